@@ -1,165 +1,135 @@
-import openai
-from openai import OpenAI
 from config import settings
+from metrics import TOOL_LATENCY
+from tracing import span
+from llm_endpoints import llm_chain, LLMUnavailable
+from rate_limit import llm_limiter, LLMQuotaExceeded
+from usage_ledger import usage_ledger, TokenBudgetExceeded
+from chat_cache import chat_cache, CachedTurn, results_digest
+from mcp_tools import tool_schemas, read_only_tools, TOOL_REGISTRY
+from intent_router import (
+    match_intent,
+    execute_intent,
+    ROUTE_LLM,
+    ROUTE_CACHE_HIT,
+    ROUTE_CACHE_REFRESHED,
+    ROUTE_SIMULATED,
+)
 import json
-from typing import Dict, Any
+import time
+from typing import Dict, Any, List, Optional
+
+SYSTEM_PROMPT = "You are a helpful task management assistant. Use the available tools to manage tasks for the user. Always respond in a friendly and helpful manner."
+
+# Tools that never write; turns using only these can be served from the response cache
+READ_ONLY_TOOLS = read_only_tools()
 
 
 class AIChatAgent:
     """
     AI Chat Agent that integrates with OpenAI and uses MCP tools
     """
-    
+
     def __init__(self, tools=None):
-        # Initialize OpenAI client
-        if settings.OPENAI_API_KEY:
-            self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
-        else:
-            # If no API key is provided, we'll simulate responses
-            self.client = None
+        # Completions go through the endpoint chain (failover, hedging, circuit breaking);
+        # with no endpoint configured, responses are simulated
+        self.llm = llm_chain if llm_chain.endpoints else None
         
         self.tools = tools
+        # Routing decision of the last processed message (see intent_router)
+        self.last_route = ROUTE_LLM
+        # LLM usage of the last processed message, stored on the assistant reply
+        self.usage = self._new_usage()
         self.tool_functions = {
-            "add_task": self.tools.add_task if self.tools else None,
-            "list_tasks": self.tools.list_tasks if self.tools else None,
-            "complete_task": self.tools.complete_task if self.tools else None,
-            "delete_task": self.tools.delete_task if self.tools else None,
-            "update_task": self.tools.update_task if self.tools else None
+            name: getattr(self.tools, name, None) for name in TOOL_REGISTRY
         } if tools else {}
     
+    @staticmethod
+    def _new_usage() -> Dict[str, Any]:
+        return {"model": None, "completions": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "latency_ms": 0, "tool_result_bytes": 0}
+    
+    async def _create_completion(self, tool_result_bytes: int = 0, **kwargs):
+        """
+        Call the chat completions API within the user's LLM concurrency quota
+        and daily token budget, and account for the tokens it used
+        """
+        user_id = self.tools.user_id if self.tools else None
+        first = self.usage["completions"] == 0
+        if first and user_id is not None:
+            await usage_ledger.check_budget(user_id)
+        
+        # Fair per-user and global cap on in-flight completions
+        async with llm_limiter.slot(user_id):
+            started = time.perf_counter()
+            response = await self.llm.complete(**kwargs)
+        
+        latency_ms = round((time.perf_counter() - started) * 1000)
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        model = getattr(response, "model", None) or "unknown"
+        self.usage["model"] = model
+        self.usage["completions"] += 1
+        self.usage["prompt_tokens"] += prompt_tokens
+        self.usage["completion_tokens"] += completion_tokens
+        self.usage["latency_ms"] += latency_ms
+        self.usage["tool_result_bytes"] += tool_result_bytes
+        if user_id is not None:
+            usage_ledger.record(user_id, model, prompt_tokens, completion_tokens, latency_ms,
+                                tool_result_bytes, turns=1 if first else 0)
+        return response
+    
+    async def _call_tool(self, function_name: str, function_args: Dict[str, Any]) -> Any:
+        """
+        Run an AsyncMCPTools tool and record its execution time
+        """
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await self.tool_functions[function_name](**function_args)
+            outcome = "failed" if isinstance(result, dict) and result.get("success") is False else "ok"
+            return result
+        finally:
+            TOOL_LATENCY.labels(function_name, outcome).observe(time.perf_counter() - started)
+    
     async def process_message(self, user_message: str) -> str:
         """
         Process a user message and return an AI response
         """
-        if not self.client:
+        self.last_route = ROUTE_LLM
+        self.usage = self._new_usage()
+        
+        # Simple commands are answered locally without a model round-trip
+        if self.tools is not None and settings.INTENT_ROUTER_ENABLED:
+            intent = match_intent(user_message)
+            if intent is not None:
+                with span("chat.fast_path", intent=intent.name):
+                    reply = await execute_intent(self.tools, intent)
+                if reply is not None:
+                    self.last_route = intent.route
+                    return reply
+        
+        if not self.llm:
             # Simulated response when no OpenAI API key is available
+            self.last_route = ROUTE_SIMULATED
             return f"I received your message: '{user_message}'. This is a simulated response since no OpenAI API key is configured."
         
-        # Define available tools
-        available_tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "add_task",
-                    "description": "Add a new task for the user",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "title": {
-                                "type": "string",
-                                "description": "Title of the task"
-                            },
-                            "description": {
-                                "type": "string",
-                                "description": "Description of the task"
-                            },
-                            "due_date": {
-                                "type": "string",
-                                "description": "Due date in ISO format (YYYY-MM-DDTHH:MM:SS.sssZ)"
-                            }
-                        },
-                        "required": ["title"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "list_tasks",
-                    "description": "List tasks for the user",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "completed": {
-                                "type": "boolean",
-                                "description": "Filter by completion status (true for completed, false for incomplete, null for all)"
-                            }
-                        }
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "complete_task",
-                    "description": "Mark a task as complete",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "task_id": {
-                                "type": "string",
-                                "description": "ID of the task to mark as complete"
-                            }
-                        },
-                        "required": ["task_id"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "delete_task",
-                    "description": "Delete a task",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "task_id": {
-                                "type": "string",
-                                "description": "ID of the task to delete"
-                            }
-                        },
-                        "required": ["task_id"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "update_task",
-                    "description": "Update a task",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "task_id": {
-                                "type": "string",
-                                "description": "ID of the task to update"
-                            },
-                            "title": {
-                                "type": "string",
-                                "description": "New title of the task"
-                            },
-                            "description": {
-                                "type": "string",
-                                "description": "New description of the task"
-                            },
-                            "due_date": {
-                                "type": "string",
-                                "description": "New due date in ISO format"
-                            },
-                            "completed": {
-                                "type": "boolean",
-                                "description": "New completion status"
-                            }
-                        },
-                        "required": ["task_id"]
-                    }
-                }
-            }
-        ]
+        # Tool definitions come from the @tool registrations in mcp_tools
+        available_tools = tool_schemas()
         
         try:
+            # Read-only turns seen before can skip one or both completions
+            cached = chat_cache.get(self.tools.user_id, user_message) if self._cache_enabled else None
+            if cached is not None:
+                return await self._replay_cached_turn(user_message, cached)
+            
+            task_version = chat_cache.task_version(self.tools.user_id) if self._cache_enabled else None
+            
             # Call OpenAI API with tools
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
+            response = await self._create_completion(
                 messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful task management assistant. Use the available tools to manage tasks for the user. Always respond in a friendly and helpful manner."
-                    },
-                    {
-                        "role": "user",
-                        "content": user_message
-                    }
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_message}
                 ],
                 tools=available_tools,
                 tool_choice="auto"
@@ -170,59 +140,120 @@ class AIChatAgent:
             
             # If the model wants to call tools
             if tool_calls:
-                # Send the info for each function call and function response to the model
-                tool_results = []
-                
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    function_args = json.loads(tool_call.function.arguments)
-                    
-                    # Call the appropriate function
-                    if function_name in self.tool_functions and self.tool_functions[function_name]:
-                        try:
-                            function_response = self.tool_functions[function_name](**function_args)
-                            tool_results.append({
-                                "tool_call_id": tool_call.id,
-                                "role": "tool",
-                                "name": function_name,
-                                "content": json.dumps(function_response)
-                            })
-                        except Exception as e:
-                            tool_results.append({
-                                "tool_call_id": tool_call.id,
-                                "role": "tool",
-                                "name": function_name,
-                                "content": json.dumps({"error": f"Error calling {function_name}: {str(e)}"})
-                            })
-                    else:
-                        tool_results.append({
-                            "tool_call_id": tool_call.id,
-                            "role": "tool",
-                            "name": function_name,
-                            "content": json.dumps({"error": f"Function {function_name} not available"})
-                        })
-                
-                # Get the final response from the model with tool results
-                final_response = self.client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "You are a helpful task management assistant. Use the available tools to manage tasks for the user. Always respond in a friendly and helpful manner."
-                        },
-                        {
-                            "role": "user",
-                            "content": user_message
-                        },
-                        *response.choices[0].message.tool_calls,
-                        *tool_results
-                    ]
-                )
-                
-                return final_response.choices[0].message.content
+                plan = [
+                    {
+                        "id": tool_call.id,
+                        "type": "function",
+                        "function": {"name": tool_call.function.name, "arguments": tool_call.function.arguments}
+                    }
+                    for tool_call in tool_calls
+                ]
+                tool_results = await self._run_tools(plan)
+                final_content = await self._final_completion(user_message, plan, tool_results)
+                self._remember(user_message, plan, tool_results, final_content, task_version)
+                chat_cache.record("miss")
+                return final_content
             else:
                 # If no tools were called, return the model's response directly
-                return response_message.content or "I processed your request."
+                content = response_message.content or "I processed your request."
+                self._remember(user_message, [], [], content, task_version)
+                chat_cache.record("miss")
+                return content
                 
+        except (LLMQuotaExceeded, LLMUnavailable, TokenBudgetExceeded):
+            # Surfaced to the route as 429 / 503 rather than an apology message
+            raise
         except Exception as e:
-            return f"Sorry, I encountered an error processing your request: {str(e)}"
\ No newline at end of file
+            return f"Sorry, I encountered an error processing your request: {str(e)}"
+    
+    @property
+    def _cache_enabled(self) -> bool:
+        return settings.CHAT_CACHE_ENABLED and self.tools is not None
+    
+    async def _run_tools(self, plan: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Execute the model's tool calls and build the tool result messages
+        """
+        tool_results = []
+        
+        for tool_call in plan:
+            function_name = tool_call["function"]["name"]
+            
+            # Call the appropriate function
+            if function_name in self.tool_functions and self.tool_functions[function_name]:
+                try:
+                    function_args = json.loads(tool_call["function"]["arguments"] or "{}")
+                    function_response = await self._call_tool(function_name, function_args)
+                    content = json.dumps(function_response)
+                except Exception as e:
+                    content = json.dumps({"error": f"Error calling {function_name}: {str(e)}"})
+            else:
+                content = json.dumps({"error": f"Function {function_name} not available"})
+            
+            tool_results.append({
+                "tool_call_id": tool_call["id"],
+                "role": "tool",
+                "name": function_name,
+                "content": content
+            })
+        
+        return tool_results
+    
+    async def _final_completion(self, user_message: str, plan: List[Dict[str, Any]],
+                                tool_results: List[Dict[str, Any]]) -> str:
+        """
+        Get the final response from the model with tool results
+        """
+        final_response = await self._create_completion(
+            # Tool output is usually most of the final prompt
+            tool_result_bytes=sum(len(result["content"].encode()) for result in tool_results),
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": None, "tool_calls": plan},
+                *tool_results
+            ]
+        )
+        return final_response.choices[0].message.content
+    
+    def _remember(self, user_message: str, plan: List[Dict[str, Any]], tool_results: List[Dict[str, Any]],
+                  content: str, task_version: Optional[int]) -> None:
+        """
+        Cache the turn if it only read data
+        """
+        if not self._cache_enabled or not content:
+            return
+        if any(tool_call["function"]["name"] not in READ_ONLY_TOOLS for tool_call in plan):
+            return
+        chat_cache.put(self.tools.user_id, user_message, CachedTurn(
+            tool_calls=plan,
+            results_digest=results_digest([result["content"] for result in tool_results]),
+            response=content,
+            task_version=task_version,
+        ))
+    
+    async def _replay_cached_turn(self, user_message: str, cached: CachedTurn) -> str:
+        """
+        Serve a cached read-only turn. The tool plan is replayed against fresh
+        data; if nothing changed the cached answer is returned without calling
+        the model, otherwise only the final completion is requested.
+        """
+        if not cached.tool_calls:
+            chat_cache.record("hit", cached, llm_calls_saved=1)
+            self.last_route = ROUTE_CACHE_HIT
+            return cached.response
+        
+        task_version = chat_cache.task_version(self.tools.user_id)
+        tool_results = await self._run_tools(cached.tool_calls)
+        digest = results_digest([result["content"] for result in tool_results])
+        
+        if task_version == cached.task_version and digest == cached.results_digest:
+            chat_cache.record("hit", cached, llm_calls_saved=2)
+            self.last_route = ROUTE_CACHE_HIT
+            return cached.response
+        
+        content = await self._final_completion(user_message, cached.tool_calls, tool_results)
+        chat_cache.record("refreshed", cached, llm_calls_saved=1)
+        self.last_route = ROUTE_CACHE_REFRESHED
+        self._remember(user_message, cached.tool_calls, tool_results, content, task_version)
+        return content
@@ -3,9 +3,10 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
 from config import settings
 from models import User
-from db import get_session
+from db import read_session, read_router, shard_map
 from sqlmodel import Session, select
 from typing import Optional
+import hmac
 import uuid
 
 
@@ -40,15 +41,18 @@ def validate_user_from_jwt(credentials: HTTPAuthorizationCredentials = Depends(s
                 headers={"WWW-Authenticate": "Bearer"},
             )
         
-        # Verify user exists in database
-        with next(get_session()) as session:
+        # Verify user exists in database (a replica serves this lookup when configured)
+        with read_session(user_uuid) as session:
             user = session.exec(select(User).where(User.id == user_uuid)).first()
-            if not user:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="User not found",
-                    headers={"WWW-Authenticate": "Bearer"},
-                )
+        if not user and read_router.replicas:
+            with shard_map.shard_for_user(user_uuid).SyncSession() as session:
+                user = session.exec(select(User).where(User.id == user_uuid)).first()
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="User not found",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
         
         return {"user_id": user_uuid, "email": user.email}
         
@@ -66,6 +70,18 @@ def validate_user_from_jwt(credentials: HTTPAuthorizationCredentials = Depends(s
         )
 
 
+def user_id_from_token(token: str) -> Optional[uuid.UUID]:
+    """
+    The user id carried by a valid JWT, or None. For code running outside
+    FastAPI dependencies (ASGI middleware, the MCP server).
+    """
+    try:
+        payload = jwt.decode(token, settings.BETTER_AUTH_SECRET, algorithms=["HS256"])
+        return uuid.UUID(payload["user_id"])
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        return None
+
+
 def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)) -> uuid.UUID:
     """
     Extract and return the user ID from the JWT token
@@ -96,4 +112,18 @@ def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(secu
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
-        )
\ No newline at end of file
+        )
+
+
+def require_admin(credentials: HTTPAuthorizationCredentials = Depends(security)) -> None:
+    """
+    Allow the request only when it carries ADMIN_TOKEN as its bearer token.
+    Admin endpoints do not exist while ADMIN_TOKEN is unset.
+    """
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    if not hmac.compare_digest(credentials.credentials.encode(), settings.ADMIN_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin token required",
+        )
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from config import settings
+from metrics import CACHE_REQUESTS, CACHE_LLM_CALLS_SAVED, CACHE_ENTRY_AGE
+import task_events
+
+_FILLER_WORDS = {"please", "pls", "can", "could", "you", "would", "hey", "hi", "me", "show", "tell", "the"}
+_NON_WORD = re.compile(r"[^a-z0-9#\s]")
+
+
+def normalize_message(message: str) -> str:
+    """
+    Reduce a chat message to a cache key: lower case, no punctuation or
+    filler words, single spaces. "Can you show me my tasks?" -> "my tasks"
+    """
+    words = _NON_WORD.sub(" ", message.lower()).split()
+    kept = [word for word in words if word not in _FILLER_WORDS]
+    return " ".join(kept or words)
+
+
+def results_digest(tool_results: List[Any]) -> str:
+    return hashlib.sha256(json.dumps(tool_results, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@dataclass
+class CachedTurn:
+    """
+    A read-only chat turn: the model's tool plan, what the tools returned, and the final answer
+    """
+    tool_calls: List[Dict[str, Any]]
+    results_digest: str
+    response: str
+    task_version: int
+    created_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created_at
+
+
+class ChatResponseCache:
+    """
+    LRU cache of read-only chat turns keyed on (user, normalized message).
+
+    Each user has a task-list version that is bumped by every task write. A
+    hit is only served verbatim when the version is unchanged and replaying the
+    cached tool plan yields the same results; otherwise the caller replays the
+    plan against fresh data and only asks the model for the final answer.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, CachedTurn]" = OrderedDict()
+        self._versions: Dict[uuid.UUID, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def task_version(self, user_id: uuid.UUID) -> int:
+        return self._versions[user_id]
+
+    def invalidate_user(self, user_id: uuid.UUID) -> None:
+        with self._lock:
+            self._versions[user_id] += 1
+
+    def get(self, user_id: uuid.UUID, message: str) -> Optional[CachedTurn]:
+        key = (user_id, normalize_message(message))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.age > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, user_id: uuid.UUID, message: str, entry: CachedTurn) -> None:
+        key = (user_id, normalize_message(message))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record(self, result: str, entry: Optional[CachedTurn] = None, llm_calls_saved: int = 0) -> None:
+        CACHE_REQUESTS.labels(result).inc()
+        if llm_calls_saved:
+            CACHE_LLM_CALLS_SAVED.inc(llm_calls_saved)
+        if entry is not None:
+            CACHE_ENTRY_AGE.labels(result).observe(entry.age)
+
+
+chat_cache = ChatResponseCache(
+    max_entries=settings.CHAT_CACHE_MAX_ENTRIES,
+    ttl=settings.CHAT_CACHE_TTL_SECONDS,
+)
+
+task_events.subscribe(lambda kind, user_id, task: chat_cache.invalidate_user(user_id))
@@ -0,0 +1,340 @@
+"""
+Response compression.
+
+The encoding is negotiated from Accept-Encoding: zstd and br when the
+zstandard / brotli packages are installed, gzip always. Complete JSON and
+text bodies of at least COMPRESSION_MIN_BYTES are compressed in one go;
+streaming responses are compressed chunk by chunk and flushed after every
+chunk, so streamed output is not held back.
+
+Successful GET responses also get a weak ETag of their body (unless the route
+set one), and If-None-Match requests for an unchanged body are answered with
+304. Compressed bodies are cached by path, query, ETag and encoding, so a
+client polling an unchanged task list or history costs no recompression.
+"""
+import asyncio
+import hashlib
+import re
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from config import settings
+from metrics import COMPRESSION_BYTES, COMPRESSION_CACHE
+
+try:
+    import brotli
+except ImportError:  # br is offered only when brotli is installed
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstd is offered only when zstandard is installed
+    zstandard = None
+
+Headers = List[Tuple[bytes, bytes]]
+
+_COMPRESSIBLE = re.compile(rb"^(?:text/|application/(?:[\w.+-]+\+)?(?:json|xml|javascript)\b)")
+# Bodies this large are compressed off the event loop
+THREAD_MIN_BYTES = 256 * 1024
+
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _Zstd:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=settings.COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def available_encodings() -> Dict[str, type]:
+    """
+    Supported encodings, most preferred first
+    """
+    encodings = {}
+    if zstandard is not None:
+        encodings["zstd"] = _Zstd
+    if brotli is not None:
+        encodings["br"] = _Brotli
+    encodings["gzip"] = _Gzip
+    return encodings
+
+
+ENCODINGS = available_encodings()
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """
+    The supported encoding with the highest q-value in Accept-Encoding, or None
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            accepted[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(encoding: str, body: bytes) -> bytes:
+    compressor = ENCODINGS[encoding]()
+    return compressor.compress(body) + compressor.finish()
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Weak comparison of an ETag against an If-None-Match header
+    """
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return any(tag.strip() == "*" or opaque(tag) == opaque(etag) for tag in if_none_match.split(","))
+
+
+def _header(headers: Headers, name: bytes) -> Optional[bytes]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _without(headers: Headers, *names: bytes) -> Headers:
+    return [(key, value) for key, value in headers if key.lower() not in names]
+
+
+def _add_vary(headers: Headers) -> Headers:
+    vary = _header(headers, b"vary")
+    if vary is None:
+        return headers + [(b"vary", b"Accept-Encoding")]
+    if b"accept-encoding" in vary.lower() or vary.strip() == b"*":
+        return headers
+    return _without(headers, b"vary") + [(b"vary", vary + b", Accept-Encoding")]
+
+
+class CompressedBodyCache:
+    """
+    Compressed response bodies, least recently used evicted first once
+    `max_bytes` is exceeded
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._size = 0
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        body = self._entries.get(key)
+        if body is not None:
+            self._entries.move_to_end(key)
+        return body
+
+    def put(self, key: tuple, body: bytes) -> None:
+        # One huge body should not flush everything else out
+        if len(body) > self.max_bytes // 8:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous)
+        self._entries[key] = body
+        self._size += len(body)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+
+class _Responder:
+    """
+    Rewrites one response: holds back http.response.start until the first
+    body chunk shows whether the body is complete or streamed
+    """
+
+    def __init__(self, middleware: "CompressionMiddleware", scope, send, encoding: Optional[str],
+                 if_none_match: Optional[str]):
+        self.middleware = middleware
+        self.scope = scope
+        self._send = send
+        self.encoding = encoding
+        self.if_none_match = if_none_match
+        self.start: Optional[dict] = None
+        self.compressor = None
+        self.passthrough = False
+
+    def _eligible(self) -> bool:
+        headers = self.start.get("headers", [])
+        content_type = _header(headers, b"content-type") or b""
+        return (
+            self.start["status"] not in (204, 304)
+            and self.scope["method"] != "HEAD"
+            and _header(headers, b"content-encoding") is None
+            and bool(_COMPRESSIBLE.match(content_type.lower()))
+        )
+
+    async def send(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if self.passthrough or message["type"] != "http.response.body":
+            if self.start is not None:
+                await self._send(self.start)
+                self.start = None
+            self.passthrough = True
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is not None:
+            await self._stream(body, more_body)
+        elif not self._eligible():
+            self.passthrough = True
+            await self._send(self.start)
+            self.start = None
+            await self._send(message)
+        elif more_body:
+            await self._begin_stream(body)
+        else:
+            await self._send_complete(body)
+
+    async def _begin_stream(self, body: bytes) -> None:
+        headers = _add_vary(list(self.start.get("headers", [])))
+        if self.encoding is None:
+            self.passthrough = True
+            await self._send({**self.start, "headers": headers})
+            await self._send({"type": "http.response.body", "body": body, "more_body": True})
+            return
+        self.compressor = ENCODINGS[self.encoding]()
+        headers = _without(headers, b"content-length", b"etag") + [(b"content-encoding", self.encoding.encode())]
+        await self._send({**self.start, "headers": headers})
+        await self._stream(body, True)
+
+    async def _stream(self, body: bytes, more_body: bool) -> None:
+        chunk = self.compressor.compress(body)
+        chunk += self.compressor.flush() if more_body else self.compressor.finish()
+        COMPRESSION_BYTES.labels(self.encoding, "original").inc(len(body))
+        COMPRESSION_BYTES.labels(self.encoding, "compressed").inc(len(chunk))
+        await self._send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+    async def _send_complete(self, body: bytes) -> None:
+        status = self.start["status"]
+        headers = _add_vary(list(self.start.get("headers", [])))
+        etag = _header(headers, b"etag")
+
+        if self.scope["method"] == "GET" and status == 200:
+            if etag is None:
+                etag = b'W/"' + hashlib.sha256(body).hexdigest()[:32].encode() + b'"'
+                headers.append((b"etag", etag))
+            if self.if_none_match is not None and etag_matches(self.if_none_match, etag.decode("latin-1")):
+                COMPRESSION_CACHE.labels("not_modified").inc()
+                await self._send({**self.start, "status": 304,
+                                  "headers": _without(headers, b"content-length", b"content-type")})
+                await self._send({"type": "http.response.body", "body": b""})
+                return
+
+        if self.encoding is None or len(body) < self.middleware.minimum_size:
+            await self._send({**self.start, "headers": headers})
+            await self._send({"type": "http.response.body", "body": body})
+            return
+
+        compressed = await self.middleware.compressed(self.scope, etag, self.encoding, body)
+        COMPRESSION_BYTES.labels(self.encoding, "original").inc(len(body))
+        COMPRESSION_BYTES.labels(self.encoding, "compressed").inc(len(compressed))
+        headers = _without(headers, b"content-length") + [
+            (b"content-encoding", self.encoding.encode()),
+            (b"content-length", str(len(compressed)).encode()),
+        ]
+        await self._send({**self.start, "headers": headers})
+        await self._send({"type": "http.response.body", "body": compressed})
+
+
+class CompressionMiddleware:
+    """
+    Pure ASGI middleware (see the module docstring)
+    """
+
+    def __init__(self, app, minimum_size: Optional[int] = None):
+        self.app = app
+        self.minimum_size = settings.COMPRESSION_MIN_BYTES if minimum_size is None else minimum_size
+        self.cache = CompressedBodyCache(settings.COMPRESSION_CACHE_MAX_BYTES)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.COMPRESSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        encoding = negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if_none_match = headers.get(b"if-none-match")
+        if encoding is None and if_none_match is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _Responder(self, scope, send, encoding,
+                               if_none_match.decode("latin-1") if if_none_match is not None else None)
+        await self.app(scope, receive, responder.send)
+
+    async def compressed(self, scope, etag: Optional[bytes], encoding: str, body: bytes) -> bytes:
+        """
+        `body` compressed with `encoding`, from the cache when this ETag was compressed before
+        """
+        key = (scope["path"], scope.get("query_string", b""), etag, encoding) if etag is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                COMPRESSION_CACHE.labels("hit").inc()
+                return cached
+            COMPRESSION_CACHE.labels("miss").inc()
+
+        if len(body) >= THREAD_MIN_BYTES:
+            result = await asyncio.to_thread(compress, encoding, body)
+        else:
+            result = compress(encoding, body)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
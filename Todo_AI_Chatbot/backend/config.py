@@ -8,6 +8,136 @@ class Settings(BaseSettings):
     BETTER_AUTH_SECRET: str
     OPENAI_API_KEY: Optional[str] = None
     JWT_SECRET: Optional[str] = None
+    # Write-behind chat message persistence
+    MESSAGE_FLUSH_INTERVAL_MS: int = 5
+    MESSAGE_FLUSH_BATCH_SIZE: int = 100
+    # Failed inserts of one message before it is dead-lettered to the log, queued rows above
+    # which chat turns wait (then get 503), and how long shutdown may spend draining the queue
+    MESSAGE_MAX_ATTEMPTS: int = 5
+    MESSAGE_QUEUE_MAX_ROWS: int = 10000
+    MESSAGE_QUEUE_WAIT_SECONDS: float = 5.0
+    MESSAGE_DRAIN_SECONDS: float = 10.0
+    # Message partitioning and cold-conversation archival
+    MESSAGE_PARTITION_MONTHS_AHEAD: int = 3
+    MESSAGE_ARCHIVE_AFTER_DAYS: int = 90
+    MESSAGE_MAINTENANCE_INTERVAL_SECONDS: int = 3600
+    # Query profiling
+    SLOW_QUERY_THRESHOLD_MS: int = 200
+    SLOW_QUERY_EXPLAIN: bool = True
+    N_PLUS_ONE_THRESHOLD: int = 3
+    QUERY_BUDGET_PER_REQUEST: Optional[int] = None
+    # Tracing: fraction of new traces recorded, and where finished spans are written
+    TRACE_SAMPLE_RATIO: float = 0.0
+    TRACE_EXPORT_PATH: Optional[str] = None
+    # Per-user rate limiting (token bucket) and LLM concurrency quotas
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_CAPACITY: int = 60
+    RATE_LIMIT_REFILL_PER_SECOND: float = 1.0
+    CHAT_REQUEST_COST: int = 5
+    RATE_LIMIT_REDIS_URL: Optional[str] = None
+    LLM_MAX_CONCURRENT: int = 32
+    LLM_MAX_CONCURRENT_PER_USER: int = 2
+    LLM_QUEUE_TIMEOUT_SECONDS: float = 10.0
+    # LLM endpoint chain, in order of preference: comma-separated name=model@base_url
+    # (base_url optional for OpenAI); empty means LLM_MODEL on OpenAI when OPENAI_API_KEY is set
+    LLM_ENDPOINTS: str = ""
+    LLM_MODEL: str = "gpt-3.5-turbo"
+    LLM_TIMEOUT_SECONDS: float = 20.0
+    LLM_DEADLINE_SECONDS: float = 40.0
+    LLM_MAX_RETRIES: int = 2
+    LLM_RETRY_BASE_SECONDS: float = 0.25
+    LLM_RETRY_MAX_SECONDS: float = 4.0
+    LLM_HEDGE_ENABLED: bool = True
+    LLM_HEDGE_PERCENTILE: float = 0.95
+    LLM_HEDGE_MIN_SAMPLES: int = 20
+    LLM_BREAKER_FAILURES: int = 5
+    LLM_BREAKER_RESET_SECONDS: float = 30.0
+    # Cache of read-only chat turns
+    CHAT_CACHE_ENABLED: bool = True
+    CHAT_CACHE_MAX_ENTRIES: int = 10000
+    CHAT_CACHE_TTL_SECONDS: int = 600
+    # Deterministic fast path for simple commands ("add buy milk", "complete #3")
+    INTENT_ROUTER_ENABLED: bool = True
+    # Standalone MCP server (mcp_server.py)
+    MCP_AUTH_TOKEN: Optional[str] = None
+    MCP_HTTP_PORT: int = 8001
+    MCP_WARM_CONNECTIONS: int = 5
+    MCP_MAX_IN_FLIGHT: int = 64
+    MCP_MAX_BATCH_SIZE: int = 100
+    # Due-date reminders. One elected API process runs the scheduler; it rereads the loaded
+    # window every REMINDER_RESCAN_SECONDS to pick up task writes made in other processes.
+    REMINDERS_ENABLED: bool = True
+    REMINDER_LEAD_SECONDS: int = 0
+    REMINDER_HORIZON_SECONDS: int = 3600
+    REMINDER_GRACE_SECONDS: int = 300
+    REMINDER_RESCAN_SECONDS: int = 60
+    # How often processes not elected to run a singleton loop try to take it over
+    LEADER_ELECTION_INTERVAL_SECONDS: float = 15.0
+    # Background job queue ("database" uses the jobs table, "memory" is in-process only).
+    # Set JOB_WORKER_IN_PROCESS=false only when separate worker.py processes run the jobs.
+    JOB_QUEUE_BACKEND: str = "database"
+    JOB_WORKER_IN_PROCESS: bool = True
+    JOB_WORKER_CONCURRENCY: int = 4
+    JOB_POLL_INTERVAL_SECONDS: float = 1.0
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BASE_SECONDS: float = 2.0
+    JOB_RETRY_MAX_SECONDS: float = 600.0
+    JOB_LOCK_TIMEOUT_SECONDS: int = 300
+    JOB_RETENTION_HOURS: int = 24
+    # Idempotency-Key handling for POST /tasks and POST /chat
+    IDEMPOTENCY_ENABLED: bool = True
+    IDEMPOTENCY_TTL_SECONDS: int = 86400
+    IDEMPOTENCY_MAX_ENTRIES: int = 100000
+    IDEMPOTENCY_WAIT_SECONDS: float = 60.0
+    IDEMPOTENCY_REDIS_URL: Optional[str] = None
+    # Read replicas (comma-separated URLs); reads fall back to the primary when none are healthy
+    DATABASE_REPLICA_URLS: str = ""
+    REPLICA_HEALTH_CHECK_INTERVAL_SECONDS: float = 5.0
+    REPLICA_MAX_LAG_SECONDS: float = 10.0
+    READ_YOUR_WRITES_SECONDS: float = 5.0
+    # Hash sharding by user_id: comma-separated name=url pairs; empty keeps everything on DATABASE_URL
+    DATABASE_SHARD_URLS: str = ""
+    SHARD_VIRTUAL_NODES: int = 128
+    SHARD_DIRECTORY_CACHE_SECONDS: float = 30.0
+    # Semantic task index for find_tasks and duplicate warnings (needs numpy)
+    TASK_INDEX_ENABLED: bool = True
+    TASK_INDEX_DIMENSIONS: int = 256
+    TASK_INDEX_MAX_USERS: int = 1000
+    TASK_INDEX_TTL_SECONDS: float = 300.0
+    TASK_MATCH_MIN_SCORE: float = 0.2
+    TASK_DUPLICATE_THRESHOLD: float = 0.75
+    # Admin endpoints (/api/admin) take this as bearer token; they are disabled while unset
+    ADMIN_TOKEN: Optional[str] = None
+    # Token-usage ledger, and each user's daily LLM token budget (0 = unlimited)
+    USAGE_FLUSH_SECONDS: float = 5.0
+    LLM_DAILY_TOKEN_BUDGET: int = 0
+    USAGE_BUDGET_CACHE_SECONDS: float = 30.0
+    # Event-loop lag monitor: logs the stack of callbacks blocking the loop longer than the threshold
+    LOOP_LAG_MONITOR_ENABLED: bool = True
+    LOOP_LAG_THRESHOLD_MS: int = 250
+    LOOP_LAG_INTERVAL_MS: int = 100
+    # On-demand sampling profiler (GET /api/admin/profile)
+    PROFILER_MAX_SECONDS: float = 60.0
+    PROFILER_INTERVAL_MS: float = 10.0
+    # Response compression (zstd and br need the zstandard and brotli packages) and the
+    # cache of compressed bodies by ETag
+    COMPRESSION_ENABLED: bool = True
+    COMPRESSION_MIN_BYTES: int = 1024
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_BROTLI_QUALITY: int = 5
+    COMPRESSION_ZSTD_LEVEL: int = 3
+    COMPRESSION_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    # Production server (serve.py). DB_CONNECTION_BUDGET caps the connections all web workers
+    # together hold to each database (0 keeps SQLAlchemy's default pool sizes). With several
+    # workers serve.py refuses state kept per worker (rate limits, idempotency keys, replica
+    # pins) unless ALLOW_PER_WORKER_STATE accepts its limits.
+    WEB_WORKERS: int = 1
+    ALLOW_PER_WORKER_STATE: bool = False
+    DB_CONNECTION_BUDGET: int = 0
+    DB_POOL_TIMEOUT_SECONDS: float = 30.0
+    DB_POOL_WARMUP: bool = True
+    # How long in-flight requests and streamed responses may finish after SIGTERM
+    SHUTDOWN_DRAIN_SECONDS: float = 30.0
 
     class Config:
         env_file = ".env"
@@ -1,23 +1,66 @@
-from sqlmodel import create_engine
+from sqlmodel import create_engine, Session
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession as AsyncSessionClass
 from sqlalchemy.orm import sessionmaker
+from fastapi import HTTPException
 from config import settings
+from metrics import checked_out
+from sharding import DEFAULT_SHARD, MOVING, Shard, ShardMap, UserMoving, parse_shard_urls
+from typing import Dict, List, Optional
+import asyncio
+import itertools
+import logging
+import threading
+import time
 import urllib.parse
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def _engine_urls(database_url: str) -> tuple[str, str]:
+    """
+    (sync URL, async URL) for a configured database URL
+    """
+    async_url = database_url
+    # Replace postgresql:// with postgresql+asyncpg:// for async support
+    if async_url.startswith("postgresql://"):
+        async_url = async_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    # SQLite (local development and benchmarks) needs the aiosqlite driver for the async engine
+    elif async_url.startswith("sqlite://"):
+        async_url = async_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+    sync_url = (
+        async_url
+        .replace("postgresql+asyncpg://", "postgresql://", 1)
+        .replace("sqlite+aiosqlite://", "sqlite://", 1)
+    )
+    return sync_url, async_url
 
-# Properly encode the database URL to handle special characters
-encoded_database_url = settings.DATABASE_URL
 
-# Replace postgresql:// with postgresql+asyncpg:// for async support
-if encoded_database_url.startswith("postgresql://"):
-    encoded_database_url = encoded_database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+def pool_options(url: str) -> dict:
+    """
+    Connection pool arguments for an engine. Each web worker gets an equal
+    share of DB_CONNECTION_BUDGET per database, split between its sync and
+    async engine; overflow is disabled so the budget holds.
+    """
+    if settings.DB_CONNECTION_BUDGET <= 0 or url.startswith("sqlite"):
+        return {}
+    per_engine = max(settings.DB_CONNECTION_BUDGET // max(settings.WEB_WORKERS, 1) // 2, 1)
+    return {"pool_size": per_engine, "max_overflow": 0, "pool_timeout": settings.DB_POOL_TIMEOUT_SECONDS}
+
+
+# Properly encode the database URL to handle special characters
+sync_database_url, encoded_database_url = _engine_urls(settings.DATABASE_URL)
 
 # Synchronous engine and session
-sync_engine = create_engine(encoded_database_url.replace("postgresql+asyncpg://", "postgresql://", 1))
-SyncSession = sessionmaker(bind=sync_engine, autocommit=False, autoflush=False)
+sync_engine = create_engine(sync_database_url, **pool_options(sync_database_url))
+SyncSession = sessionmaker(bind=sync_engine, class_=Session, autocommit=False, autoflush=False)
 
 # Asynchronous engine and session
-async_engine = create_async_engine(encoded_database_url, pool_pre_ping=True)
-AsyncSession = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+async_engine = create_async_engine(encoded_database_url, pool_pre_ping=True, **pool_options(encoded_database_url))
+AsyncSession = async_sessionmaker(async_engine, class_=AsyncSessionClass, expire_on_commit=False)
 
 
 async def get_async_session():
@@ -27,13 +70,19 @@ async def get_async_session():
 
 async def create_db_and_tables():
     """Create database tables"""
-    from models import User, Task, Conversation, Message  # Import here to avoid circular imports
+    from models import User, Task, TaskCounters, Conversation, Message, ArchivedConversation, Job, TokenUsage  # Import here to avoid circular imports
     from sqlmodel import SQLModel
 
     async with async_engine.begin() as conn:
         # Create tables
         await conn.run_sync(SQLModel.metadata.create_all)
 
+    # Each shard gets the full schema; the directory and jobs tables are only used on the main database
+    for shard in shard_map.all():
+        if shard.async_engine is not async_engine:
+            async with shard.async_engine.begin() as conn:
+                await conn.run_sync(SQLModel.metadata.create_all)
+
 
 def get_session():
     """Get synchronous session"""
@@ -41,4 +90,294 @@ def get_session():
     try:
         yield session
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+
+def _create_engines(url: str):
+    sync_url, async_url = _engine_urls(url)
+    return (
+        create_engine(sync_url, pool_pre_ping=True, **pool_options(sync_url)),
+        create_async_engine(async_url, pool_pre_ping=True, **pool_options(async_url)),
+    )
+
+
+class Replica:
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.sync_engine, self.async_engine = _create_engines(url)
+        self.healthy = True
+        self.lag: Optional[float] = None
+
+    @property
+    def load(self) -> int:
+        # Connections currently checked out of both pools
+        return checked_out(self.sync_engine.pool) + checked_out(self.async_engine.pool)
+
+
+class ReplicaRouter:
+    """
+    Chooses where read-only work runs.
+
+    Reads go to the least-loaded healthy replica (round-robin between equally
+    loaded ones), or to the primary when there are no healthy replicas. A user
+    who wrote within the last `pin_seconds` reads from the primary, so they
+    always see their own writes despite replication lag. Pins are kept per
+    process.
+    """
+
+    def __init__(self, urls: List[str], pin_seconds: float, max_lag: float, check_interval: float):
+        self.replicas = [Replica(f"replica{index}", url) for index, url in enumerate(urls)]
+        self.pin_seconds = pin_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._pinned: Dict[str, float] = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def mark_write(self, user_id) -> None:
+        """
+        Send this user's reads to the primary for the next `pin_seconds`
+        """
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._pinned[str(user_id)] = now + self.pin_seconds
+            if len(self._pinned) > 10000:
+                self._pinned = {key: until for key, until in self._pinned.items() if until > now}
+
+    def is_pinned(self, user_id) -> bool:
+        until = self._pinned.get(str(user_id))
+        return until is not None and until > time.monotonic()
+
+    def pick(self, user_id=None) -> Optional[Replica]:
+        """
+        The replica for a read by `user_id`, or None to use the primary
+        """
+        if not self.replicas or (user_id is not None and self.is_pinned(user_id)):
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        least = min(replica.load for replica in healthy)
+        candidates = [replica for replica in healthy if replica.load == least]
+        return candidates[next(self._counter) % len(candidates)]
+
+    async def check_health(self) -> None:
+        for replica in self.replicas:
+            try:
+                async with replica.async_engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+                    if replica.async_engine.dialect.name == "postgresql":
+                        # NULL on a primary or a replica that has replayed nothing yet
+                        lag = (await conn.execute(text(
+                            "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+                        ))).scalar()
+                        replica.lag = float(lag) if lag is not None else None
+                healthy = replica.lag is None or replica.lag <= self.max_lag
+            except Exception:
+                logger.warning("Read replica %s failed its health check", replica.name, exc_info=True)
+                healthy = False
+            if healthy != replica.healthy:
+                logger.info("Read replica %s is now %s", replica.name, "healthy" if healthy else "unhealthy")
+            replica.healthy = healthy
+
+    async def start(self) -> None:
+        if self.replicas and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.check_interval)
+
+
+read_router = ReplicaRouter(
+    urls=[url.strip() for url in settings.DATABASE_REPLICA_URLS.split(",") if url.strip()],
+    pin_seconds=settings.READ_YOUR_WRITES_SECONDS,
+    max_lag=settings.REPLICA_MAX_LAG_SECONDS,
+    check_interval=settings.REPLICA_HEALTH_CHECK_INTERVAL_SECONDS,
+)
+
+_replica_sessions = {
+    replica.name: (
+        sessionmaker(bind=replica.sync_engine, class_=Session, autocommit=False, autoflush=False),
+        async_sessionmaker(replica.async_engine, class_=AsyncSessionClass, expire_on_commit=False),
+    )
+    for replica in read_router.replicas
+}
+
+
+_shard_urls = parse_shard_urls(settings.DATABASE_SHARD_URLS)
+shard_map = ShardMap(
+    shards=[Shard(name, *_create_engines(url)) for name, url in _shard_urls]
+    or [Shard(DEFAULT_SHARD, sync_engine, async_engine)],
+    directory=SyncSession,
+    async_directory=AsyncSession,
+    vnodes=settings.SHARD_VIRTUAL_NODES,
+    cache_seconds=settings.SHARD_DIRECTORY_CACHE_SECONDS,
+    enabled=bool(_shard_urls),
+)
+
+
+def _check_writable(status: str) -> None:
+    if status == MOVING:
+        # rebalance.py is copying this user to another shard
+        error = UserMoving()
+        raise HTTPException(
+            status_code=503,
+            detail=str(error),
+            headers={"Retry-After": str(error.retry_after)},
+        )
+
+
+def get_user_session(user_id: uuid.UUID):
+    """
+    Synchronous session on the shard holding `user_id` (the path parameter
+    of /api/{user_id} routes)
+    """
+    name, status = shard_map.lookup(user_id)
+    _check_writable(status)
+    session = shard_map.shards[name].SyncSession()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def user_write_session(user_id: uuid.UUID) -> Session:
+    """
+    A synchronous session for writes on behalf of `user_id` outside of the
+    request dependencies; raises 503 while the user is being moved
+    """
+    name, status = shard_map.lookup(user_id)
+    _check_writable(status)
+    return shard_map.shards[name].SyncSession()
+
+
+async def get_async_user_session(user_id: uuid.UUID):
+    name, status = await shard_map.alookup(user_id)
+    _check_writable(status)
+    async with shard_map.shards[name].AsyncSession() as session:
+        yield session
+
+
+def read_session(user_id=None) -> Session:
+    """
+    A synchronous session for read-only work on behalf of `user_id`.
+    Replicas serve the default shard; other shards are read from directly.
+    """
+    shard = shard_map.shard_for_user(user_id) if user_id is not None else None
+    if shard is not None and shard.name != DEFAULT_SHARD:
+        return shard.SyncSession()
+    replica = read_router.pick(user_id)
+    return _replica_sessions[replica.name][0]() if replica else SyncSession()
+
+
+async def async_read_session(user_id=None):
+    """
+    An AsyncSession for read-only work on behalf of `user_id`
+    """
+    shard = await shard_map.ashard_for_user(user_id) if user_id is not None else None
+    if shard is not None and shard.name != DEFAULT_SHARD:
+        return shard.AsyncSession()
+    replica = read_router.pick(user_id)
+    return _replica_sessions[replica.name][1]() if replica else AsyncSession()
+
+
+def get_read_session(user_id: Optional[uuid.UUID] = None):
+    """
+    Synchronous session for read-only routes. Routes under /api/{user_id}
+    receive the path's user_id, so that user's recent writes stay visible.
+    """
+    session = read_session(user_id)
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+async def get_async_read_session(user_id: Optional[uuid.UUID] = None):
+    async with await async_read_session(user_id) as session:
+        yield session
+
+
+def _pin_writer(kind, user_id, task) -> None:
+    read_router.mark_write(user_id)
+
+
+# Task writes pin the user to the primary; imported late because models import sqlmodel only
+import task_events  # noqa: E402
+task_events.subscribe(_pin_writer)
+
+
+def all_engines() -> list:
+    """
+    (name, sync engine, async engine) of the main database, shards and replicas
+    """
+    engines = [("main", sync_engine, async_engine)]
+    for database in [*shard_map.all(), *read_router.replicas]:
+        if database.sync_engine is not sync_engine:
+            engines.append((database.name, database.sync_engine, database.async_engine))
+    return engines
+
+
+def _pool_size(engine) -> int:
+    # QueuePool keeps `size()` connections; SQLite pools keep at most one
+    size = getattr(engine.pool, "size", None)
+    return size() if callable(size) else 1
+
+
+def _open_sync(engine, count: int) -> None:
+    connections = [engine.connect() for _ in range(count)]
+    for connection in connections:
+        connection.close()
+
+
+async def _open_async(engine, count: int) -> None:
+    connections = [await engine.connect().start() for _ in range(count)]
+    for connection in connections:
+        await connection.close()
+
+
+async def warm_pools() -> None:
+    """
+    Fill every pool with its steady-state connections, so the first requests
+    after startup do not wait on connection setup
+    """
+    for name, sync, async_ in all_engines():
+        try:
+            await asyncio.to_thread(_open_sync, sync, _pool_size(sync))
+            await _open_async(async_, _pool_size(async_.sync_engine))
+        except Exception:
+            # An unreachable replica is routed around; the primary would already have failed startup
+            logger.warning("Could not warm the connection pools of %s", name, exc_info=True)
+
+
+async def dispose_engines() -> None:
+    """
+    Close all pooled connections at shutdown
+    """
+    for _, sync, async_ in all_engines():
+        sync.dispose()
+        await async_.dispose()
+
+
+def reset_pools_after_fork() -> None:
+    """
+    Drop pooled connections inherited from the parent process without closing
+    them, so a forked worker never shares a socket with its parent
+    """
+    for _, sync, async_ in all_engines():
+        sync.dispose(close=False)
+        async_.sync_engine.dispose(close=False)
@@ -0,0 +1,94 @@
+"""
+Local OpenAI-compatible chat completions endpoint with configurable latency
+and failures, for exercising the LLM endpoint chain without a real provider.
+
+    python fake_llm.py --port 9001 --latency-ms 300 --slow-rate 0.05 --slow-ms 5000
+    python fake_llm.py --port 9002 --error-rate 0.3 --error-status 503
+    LLM_ENDPOINTS=primary=fake@http://localhost:9001/v1,backup=fake@http://localhost:9002/v1 uvicorn main:app
+
+Messages mentioning "list" or "tasks" get a list_tasks tool call when tools
+are offered, so the chat tool path is exercised too.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def create_app(latency_ms: float = 0.0, jitter_ms: float = 0.0, slow_rate: float = 0.0, slow_ms: float = 0.0,
+               error_rate: float = 0.0, error_status: int = 500) -> FastAPI:
+    app = FastAPI(title="Fake LLM")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        delay = latency_ms + random.uniform(0, jitter_ms)
+        if random.random() < slow_rate:
+            # Tail latency: the requests hedging is meant to rescue
+            delay += slow_ms
+        await asyncio.sleep(delay / 1000)
+
+        if random.random() < error_rate:
+            return JSONResponse(
+                status_code=error_status,
+                content={"error": {"message": "Injected failure", "type": "server_error", "code": None}},
+            )
+
+        messages = body.get("messages") or []
+        last = messages[-1] if messages else {}
+        text = last.get("content") or ""
+        message = {"role": "assistant", "content": "Done."}
+        if body.get("tools") and last.get("role") == "user" and ("list" in text or "tasks" in text):
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:8]}",
+                    "type": "function",
+                    "function": {"name": "list_tasks", "arguments": json.dumps({"completed": False})},
+                }],
+            }
+
+        prompt_tokens = len(json.dumps(messages)) // 4
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+            }],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 8, "total_tokens": prompt_tokens + 8},
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fraction of requests that are slow")
+    parser.add_argument("--slow-ms", type=float, default=5000.0, help="Extra latency of a slow request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(
+        create_app(args.latency_ms, args.jitter_ms, args.slow_rate, args.slow_ms, args.error_rate, args.error_status),
+        host=args.host,
+        port=args.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
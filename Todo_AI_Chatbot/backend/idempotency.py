@@ -0,0 +1,324 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+from auth import user_id_from_token
+from config import settings
+from metrics import IDEMPOTENCY_REQUESTS
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # The shared store is optional
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of IdempotencyStore.begin
+OWNER = "owner"
+REPLAY = "replay"
+MISMATCH = "mismatch"
+CONFLICT = "conflict"
+FULL = "full"
+
+
+@dataclass
+class StoredResponse:
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "status": self.status,
+            "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in self.headers],
+            "body": base64.b64encode(self.body).decode(),
+        })
+
+    @classmethod
+    def from_json(cls, raw: str) -> "StoredResponse":
+        data = json.loads(raw)
+        return cls(
+            status=data["status"],
+            headers=[(name.encode("latin-1"), value.encode("latin-1")) for name, value in data["headers"]],
+            body=base64.b64decode(data["body"]),
+        )
+
+
+@dataclass
+class _Entry:
+    fingerprint: str
+    expires_at: float
+    response: Optional[StoredResponse] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class InMemoryIdempotencyStore:
+    """
+    Idempotency records kept in this process. Concurrent duplicates wait on
+    the first request's completion event instead of running again. Above
+    `max_entries` the oldest completed or expired record makes room; records
+    of requests still running are never evicted, so a new key is refused
+    (FULL) when only those are left.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, wait_timeout: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    async def begin(self, key: str, fingerprint: str) -> Tuple[str, Optional[StoredResponse]]:
+        """
+        Claim `key` for this request. Returns (OWNER, None) when the caller
+        should run the request, (REPLAY, response) for a completed duplicate,
+        or MISMATCH / CONFLICT / FULL.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                if len(self._entries) >= self.max_entries and not self._evict_one(now):
+                    return FULL, None
+                self._entries[key] = _Entry(fingerprint=fingerprint, expires_at=now + self.ttl)
+                return OWNER, None
+
+            if entry.fingerprint != fingerprint:
+                return MISMATCH, None
+            if entry.response is not None:
+                return REPLAY, entry.response
+
+            # Same request still running: wait for it, then look again
+            # (the owner may also have given up, in which case we take over)
+            try:
+                await asyncio.wait_for(entry.done.wait(), timeout=max(deadline - now, 0))
+            except asyncio.TimeoutError:
+                return CONFLICT, None
+
+    def _evict_one(self, now: float) -> bool:
+        # Oldest first; a pending entry's owner and waiters still rely on it
+        for key, entry in self._entries.items():
+            if entry.response is not None or entry.expires_at <= now:
+                del self._entries[key]
+                return True
+        return False
+
+    async def finish(self, key: str, fingerprint: str, response: StoredResponse) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry.fingerprint == fingerprint:
+            entry.response = response
+            entry.done.set()
+
+    async def abandon(self, key: str, fingerprint: str) -> None:
+        entry = self._entries.get(key)
+        if entry is not None and entry.fingerprint == fingerprint:
+            del self._entries[key]
+            entry.done.set()
+
+
+class RedisIdempotencyStore:
+    """
+    Idempotency records shared between workers through Redis. A pending
+    record is a lease that expires, so a crashed worker does not block the key.
+    Finishing or abandoning checks the fingerprint in the same script, so an
+    owner whose lease ran out never overwrites a record another request took over.
+    """
+
+    _FINISH = """
+    local current = redis.call('GET', KEYS[1])
+    if current and cjson.decode(current)['fingerprint'] ~= ARGV[1] then
+        return 0
+    end
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+    """
+
+    _ABANDON = """
+    local current = redis.call('GET', KEYS[1])
+    if current then
+        local record = cjson.decode(current)
+        if record['fingerprint'] == ARGV[1] and record['response'] == cjson.null then
+            redis.call('DEL', KEYS[1])
+            return 1
+        end
+    end
+    return 0
+    """
+
+    def __init__(self, url: str, ttl: float, wait_timeout: float, poll_interval: float = 0.05):
+        self._client = redis_asyncio.from_url(url)
+        self._finish = self._client.register_script(self._FINISH)
+        self._abandon = self._client.register_script(self._ABANDON)
+        self.ttl = int(ttl)
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+    async def begin(self, key: str, fingerprint: str) -> Tuple[str, Optional[StoredResponse]]:
+        redis_key = f"idempotency:{key}"
+        pending = json.dumps({"fingerprint": fingerprint, "response": None})
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            if await self._client.set(redis_key, pending, nx=True, ex=max(int(self.wait_timeout), 1)):
+                return OWNER, None
+            raw = await self._client.get(redis_key)
+            if raw is not None:
+                record = json.loads(raw)
+                if record["fingerprint"] != fingerprint:
+                    return MISMATCH, None
+                if record["response"] is not None:
+                    return REPLAY, StoredResponse.from_json(record["response"])
+            if time.monotonic() >= deadline:
+                return CONFLICT, None
+            await asyncio.sleep(self.poll_interval)
+
+    async def finish(self, key: str, fingerprint: str, response: StoredResponse) -> None:
+        record = json.dumps({"fingerprint": fingerprint, "response": response.to_json()})
+        await self._finish(keys=[f"idempotency:{key}"], args=[fingerprint, record, self.ttl])
+
+    async def abandon(self, key: str, fingerprint: str) -> None:
+        await self._abandon(keys=[f"idempotency:{key}"], args=[fingerprint])
+
+
+def _create_store():
+    if settings.IDEMPOTENCY_REDIS_URL:
+        if redis_asyncio is None:
+            raise RuntimeError("IDEMPOTENCY_REDIS_URL is set but the redis package is not installed")
+        return RedisIdempotencyStore(
+            settings.IDEMPOTENCY_REDIS_URL, settings.IDEMPOTENCY_TTL_SECONDS, settings.IDEMPOTENCY_WAIT_SECONDS
+        )
+    return InMemoryIdempotencyStore(
+        settings.IDEMPOTENCY_TTL_SECONDS, settings.IDEMPOTENCY_MAX_ENTRIES, settings.IDEMPOTENCY_WAIT_SECONDS
+    )
+
+
+def _json_response(status: int, detail: str) -> StoredResponse:
+    body = json.dumps({"detail": detail}).encode()
+    return StoredResponse(status, [(b"content-type", b"application/json"),
+                                   (b"content-length", str(len(body)).encode())], body)
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware honouring the Idempotency-Key header on POST /tasks and
+    POST /chat. The first request with a key runs normally and its response
+    is stored for IDEMPOTENCY_TTL_SECONDS; retries with the same key and body
+    get the stored response (marked Idempotent-Replayed), and retries that
+    arrive while the first is still running wait for it. Reusing a key with
+    a different body is rejected with 422. 5xx and 429 responses are not
+    stored, so those can be retried.
+    """
+
+    paths = re.compile(r"^/api/[^/]+/(?:tasks|chat)$")
+
+    def __init__(self, app):
+        self.app = app
+        self.store = _create_store()
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not settings.IDEMPOTENCY_ENABLED
+            or not self.paths.match(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        idempotency_key = headers.get(b"idempotency-key", b"").decode("latin-1").strip()
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        user_id = user_id_from_token(authorization[7:]) if authorization.startswith("Bearer ") else None
+        if not idempotency_key or user_id is None:
+            # Without a key there is nothing to deduplicate; without a user the route rejects the request
+            await self.app(scope, receive, send)
+            return
+        if len(idempotency_key) > 255:
+            await self._send(send, _json_response(400, "Idempotency-Key is too long"))
+            return
+
+        # Buffer the body: it is part of the fingerprint and replayed to the app
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+
+        key = f"{user_id}:{idempotency_key}"
+        fingerprint = hashlib.sha256(scope["path"].encode() + b"\n" + body).hexdigest()
+        outcome, stored = await self.store.begin(key, fingerprint)
+
+        if outcome == MISMATCH:
+            IDEMPOTENCY_REQUESTS.labels("mismatch").inc()
+            await self._send(send, _json_response(422, "Idempotency-Key was already used for a different request"))
+            return
+        if outcome == CONFLICT:
+            IDEMPOTENCY_REQUESTS.labels("conflict").inc()
+            await self._send(send, _json_response(409, "A request with this Idempotency-Key is still in progress"))
+            return
+        if outcome == FULL:
+            IDEMPOTENCY_REQUESTS.labels("full").inc()
+            response = _json_response(503, "Too many requests with an Idempotency-Key are in progress")
+            response.headers.append((b"retry-after", b"1"))
+            await self._send(send, response)
+            return
+        if outcome == REPLAY:
+            IDEMPOTENCY_REQUESTS.labels("replayed").inc()
+            await self._send(send, stored, replayed=True)
+            return
+
+        IDEMPOTENCY_REQUESTS.labels("new").inc()
+        await self._run(scope, body, send, key, fingerprint)
+
+    async def _run(self, scope, body: bytes, send, key: str, fingerprint: str) -> None:
+        body_sent = False
+
+        async def receive_body():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # Nothing more to read; wait like a client that stays connected
+            await asyncio.Event().wait()
+
+        response = StoredResponse(500, [], b"")
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response.status = message["status"]
+                response.headers = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                response.body += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, capture)
+        except BaseException:
+            await self.store.abandon(key, fingerprint)
+            raise
+
+        if response.status >= 500 or response.status == 429:
+            # Let the client retry these for real
+            await self.store.abandon(key, fingerprint)
+        else:
+            await self.store.finish(key, fingerprint, response)
+
+    async def _send(self, send, response: StoredResponse, replayed: bool = False) -> None:
+        headers = list(response.headers)
+        if replayed:
+            headers.append((b"idempotent-replayed", b"true"))
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        await send({"type": "http.response.body", "body": response.body})
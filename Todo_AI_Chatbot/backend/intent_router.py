@@ -0,0 +1,231 @@
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+# Routing decisions recorded on assistant messages
+ROUTE_LLM = "llm"
+ROUTE_CACHE_HIT = "cache_hit"
+ROUTE_CACHE_REFRESHED = "cache_refreshed"
+ROUTE_SIMULATED = "simulated"
+
+
+@dataclass
+class Intent:
+    """
+    A simple command recognised without the model
+    """
+    name: str
+    args: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def route(self) -> str:
+        return f"fast_path:{self.name}"
+
+
+_TASK_WORDS = r"(?:tasks?|todos?|to-dos?|items?)"
+_TASK_REF = r"(?:task\s+)?(?:#(?P<number>\d+)|(?P<uuid>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})|(?P<title>.+?))"
+
+_PATTERNS: List[tuple[str, re.Pattern]] = [
+    ("list_tasks", re.compile(
+        rf"^(?:(?:list|show)(?:\s+me)?(?:\s+(?P<all>all))?(?:\s+my)?|what\s+are\s+my|what\s+(?:are|is)\s+on\s+my)"
+        rf"(?:\s+(?P<filter>open|incomplete|pending|remaining|completed|done|finished|all))?\s+{_TASK_WORDS}"
+        rf"(?:\s+list)?$"
+    )),
+    ("task_stats", re.compile(
+        rf"^how\s+many(?:\s+(?:open|incomplete|pending|remaining|completed|done|finished|overdue))?\s+{_TASK_WORDS}"
+        rf"(?:\s+(?:do\s+i\s+have|have\s+i\s+(?:got|completed|finished|done)|are\s+there|are|is))?"
+        rf"(?:\s+(?:left|remaining|open|overdue|due\s+today|done|completed|finished|to\s+do|in\s+total))?(?:\s+(?:left|today))?$"
+    )),
+    # "add <title>", or "add/create (a) (new) task: <title>"; "create" and "new" only with "task",
+    # since "create a plan ..." or "new york trip ideas" are not commands
+    ("add_task", re.compile(
+        r"^(?:(?:add|create)\s+(?:a\s+)?(?:new\s+)?task|new\s+task|add(?!\s+(?:up|together|them|these|those|it)\b))"
+        r"(?:\s*:\s*|\s+)(?P<title>.+?)(?:\s+to\s+my\s+(?:list|tasks|to-?do\s+list))?$"
+    )),
+    ("complete_task", re.compile(
+        rf"^(?P<verb>complete|finish|check\s+off|mark)\s+{_TASK_REF}"
+        rf"(?:\s+as\s+(?P<state>done|complete|completed|finished))?$"
+    )),
+    ("delete_task", re.compile(
+        rf"^(?:delete|remove)\s+{_TASK_REF}$"
+    )),
+]
+
+_GENERIC_TITLES = {"task", "tasks", "a task", "new task", "a new task", "todo", "a todo"}
+_NEEDS_MODEL = re.compile(
+    r"\b(?:due|by|tomorrow|today|tonight|next|every|remind|and|then|before|after|"
+    r"monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b"
+)
+
+# "delete all tasks", "remove everything": bulk changes are left to the model
+_QUANTIFIERS = re.compile(r"\b(?:all|every|everything|each|any)\b")
+
+_FILTERS = {
+    "open": False, "incomplete": False, "pending": False, "remaining": False,
+    "completed": True, "done": True, "finished": True,
+}
+
+
+def _clean(message: str) -> str:
+    message = message.strip().rstrip(".!?").strip()
+    message = re.sub(r"^(?:please\s+|can\s+you\s+|could\s+you\s+)", "", message, flags=re.IGNORECASE)
+    return re.sub(r"\s+", " ", message)
+
+
+def match_intent(message: str) -> Optional[Intent]:
+    """
+    Map a high-confidence simple command onto a tool call, or return None
+    so the message goes to the model
+    """
+    # Questions ("new york trip ideas?") never run a write command
+    question = message.strip().endswith("?")
+    text = _clean(message)
+    lowered = text.lower()
+
+    for name, pattern in _PATTERNS:
+        match = pattern.match(lowered)
+        if not match:
+            continue
+        groups = match.groupdict()
+
+        if name == "list_tasks":
+            status = groups.get("filter")
+            if status == "all" or (groups.get("all") and not status):
+                return Intent(name, {})
+            # No filter means open tasks, numbered for #n references
+            return Intent(name, {"completed": _FILTERS.get(status, False)})
+
+        if name == "task_stats":
+            # The reply covers every count, so the wording of the question does not matter
+            return Intent(name, {})
+
+        if question:
+            return None
+
+        if name == "add_task":
+            # Take the title from the original text to keep its casing
+            start, end = match.span("title")
+            title = text[start:end].strip().strip("\"'")
+            if not title or len(title) > 255 or title.lower() in _GENERIC_TITLES:
+                return None
+            if _NEEDS_MODEL.search(title.lower()) or _QUANTIFIERS.search(title.lower()):
+                # Dates, recurrence, compound or bulk requests are left to the model
+                return None
+            return Intent(name, {"title": title})
+
+        # complete_task / delete_task; "mark" only with "as done" etc., so "mark my words" is not a command
+        if groups.get("verb") == "mark" and not groups.get("state"):
+            return None
+        if groups.get("number"):
+            return Intent(name, {"number": int(groups["number"])})
+        if groups.get("uuid"):
+            return Intent(name, {"task_id": groups["uuid"]})
+        start, end = match.span("title")
+        title = text[start:end].strip().strip("\"'")
+        if _QUANTIFIERS.search(title.lower()):
+            return None
+        return Intent(name, {"title": title})
+
+    return None
+
+
+def _format_task(task: Dict[str, Any]) -> str:
+    due = f" (due {task['due_date'][:10]})" if task.get("due_date") else ""
+    return f"{task['title']}{due}"
+
+
+def _plural(count: int, word: str) -> str:
+    return f"{count} {word}{'s' if count != 1 else ''}"
+
+
+def _format_stats(stats: Dict[str, Any]) -> str:
+    if not stats["total"]:
+        return "You have no tasks yet."
+    due = [
+        f"{count} {label}" for count, label in ((stats["overdue"], "overdue"), (stats["due_today"], "due today")) if count
+    ]
+    open_part = f"{stats['open']} open" + (f" ({', '.join(due)})" if due else "")
+    return f"You have {_plural(stats['total'], 'task')}: {open_part} and {stats['completed']} completed."
+
+
+async def _open_tasks(tools) -> List[Dict[str, Any]]:
+    """
+    Open tasks in the order used for #n references
+    """
+    tasks = [task for task in await tools.list_tasks(completed=False) if "error" not in task]
+    return sorted(tasks, key=lambda task: (task["created_at"], task["id"]))
+
+
+async def _resolve_task(tools, args: Dict[str, Any]) -> tuple[Optional[str], Optional[str]]:
+    """
+    Turn a #n, id or exact title reference into a task id. Returns
+    (task_id, error message); (None, None) sends the message to the model.
+    """
+    if "task_id" in args:
+        return args["task_id"], None
+
+    open_tasks = await _open_tasks(tools)
+    if "number" in args:
+        number = args["number"]
+        if 1 <= number <= len(open_tasks):
+            return open_tasks[number - 1]["id"], None
+        return None, f"I couldn't find task #{number}. You have {len(open_tasks)} open tasks."
+
+    # Only an exact title completes or deletes without the model; near matches
+    # ("the report thing") are left to it, since a wrong guess changes the wrong task
+    title = args["title"].lower()
+    matches = [task for task in open_tasks if task["title"].lower() == title]
+    if len(matches) == 1:
+        return matches[0]["id"], None
+    return None, None
+
+
+async def execute_intent(tools, intent: Intent) -> Optional[str]:
+    """
+    Run the intent against AsyncMCPTools and render a templated reply.
+    Returns None when the command turns out to need the model after all
+    (for example a title that matches no task, or several).
+    """
+    if intent.name == "list_tasks":
+        completed = intent.args.get("completed")
+        tasks = await _open_tasks(tools) if completed is False else await tools.list_tasks(completed=completed)
+        if tasks and "error" in tasks[0]:
+            return None
+        if not tasks:
+            if completed is None:
+                return "You have no tasks yet."
+            return "You have no completed tasks." if completed else "You have no open tasks. Nice work!"
+        label = {False: "open", True: "completed"}.get(completed, "")
+        header = f"You have {len(tasks)} {label + ' ' if label else ''}task{'s' if len(tasks) != 1 else ''}:"
+        if completed is False:
+            lines = [f"#{index}. {_format_task(task)}" for index, task in enumerate(tasks, start=1)]
+        else:
+            lines = [f"{'[x]' if task['completed'] else '[ ]'} {_format_task(task)}" for task in tasks]
+        return "\n".join([header, *lines])
+
+    if intent.name == "task_stats":
+        stats = await tools.task_stats()
+        return _format_stats(stats) if stats.get("success") else None
+
+    if intent.name == "add_task":
+        result = await tools.add_task(title=intent.args["title"])
+        if not result.get("success"):
+            return None
+        reply = f"Added \"{intent.args['title']}\" to your tasks."
+        duplicates = result.get("possible_duplicates")
+        if duplicates:
+            titles = ", ".join(f"\"{match['title']}\"" for match in duplicates)
+            reply += f" It looks similar to your existing task{'s' if len(duplicates) > 1 else ''} {titles}."
+        return reply
+
+    task_id, error = await _resolve_task(tools, intent.args)
+    if error:
+        return error
+    if task_id is None:
+        return None
+
+    if intent.name == "complete_task":
+        result = await tools.complete_task(task_id=task_id)
+    else:
+        result = await tools.delete_task(task_id=task_id)
+    return result.get("message") if result.get("success") else None
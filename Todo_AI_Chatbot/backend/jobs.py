@@ -0,0 +1,331 @@
+import asyncio
+import inspect
+import logging
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+from sqlalchemy import delete, func, select, update
+from config import settings
+from db import AsyncSession
+from metrics import JOB_QUEUE_DEPTH, JOBS_PROCESSED, JOB_DURATION
+from models import Job
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JobHandler = Callable[[Dict[str, Any]], Optional[Awaitable[None]]]
+HANDLERS: Dict[str, JobHandler] = {}
+
+
+def job_handler(kind: str) -> Callable:
+    """
+    Register the function that runs jobs of `kind`. It receives the job
+    payload and may be sync (run in a thread) or async. Raising retries the job.
+    """
+    def decorator(func: JobHandler) -> JobHandler:
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+class DatabaseJobStore:
+    """
+    Jobs in the jobs table. Workers claim rows with SELECT ... FOR UPDATE
+    SKIP LOCKED, so any number of worker processes can share a queue without
+    handing out a job twice. Jobs whose lock expired (a worker died) are claimed again.
+    """
+
+    async def add(self, jobs: Sequence[Job]) -> None:
+        async with AsyncSession() as session:
+            session.add_all(jobs)
+            await session.commit()
+
+    async def claim(self, queues: Sequence[str], limit: int, lock_timeout: float) -> List[Job]:
+        now = datetime.utcnow()
+        async with AsyncSession() as session:
+            async with session.begin():
+                query = (
+                    select(Job)
+                    .where(Job.queue.in_(queues))
+                    .where(
+                        ((Job.status == QUEUED) & (Job.run_at <= now))
+                        | ((Job.status == RUNNING) & (Job.locked_until < now))
+                    )
+                    .order_by(Job.run_at)
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                )
+                jobs = list((await session.execute(query)).scalars().all())
+                for job in jobs:
+                    job.status = RUNNING
+                    job.attempts += 1
+                    job.locked_until = now + timedelta(seconds=lock_timeout)
+                    job.updated_at = now
+        return jobs
+
+    async def _set(self, job: Job, **values) -> None:
+        values["updated_at"] = datetime.utcnow()
+        async with AsyncSession() as session:
+            await session.execute(update(Job).where(Job.id == job.id).values(**values))
+            await session.commit()
+
+    async def complete(self, job: Job) -> None:
+        await self._set(job, status=DONE, locked_until=None)
+
+    async def retry(self, job: Job, run_at: datetime, error: str) -> None:
+        await self._set(job, status=QUEUED, run_at=run_at, locked_until=None, last_error=error)
+
+    async def fail(self, job: Job, error: str) -> None:
+        await self._set(job, status=FAILED, locked_until=None, last_error=error)
+
+    async def depth(self) -> Dict[str, int]:
+        async with AsyncSession() as session:
+            rows = await session.execute(
+                select(Job.queue, func.count()).where(Job.status == QUEUED).group_by(Job.queue)
+            )
+            return {queue: count for queue, count in rows.all()}
+
+    async def purge(self, older_than: datetime) -> None:
+        """
+        Delete finished jobs; failed ones are kept for inspection
+        """
+        async with AsyncSession() as session:
+            await session.execute(delete(Job).where(Job.status == DONE).where(Job.updated_at < older_than))
+            await session.commit()
+
+
+class InMemoryJobStore:
+    """
+    Process-local stand-in for DatabaseJobStore (tests and single-process setups).
+    Jobs are lost when the process exits.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[uuid.UUID, Job] = {}
+        self._lock = asyncio.Lock()
+
+    async def add(self, jobs: Sequence[Job]) -> None:
+        async with self._lock:
+            for job in jobs:
+                self._jobs[job.id] = job
+
+    async def claim(self, queues: Sequence[str], limit: int, lock_timeout: float) -> List[Job]:
+        now = datetime.utcnow()
+        async with self._lock:
+            runnable = sorted(
+                (
+                    job for job in self._jobs.values()
+                    if job.queue in queues and (
+                        (job.status == QUEUED and job.run_at <= now)
+                        or (job.status == RUNNING and job.locked_until < now)
+                    )
+                ),
+                key=lambda job: job.run_at,
+            )[:limit]
+            for job in runnable:
+                job.status = RUNNING
+                job.attempts += 1
+                job.locked_until = now + timedelta(seconds=lock_timeout)
+                job.updated_at = now
+        return runnable
+
+    async def _set(self, job: Job, **values) -> None:
+        async with self._lock:
+            stored = self._jobs.get(job.id)
+            if stored is not None:
+                for name, value in values.items():
+                    setattr(stored, name, value)
+                stored.updated_at = datetime.utcnow()
+
+    async def complete(self, job: Job) -> None:
+        await self._set(job, status=DONE, locked_until=None)
+
+    async def retry(self, job: Job, run_at: datetime, error: str) -> None:
+        await self._set(job, status=QUEUED, run_at=run_at, locked_until=None, last_error=error)
+
+    async def fail(self, job: Job, error: str) -> None:
+        await self._set(job, status=FAILED, locked_until=None, last_error=error)
+
+    async def depth(self) -> Dict[str, int]:
+        depth: Dict[str, int] = {}
+        for job in list(self._jobs.values()):
+            if job.status == QUEUED:
+                depth[job.queue] = depth.get(job.queue, 0) + 1
+        return depth
+
+    async def purge(self, older_than: datetime) -> None:
+        async with self._lock:
+            for job_id in [job.id for job in self._jobs.values() if job.status == DONE and job.updated_at < older_than]:
+                del self._jobs[job_id]
+
+
+class JobQueue:
+    """
+    Entry point for enqueueing jobs from request handlers and services
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # Set on enqueue so an in-process worker picks the job up without waiting for its next poll
+        self.wakeup = asyncio.Event()
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any] = None, queue: str = "default",
+                      delay: float = 0, max_attempts: int = None) -> uuid.UUID:
+        """
+        Queue one job and return its id
+        """
+        job = self._job(kind, payload, queue, delay, max_attempts)
+        await self.store.add([job])
+        self.wakeup.set()
+        return job.id
+
+    async def enqueue_many(self, kind: str, payloads: Sequence[Dict[str, Any]], queue: str = "default",
+                           delay: float = 0, max_attempts: int = None) -> List[uuid.UUID]:
+        """
+        Queue several jobs of one kind in a single write
+        """
+        jobs = [self._job(kind, payload, queue, delay, max_attempts) for payload in payloads]
+        if jobs:
+            await self.store.add(jobs)
+            self.wakeup.set()
+        return [job.id for job in jobs]
+
+    def _job(self, kind: str, payload: Optional[Dict[str, Any]], queue: str, delay: float,
+             max_attempts: Optional[int]) -> Job:
+        return Job(
+            queue=queue,
+            kind=kind,
+            payload=payload or {},
+            max_attempts=max_attempts or settings.JOB_MAX_ATTEMPTS,
+            run_at=datetime.utcnow() + timedelta(seconds=delay),
+        )
+
+
+def retry_delay(attempts: int) -> float:
+    """
+    Exponential backoff with full jitter for the given attempt number
+    """
+    ceiling = min(settings.JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.JOB_RETRY_MAX_SECONDS)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class Worker:
+    """
+    Runs queued jobs with at most `concurrency` in flight. Failed jobs are
+    retried with backoff until they reach max_attempts and are marked failed.
+    """
+
+    def __init__(self, queue: JobQueue, queues: Sequence[str], concurrency: int, poll_interval: float):
+        self.queue = queue
+        self.queues = list(queues)
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._running: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """
+        Stop claiming jobs and wait for the ones in flight to finish
+        """
+        self._stopping = True
+        self.queue.wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        if self._running:
+            # Unfinished jobs are claimed again once their lock expires
+            await asyncio.wait(self._running, timeout=timeout)
+
+    async def run(self) -> None:
+        store = self.queue.store
+        next_housekeeping = 0.0
+        while not self._stopping:
+            claimed = []
+            try:
+                if time.monotonic() >= next_housekeeping:
+                    await self._housekeeping()
+                    next_housekeeping = time.monotonic() + 30
+                free = self.concurrency - len(self._running)
+                if free > 0:
+                    claimed = await store.claim(self.queues, free, settings.JOB_LOCK_TIMEOUT_SECONDS)
+            except Exception:
+                logger.exception("Claiming jobs failed")
+
+            for job in claimed:
+                task = asyncio.create_task(self._execute(job))
+                self._running.add(task)
+                task.add_done_callback(self._finished)
+
+            if claimed and len(self._running) < self.concurrency:
+                # There may be more runnable jobs
+                continue
+            try:
+                await asyncio.wait_for(self.queue.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.queue.wakeup.clear()
+
+    def _finished(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        # A slot is free again
+        self.queue.wakeup.set()
+
+    async def _housekeeping(self) -> None:
+        for queue, count in (await self.queue.store.depth()).items():
+            JOB_QUEUE_DEPTH.labels(queue).set(count)
+        await self.queue.store.purge(datetime.utcnow() - timedelta(hours=settings.JOB_RETENTION_HOURS))
+
+    async def _execute(self, job: Job) -> None:
+        store = self.queue.store
+        handler = HANDLERS.get(job.kind)
+        if handler is None:
+            logger.error("No handler for job kind %r (job %s)", job.kind, job.id)
+            await store.fail(job, f"No handler for {job.kind}")
+            JOBS_PROCESSED.labels(job.kind, FAILED).inc()
+            return
+
+        started = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(handler):
+                await handler(job.payload)
+            else:
+                await asyncio.to_thread(handler, job.payload)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts >= job.max_attempts:
+                logger.exception("Job %s (%s) failed after %d attempts", job.id, job.kind, job.attempts)
+                await store.fail(job, error)
+                JOBS_PROCESSED.labels(job.kind, FAILED).inc()
+            else:
+                delay = retry_delay(job.attempts)
+                logger.warning("Job %s (%s) failed, retrying in %.1fs: %s", job.id, job.kind, delay, error)
+                await store.retry(job, datetime.utcnow() + timedelta(seconds=delay), error)
+                JOBS_PROCESSED.labels(job.kind, "retry").inc()
+            return
+        finally:
+            JOB_DURATION.labels(job.kind).observe(time.perf_counter() - started)
+
+        await store.complete(job)
+        JOBS_PROCESSED.labels(job.kind, DONE).inc()
+
+
+def _create_store():
+    if settings.JOB_QUEUE_BACKEND == "memory":
+        return InMemoryJobStore()
+    return DatabaseJobStore()
+
+
+job_queue = JobQueue(_create_store())
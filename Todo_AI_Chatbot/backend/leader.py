@@ -0,0 +1,151 @@
+"""
+Leader election for background loops that must run in one process only.
+
+Every API process runs a LeaderElection per loop, and the elected one runs
+it. On Postgres the leader holds a session-level advisory lock on the main
+database, over a connection of its own outside the pools (so each leader
+uses one connection beyond DB_CONNECTION_BUDGET). On other databases (SQLite
+in development) it holds an exclusive lock on a file in the temp directory,
+which covers every process on the host. The other processes retry every
+`interval` seconds and take over when the leader exits or loses its
+database connection.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Awaitable, Callable, Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+from sqlalchemy.pool import NullPool
+from db import encoded_database_url
+
+try:
+    import fcntl
+except ImportError:  # No file locks (Windows): every process is elected
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_lock_engine = create_async_engine(encoded_database_url, poolclass=NullPool)
+
+
+def _digest(value: str) -> bytes:
+    return hashlib.sha256(value.encode()).digest()
+
+
+class LeaderElection:
+    """
+    Runs `on_elected()` when this process becomes leader for `name` and
+    `on_deposed()` when it stops being leader
+    """
+
+    def __init__(self, name: str, on_elected: Callable[[], Awaitable[None]],
+                 on_deposed: Callable[[], Awaitable[None]], interval: float):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.interval = interval
+        self.key = int.from_bytes(_digest(name)[:8], "big", signed=True)
+        self.is_leader = False
+        self._conn: Optional[AsyncConnection] = None
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            await self.on_deposed()
+        await self._release()
+
+    async def _acquire(self) -> bool:
+        if _lock_engine.dialect.name == "postgresql":
+            conn = await _lock_engine.connect()
+            try:
+                acquired = (await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key})).scalar()
+                await conn.commit()
+            except BaseException:
+                await conn.close()
+                raise
+            if not acquired:
+                await conn.close()
+                return False
+            self._conn = conn
+            return True
+
+        if fcntl is None:
+            return True
+        path = os.path.join(
+            tempfile.gettempdir(), f"todo-{self.name}-{_digest(encoded_database_url).hex()[:16]}.lock"
+        )
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    async def _still_held(self) -> bool:
+        # The advisory lock lives exactly as long as its connection
+        if self._conn is None:
+            return True
+        try:
+            await self._conn.execute(text("SELECT 1"))
+            await self._conn.commit()
+            return True
+        except Exception:
+            return False
+
+    async def _release(self) -> None:
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+                await conn.commit()
+            except Exception:
+                pass
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if not self.is_leader:
+                    if await self._acquire():
+                        try:
+                            await self.on_elected()
+                        except BaseException:
+                            await self._release()
+                            raise
+                        self.is_leader = True
+                        logger.info("This process now runs %s", self.name)
+                elif not await self._still_held():
+                    logger.warning("Lost the %s lock; stopping it in this process", self.name)
+                    self.is_leader = False
+                    try:
+                        await self.on_deposed()
+                    finally:
+                        await self._release()
+            except Exception:
+                logger.exception("Leader election for %s failed", self.name)
+            await asyncio.sleep(self.interval)
+
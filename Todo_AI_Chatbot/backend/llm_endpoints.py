@@ -0,0 +1,330 @@
+"""
+Chat completions across a chain of LLM endpoints.
+
+LLM_ENDPOINTS lists OpenAI-compatible endpoints in order of preference. Each
+completion has an overall deadline (LLM_DEADLINE_SECONDS) and a timeout per
+attempt (LLM_TIMEOUT_SECONDS):
+
+- It goes to the first endpoint whose circuit breaker lets traffic through.
+  If that endpoint has not answered by its recent p95 latency, a hedged
+  duplicate goes to the next endpoint (or the same one when it is the only
+  one) and the first answer wins.
+- On a retryable error (timeout, connection error, 408/409/429, 5xx) or an
+  endpoint-specific one (401/403/404) the next endpoint is tried at once.
+  When every endpoint failed, the chain is retried after a jittered backoff
+  while the deadline allows.
+- An endpoint that fails LLM_BREAKER_FAILURES times in a row is skipped for
+  LLM_BREAKER_RESET_SECONDS, then receives a single probe request.
+
+Point an endpoint at `python fake_llm.py` to try all of this locally.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import List, Optional, Set, Tuple
+import openai
+from openai import AsyncOpenAI
+from config import settings
+from metrics import observe_completion, LLM_CIRCUIT_OPEN, LLM_FAILOVERS, LLM_HEDGES
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class LLMUnavailable(Exception):
+    """
+    Raised when no endpoint produced a completion before the deadline
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__("The AI service is temporarily unavailable, please retry shortly")
+        self.retry_after = retry_after
+
+
+def parse_endpoints(value: str, default_model: str) -> List[Tuple[str, str, Optional[str]]]:
+    """
+    Parse LLM_ENDPOINTS ("primary=gpt-4o-mini,local=fake@http://localhost:9001/v1")
+    into (name, model, base_url) tuples
+    """
+    endpoints = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, separator, target = item.strip().partition("=")
+        if not separator or not name or not target:
+            raise ValueError(f"Invalid LLM endpoint {item!r}, expected name=model@base_url")
+        model, _, base_url = target.partition("@")
+        endpoints.append((name.strip(), model.strip() or default_model, base_url.strip() or None))
+    return endpoints
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def is_endpoint_fault(error: BaseException) -> bool:
+    """
+    Errors another endpoint may not have: worth failing over for
+    """
+    if is_retryable(error):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in (401, 403, 404)
+
+
+def retry_delay(round_number: int) -> float:
+    """
+    Exponential backoff with jitter before retrying the chain
+    """
+    ceiling = min(settings.LLM_RETRY_BASE_SECONDS * 2 ** (round_number - 1), settings.LLM_RETRY_MAX_SECONDS)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. While open no traffic is sent; after
+    `reset_seconds` one probe is let through and its outcome closes or
+    re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent now. In the half-open state this claims the probe.
+        """
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = HALF_OPEN
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(self.reset_seconds - (time.monotonic() - self.opened_at), 0.0)
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info("LLM endpoint %s recovered", self.name)
+            LLM_CIRCUIT_OPEN.labels(self.name).set(0)
+        self.state = CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            logger.warning("LLM endpoint %s failed %d times; circuit open", self.name, self.failures)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            LLM_CIRCUIT_OPEN.labels(self.name).set(1)
+
+    def release(self) -> None:
+        """
+        The request let through ended without telling us anything (cancelled, or a client error)
+        """
+        self._probing = False
+
+
+class LatencyWindow:
+    """
+    Latencies of an endpoint's recent successful completions
+    """
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if len(self._samples) < settings.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+class Endpoint:
+    def __init__(self, name: str, model: str, base_url: Optional[str] = None):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.breaker = CircuitBreaker(name, settings.LLM_BREAKER_FAILURES, settings.LLM_BREAKER_RESET_SECONDS)
+        self.latency = LatencyWindow()
+        self._client = None
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            # Retries and timeouts are handled by the chain, not by the SDK
+            self._client = AsyncOpenAI(
+                api_key=settings.OPENAI_API_KEY or "not-needed",
+                base_url=self.base_url,
+                max_retries=0,
+            )
+        return self._client
+
+
+class LLMChain:
+    def __init__(self, endpoints: List[Endpoint]):
+        self.endpoints = endpoints
+
+    def _next(self, tried: Set[str]) -> Optional[Endpoint]:
+        for endpoint in self.endpoints:
+            if endpoint.name not in tried and endpoint.breaker.allow():
+                return endpoint
+        return None
+
+    def warm_up(self) -> None:
+        """
+        Create the endpoint clients ahead of the first completion
+        """
+        for endpoint in self.endpoints:
+            endpoint.client
+
+    def retry_after(self) -> float:
+        waits = [endpoint.breaker.retry_after() for endpoint in self.endpoints]
+        return max(min(waits, default=0.0), 1.0)
+
+    async def complete(self, **kwargs):
+        """
+        `chat.completions.create(**kwargs)` on the chain. Raises LLMUnavailable
+        when every endpoint failed or the deadline passed, and re-raises errors
+        that are the request's fault (such as 400).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.LLM_DEADLINE_SECONDS
+        last_error: Optional[BaseException] = None
+
+        for round_number in range(settings.LLM_MAX_RETRIES + 1):
+            if round_number:
+                delay = retry_delay(round_number)
+                if loop.time() + delay >= deadline or not is_retryable(last_error):
+                    break
+                await asyncio.sleep(delay)
+
+            tried: Set[str] = set()
+            while loop.time() < deadline:
+                endpoint = self._next(tried)
+                if endpoint is None:
+                    break
+                tried.add(endpoint.name)
+                try:
+                    return await self._hedged(endpoint, tried, kwargs, deadline)
+                except Exception as e:
+                    if not is_endpoint_fault(e):
+                        raise
+                    last_error = e
+                    LLM_FAILOVERS.labels(endpoint.name, type(e).__name__).inc()
+                    logger.warning("LLM endpoint %s failed (%s: %s)", endpoint.name, type(e).__name__, e)
+            if last_error is None:
+                # Every circuit is open; waiting would not help this request
+                break
+
+        raise LLMUnavailable(self.retry_after()) from last_error
+
+    async def _hedged(self, primary: Endpoint, tried: Set[str], kwargs: dict, deadline: float):
+        """
+        Call `primary`, racing a duplicate against it once it runs past its p95
+        """
+        loop = asyncio.get_running_loop()
+
+        def start(endpoint: Endpoint) -> asyncio.Future:
+            timeout = max(min(settings.LLM_TIMEOUT_SECONDS, deadline - loop.time()), 0.001)
+            return asyncio.ensure_future(self._attempt(endpoint, kwargs, timeout))
+
+        pending = {start(primary)}
+        hedge: Optional[asyncio.Future] = None
+        hedge_delay = primary.latency.percentile(settings.LLM_HEDGE_PERCENTILE) if settings.LLM_HEDGE_ENABLED else None
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = hedge_delay if hedge is None and hedge_delay is not None else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    backup = self._next(tried) or (primary if primary.breaker.state == CLOSED else None)
+                    hedge_delay = None
+                    if backup is not None:
+                        tried.add(backup.name)
+                        hedge = start(backup)
+                        pending.add(hedge)
+                        LLM_HEDGES.labels("sent").inc()
+                    continue
+                outcomes = [(future, future.exception()) for future in done]
+                for future, exception in outcomes:
+                    if exception is None:
+                        if future is hedge:
+                            LLM_HEDGES.labels("won").inc()
+                        return future.result()
+                for _, exception in outcomes:
+                    if not is_endpoint_fault(exception):
+                        raise exception
+                    error = exception
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _attempt(self, endpoint: Endpoint, kwargs: dict, timeout: float):
+        started = time.perf_counter()
+        with span("llm.chat_completion", kind="client", model=endpoint.model, endpoint=endpoint.name) as completion_span:
+            # Continue the trace at the endpoint (an LLM gateway or our own proxy can record it)
+            headers = {**(kwargs.get("extra_headers") or {}), "traceparent": completion_span.traceparent}
+            try:
+                response = await asyncio.wait_for(
+                    endpoint.client.chat.completions.create(
+                        model=endpoint.model, **{**kwargs, "extra_headers": headers}
+                    ),
+                    timeout,
+                )
+            except asyncio.CancelledError:
+                endpoint.breaker.release()
+                raise
+            except Exception as e:
+                observe_completion(endpoint.model, started, error=e)
+                if is_endpoint_fault(e):
+                    endpoint.breaker.record_failure()
+                else:
+                    endpoint.breaker.release()
+                raise
+            endpoint.breaker.record_success()
+            endpoint.latency.add(time.perf_counter() - started)
+            observe_completion(endpoint.model, started, response=response)
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                completion_span.set_attribute("llm.prompt_tokens", usage.prompt_tokens)
+                completion_span.set_attribute("llm.completion_tokens", usage.completion_tokens)
+            return response
+
+
+def _configured_endpoints() -> List[Endpoint]:
+    if settings.LLM_ENDPOINTS:
+        return [Endpoint(*entry) for entry in parse_endpoints(settings.LLM_ENDPOINTS, settings.LLM_MODEL)]
+    if settings.OPENAI_API_KEY:
+        return [Endpoint("openai", settings.LLM_MODEL)]
+    return []
+
+
+llm_chain = LLMChain(_configured_endpoints())
@@ -1,22 +1,74 @@
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, Response
 from fastapi.middleware.cors import CORSMiddleware
 from config import settings
-from db import create_db_and_tables
-from routes import tasks, chat
+from db import create_db_and_tables, sync_engine, async_engine, read_router, shard_map, warm_pools, dispose_engines
+from metrics import MetricsMiddleware, instrument_engine, render_metrics
+from query_profiler import QueryProfilerMiddleware, install_query_profiler
+from rate_limit import RateLimitMiddleware
+from idempotency import IdempotencyMiddleware
+from compression import CompressionMiddleware
+from tracing import TracingMiddleware, install_sql_tracing, exporter as span_exporter
+from message_writer import message_writer
+from usage_ledger import usage_ledger
+from llm_endpoints import llm_chain
+from profiler import loop_lag_monitor
+from message_store import ensure_message_partitions, maintenance_election
+from reminders import reminder_election
+from jobs import Worker, job_queue
+from routes import tasks, chat, conversations
 from routes.auth import router as auth_router
+from routes.admin import router as admin_router
 from auth import validate_user_from_jwt
+import asyncio
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Runs jobs inside the API process when no separate worker.py is deployed
+job_worker = Worker(
+    job_queue,
+    queues=["default", "reminders"],
+    concurrency=settings.JOB_WORKER_CONCURRENCY,
+    poll_interval=settings.JOB_POLL_INTERVAL_SECONDS,
+)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Reported by /ready; traffic should only be sent while this is "ready"
+    app.state.status = "starting"
+    if settings.LOOP_LAG_MONITOR_ENABLED:
+        await loop_lag_monitor.start()
     # Create tables on startup
     await create_db_and_tables()
+    await asyncio.to_thread(ensure_message_partitions)
+    await message_writer.start()
+    await usage_ledger.start()
+    await maintenance_election.start()
+    await read_router.start()
+    if settings.REMINDERS_ENABLED:
+        await reminder_election.start()
+    if settings.JOB_WORKER_IN_PROCESS or settings.JOB_QUEUE_BACKEND == "memory":
+        await job_worker.start()
+    # Open pooled connections and LLM clients before the first request arrives
+    if settings.DB_POOL_WARMUP:
+        await warm_pools()
+    llm_chain.warm_up()
+    app.state.status = "ready"
     yield
-    # Cleanup on shutdown if needed
+    # The server has stopped accepting connections and let in-flight requests
+    # finish (SHUTDOWN_DRAIN_SECONDS under serve.py); flush what they queued
+    app.state.status = "stopping"
+    await reminder_election.stop()
+    await read_router.stop()
+    await job_worker.stop()
+    await maintenance_election.stop()
+    await usage_ledger.stop()
+    await message_writer.stop()
+    await asyncio.to_thread(span_exporter.flush)
+    await dispose_engines()
+    await loop_lag_monitor.stop()
 
 
 app = FastAPI(
@@ -26,6 +78,31 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Instrument both engines before any connection is checked out
+instrument_engine(sync_engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+install_query_profiler(sync_engine)
+install_query_profiler(async_engine.sync_engine)
+install_sql_tracing(sync_engine, "sync")
+install_sql_tracing(async_engine.sync_engine, "async")
+_extra_engines = [database for database in [*read_router.replicas, *shard_map.all()]
+                  if database.sync_engine is not sync_engine]
+for database in _extra_engines:
+    instrument_engine(database.sync_engine, f"{database.name}_sync")
+    instrument_engine(database.async_engine.sync_engine, f"{database.name}_async")
+    install_query_profiler(database.sync_engine)
+    install_query_profiler(database.async_engine.sync_engine)
+    install_sql_tracing(database.sync_engine, f"{database.name}_sync")
+    install_sql_tracing(database.async_engine.sync_engine, f"{database.name}_async")
+
+# Per-user token bucket; rejected requests never reach the database.
+# Added before CORS so 429 responses still carry CORS headers.
+app.add_middleware(RateLimitMiddleware)
+
+# Retries carrying an Idempotency-Key are answered from the stored response
+# (outside the rate limiter, so replays do not use up the client's quota)
+app.add_middleware(IdempotencyMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -35,10 +112,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/br/zstd responses, ETags and 304s; wraps CORS so its headers are kept
+app.add_middleware(CompressionMiddleware)
+
+# Per-request statement log: slow queries, N+1 patterns and query budgets
+app.add_middleware(QueryProfilerMiddleware)
+
+# Server span per request, continuing any incoming traceparent
+app.add_middleware(TracingMiddleware)
+
+# Request latency per route (outermost, so it includes the other middleware)
+app.add_middleware(MetricsMiddleware)
+
 # Include routers
 app.include_router(auth_router)  # Auth routes at /api/auth (prefix defined in router)
+app.include_router(admin_router)  # Admin routes at /api/admin, behind ADMIN_TOKEN
 app.include_router(tasks.router, prefix="/api/{user_id}", tags=["tasks"])
 app.include_router(chat.router, prefix="/api/{user_id}", tags=["chat"])
+app.include_router(conversations.router, prefix="/api/{user_id}", tags=["conversations"])
 
 @app.get("/")
 def read_root():
@@ -46,4 +137,17 @@ def read_root():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy"}
\ No newline at end of file
+    return {"status": "healthy"}
+
+@app.get("/ready")
+def readiness_check(response: Response):
+    # Unlike /health, this fails while the worker is starting up or shutting down
+    state = getattr(app.state, "status", "starting")
+    if state != "ready":
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": state}
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
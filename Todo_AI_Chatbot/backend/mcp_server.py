@@ -0,0 +1,334 @@
+"""
+Standalone MCP server exposing the task tools to external agents.
+
+    python mcp_server.py stdio --token <jwt>      # newline-delimited JSON-RPC on stdin/stdout
+    python mcp_server.py http --port 8001         # streamable HTTP: POST /mcp
+
+Every call is authenticated as one user (the JWT from --token / MCP_AUTH_TOKEN
+for stdio, the bearer token of each request over HTTP) and runs on
+AsyncMCPTools. The async connection pool is warmed on startup and reused
+across calls, and the tool list is built once. A JSON-RPC batch runs on a
+single unit of work and is committed once; over stdio, requests are
+pipelined and answered as they complete.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Union
+from fastapi import FastAPI, Request, Response
+from sqlalchemy import select, text
+from auth import user_id_from_token
+from config import settings
+from db import shard_map
+from sharding import MOVING, UserMoving
+from mcp_tools import AsyncMCPTools, TOOL_REGISTRY, UnitOfWorkRolledBack
+from metrics import TOOL_LATENCY, instrument_engine
+from models import User
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = "2025-03-26"
+SERVER_INFO = {"name": "todo-tasks", "version": "1.0.0"}
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+UNAUTHORIZED = -32001
+USER_MOVING = -32002
+ROLLED_BACK = -32003
+
+# Built once; tools/list is answered from this
+TOOLS = [
+    {"name": name, "description": spec["description"], "inputSchema": spec["parameters"]}
+    for name, spec in TOOL_REGISTRY.items()
+]
+
+Message = Dict[str, Any]
+
+
+class MCPError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _error(request_id: Any, code: int, message: str) -> Message:
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+
+def _result(request_id: Any, result: Any) -> Message:
+    return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+
+# Users already confirmed to exist, so a hot client does not hit the users table per call
+_known_users: set = set()
+
+
+async def authenticate(token: Optional[str]) -> uuid.UUID:
+    """
+    Resolve a bearer token to an existing user id
+    """
+    if not token:
+        raise MCPError(UNAUTHORIZED, "Missing bearer token")
+    user_id = user_id_from_token(token)
+    if user_id is None:
+        raise MCPError(UNAUTHORIZED, "Invalid bearer token")
+
+    if user_id not in _known_users:
+        async with (await shard_map.ashard_for_user(user_id)).AsyncSession() as session:
+            exists = (await session.execute(select(User.id).where(User.id == user_id))).first()
+        if not exists:
+            raise MCPError(UNAUTHORIZED, "User not found")
+        _known_users.add(user_id)
+    return user_id
+
+
+async def warm_pool(connections: int = settings.MCP_WARM_CONNECTIONS) -> None:
+    """
+    Open pooled connections up front so the first calls do not pay for connecting
+    """
+
+    async def _ping(engine):
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(
+        _ping(shard.async_engine) for shard in shard_map.all() for _ in range(max(connections, 1))
+    ))
+
+
+async def _call_tool(tools: AsyncMCPTools, params: Dict[str, Any]) -> Dict[str, Any]:
+    name = params.get("name")
+    arguments = params.get("arguments") or {}
+    if name not in TOOL_REGISTRY:
+        raise MCPError(INVALID_PARAMS, f"Unknown tool: {name}")
+    if not isinstance(arguments, dict):
+        raise MCPError(INVALID_PARAMS, "Tool arguments must be an object")
+
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        with span("mcp_server.tools_call", tool=name):
+            result = await getattr(tools, name)(**arguments)
+        failed = isinstance(result, dict) and result.get("success") is False
+        outcome = "failed" if failed else "ok"
+    except TypeError as e:
+        # Unexpected or missing arguments
+        raise MCPError(INVALID_PARAMS, str(e))
+    finally:
+        TOOL_LATENCY.labels(name, outcome).observe(time.perf_counter() - started)
+
+    return {"content": [{"type": "text", "text": json.dumps(result)}], "isError": failed}
+
+
+async def _dispatch(tools: AsyncMCPTools, message: Any) -> Optional[Message]:
+    """
+    Handle one JSON-RPC message. Returns None for notifications.
+    """
+    if not isinstance(message, dict) or message.get("jsonrpc") != "2.0" or "method" not in message:
+        return _error(message.get("id") if isinstance(message, dict) else None, INVALID_REQUEST, "Invalid request")
+
+    request_id = message.get("id")
+    method = message["method"]
+    params = message.get("params") or {}
+
+    try:
+        if method == "initialize":
+            result = {
+                "protocolVersion": PROTOCOL_VERSION,
+                "capabilities": {"tools": {"listChanged": False}},
+                "serverInfo": SERVER_INFO,
+            }
+        elif method == "ping":
+            result = {}
+        elif method == "tools/list":
+            result = {"tools": TOOLS}
+        elif method == "tools/call":
+            result = await _call_tool(tools, params)
+        elif method.startswith("notifications/"):
+            return None
+        else:
+            raise MCPError(METHOD_NOT_FOUND, f"Method not found: {method}")
+    except MCPError as e:
+        return None if request_id is None else _error(request_id, e.code, e.message)
+
+    return None if request_id is None else _result(request_id, result)
+
+
+async def handle(user_id: uuid.UUID, payload: Union[Message, List[Message]]) -> Optional[Union[Message, List[Message]]]:
+    """
+    Handle a single message or a batch. A batch shares one unit of work, so
+    all of its writes are committed together.
+    """
+    shard_name, status = await shard_map.alookup(user_id)
+    if status == MOVING:
+        return _error(payload.get("id") if isinstance(payload, dict) else None, USER_MOVING,
+                      "User data is being moved between shards, retry shortly")
+    shard = shard_map.shards[shard_name]
+    if isinstance(payload, list):
+        if not payload:
+            return _error(None, INVALID_REQUEST, "Empty batch")
+        if len(payload) > settings.MCP_MAX_BATCH_SIZE:
+            return _error(None, INVALID_REQUEST, f"Batch larger than {settings.MCP_MAX_BATCH_SIZE}")
+        try:
+            async with shard.AsyncSession() as session:
+                async with AsyncMCPTools(user_id=user_id, db_session=session) as tools:
+                    # Sequential: the calls share one session
+                    responses = [await _dispatch(tools, message) for message in payload]
+        except (UnitOfWorkRolledBack, UserMoving) as e:
+            # Every call's results are void, not just the one that failed
+            code = USER_MOVING if isinstance(e, UserMoving) else ROLLED_BACK
+            responses = [
+                _error(response["id"], code, str(e)) if response is not None else None
+                for response in responses
+            ]
+        responses = [response for response in responses if response is not None]
+        return responses or None
+
+    try:
+        async with shard.AsyncSession() as session:
+            async with AsyncMCPTools(user_id=user_id, db_session=session) as tools:
+                response = await _dispatch(tools, payload)
+    except (UnitOfWorkRolledBack, UserMoving) as e:
+        code = USER_MOVING if isinstance(e, UserMoving) else ROLLED_BACK
+        return None if response is None else _error(response["id"], code, str(e))
+    return response
+
+
+async def serve_stdio(token: Optional[str]) -> None:
+    """
+    Newline-delimited JSON-RPC over stdin/stdout. Requests are handled
+    concurrently (up to MCP_MAX_IN_FLIGHT) and each response is written as
+    soon as it is ready, so a client can pipeline calls.
+    """
+    await warm_pool()
+    user_id = await authenticate(token)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2 ** 22)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    write_lock = asyncio.Lock()
+    in_flight = asyncio.Semaphore(settings.MCP_MAX_IN_FLIGHT)
+    pending: set = set()
+
+    async def respond(response):
+        if response is None:
+            return
+        async with write_lock:
+            sys.stdout.write(json.dumps(response) + "\n")
+            sys.stdout.flush()
+
+    async def run(payload):
+        try:
+            await respond(await handle(user_id, payload))
+        except Exception:
+            logger.exception("MCP request failed")
+            request_id = payload.get("id") if isinstance(payload, dict) else None
+            await respond(_error(request_id, -32603, "Internal error"))
+        finally:
+            in_flight.release()
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+        except json.JSONDecodeError:
+            await respond(_error(None, PARSE_ERROR, "Parse error"))
+            continue
+        await in_flight.acquire()
+        task = asyncio.create_task(run(payload))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await asyncio.gather(*pending)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await warm_pool()
+    yield
+    for shard in shard_map.all():
+        await shard.async_engine.dispose()
+
+
+mcp_app = FastAPI(title="Todo Tasks MCP Server", lifespan=lifespan)
+
+
+@mcp_app.post("/mcp")
+async def mcp_endpoint(request: Request):
+    """
+    Streamable HTTP transport (stateless): each POST carries one message or a
+    batch and gets the JSON response back directly
+    """
+    authorization = request.headers.get("authorization", "")
+    token = authorization[7:] if authorization.startswith("Bearer ") else None
+    try:
+        user_id = await authenticate(token)
+    except MCPError as e:
+        return Response(
+            content=json.dumps(_error(None, e.code, e.message)),
+            status_code=401,
+            media_type="application/json",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    try:
+        payload = json.loads(await request.body())
+    except json.JSONDecodeError:
+        return Response(content=json.dumps(_error(None, PARSE_ERROR, "Parse error")),
+                        status_code=400, media_type="application/json")
+
+    response = await handle(user_id, payload)
+    if response is None:
+        # Only notifications were sent
+        return Response(status_code=202)
+    return Response(content=json.dumps(response), media_type="application/json")
+
+
+@mcp_app.get("/mcp")
+async def mcp_stream():
+    # No server-initiated messages, so no SSE stream is offered
+    return Response(status_code=405, headers={"Allow": "POST"})
+
+
+@mcp_app.get("/health")
+def health_check():
+    return {"status": "healthy"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the task tools over MCP")
+    parser.add_argument("transport", choices=["stdio", "http"])
+    parser.add_argument("--token", default=settings.MCP_AUTH_TOKEN, help="JWT of the user (stdio)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=settings.MCP_HTTP_PORT)
+    args = parser.parse_args()
+
+    # Logs go to stderr; stdout carries protocol messages in stdio mode
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    for shard in shard_map.all():
+        instrument_engine(shard.async_engine.sync_engine, f"{shard.name}_async")
+
+    if args.transport == "stdio":
+        asyncio.run(serve_stdio(args.token))
+    else:
+        import uvicorn
+        uvicorn.run(mcp_app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,240 +1,416 @@
-from typing import Dict, Any, List
-from sqlmodel import Session, select
-from models import Task, User
+from typing import Dict, Any, List, Callable, Optional, Tuple
+from sqlmodel import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Task, TaskCounters, User
 import uuid
 from datetime import datetime
+from tracing import traced
+from config import settings
+from task_index import task_index
+from db import shard_map
+from sharding import MOVING, UserMoving
+import logging
+import task_counters
+import task_events
 
+logger = logging.getLogger(__name__)
 
-class MCPTools:
+
+# Declarative tool registry: name -> {"description", "parameters", "read_only"}
+TOOL_REGISTRY: Dict[str, Dict[str, Any]] = {}
+
+
+def tool(name: str, description: str, parameters: Dict[str, Any] = None,
+         required: List[str] = None, read_only: bool = False) -> Callable:
     """
-    MCP (Model Context Protocol) Tools for task management
-    Implements the required tools for the AI chatbot to interact with tasks
+    Register a tool method together with the JSON schema the model sees
+    """
+    def decorator(func: Callable) -> Callable:
+        TOOL_REGISTRY[name] = {
+            "description": description,
+            "parameters": {
+                "type": "object",
+                "properties": parameters or {},
+                **({"required": required} if required else {}),
+            },
+            "read_only": read_only,
+        }
+        return func
+    return decorator
+
+
+def tool_schemas() -> List[Dict[str, Any]]:
     """
-    
-    def __init__(self, user_id: uuid.UUID, db_session: Session):
+    Tool definitions in the OpenAI function-calling format
+    """
+    return [
+        {
+            "type": "function",
+            "function": {"name": name, "description": spec["description"], "parameters": spec["parameters"]},
+        }
+        for name, spec in TOOL_REGISTRY.items()
+    ]
+
+
+def read_only_tools() -> set:
+    return {name for name, spec in TOOL_REGISTRY.items() if spec["read_only"]}
+
+
+class UnitOfWorkRolledBack(Exception):
+    """
+    Raised when a unit of work is rolled back after a tool hit a database error,
+    discarding writes that earlier tool calls already reported as done
+    """
+
+    def __init__(self):
+        super().__init__("Your changes could not be saved because of a database error, please try again")
+
+
+class AsyncMCPTools:
+    """
+    Async MCP tools bound to one chat turn.
+
+    All writes made by the tools share the AsyncSession's transaction and are
+    committed once when the unit of work ends (rolled back if the turn raised
+    or a tool hit a database error). A rollback that discards writes raises
+    UnitOfWorkRolledBack, since a reply may already have announced them.
+    Task lookups are served from the session's identity map and list results
+    are cached until the next write.
+
+        async with AsyncMCPTools(user_id, session) as tools:
+            await agent.process_message(message)
+    """
+
+    def __init__(self, user_id: uuid.UUID, db_session: AsyncSession, read_session: Optional[AsyncSession] = None):
         self.user_id = user_id
         self.db_session = db_session
-    
-    def add_task(self, title: str, description: str = None, due_date: str = None) -> Dict[str, Any]:
+        # Optional replica session for list_tasks while this unit of work has not written
+        self.read_session = read_session
+        self._list_cache: Dict[Optional[bool], List[Task]] = {}
+        self._events: List[tuple] = []
+        self._counts = task_counters.Delta()
+        self._failed = False
+
+    async def __aenter__(self) -> "AsyncMCPTools":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None and not self._failed:
+            await self.commit()
+            return
+        discarded = bool(self._events)
+        await self.rollback()
+        if exc_type is None and discarded:
+            raise UnitOfWorkRolledBack()
+
+    async def commit(self) -> None:
         """
-        Add a new task for the user
-        
-        Args:
-            title: Title of the task
-            description: Optional description of the task
-            due_date: Optional due date in ISO format (YYYY-MM-DDTHH:MM:SS.sssZ)
-        
-        Returns:
-            Dictionary with task information
+        Commit every write made in this unit of work, then notify task listeners.
+        Raises UserMoving (after rolling back) if rebalance.py started moving the
+        user during the turn, since its copy of the user's rows would miss these writes.
         """
+        if not self._events:
+            return
+        if shard_map.enabled:
+            shard_name, status = await shard_map.alookup(self.user_id)
+            if status == MOVING or shard_map.shards[shard_name].async_engine is not self.db_session.bind:
+                await self.rollback()
+                raise UserMoving()
+        await task_counters.arecord(self.db_session, self.user_id, self._counts)
+        await self.db_session.commit()
+        self._counts = task_counters.Delta()
+        events, self._events = self._events, []
+        for kind, task in events:
+            task_events.task_changed(kind, self.user_id, task)
+
+    async def rollback(self) -> None:
+        await self.db_session.rollback()
+        self._events = []
+        self._counts = task_counters.Delta()
+        self._list_cache = {}
+
+    def _written(self, kind: str, task: Task, before: task_counters.Contribution) -> None:
+        self._events.append((kind, task))
+        self._counts.add(before, None if kind == task_events.DELETED else task_counters.snapshot(task))
+        self._list_cache = {}
+
+    async def _get_task(self, task_id: str) -> Optional[Task]:
+        # session.get answers from the identity map when the task is already loaded
+        task = await self.db_session.get(Task, uuid.UUID(task_id))
+        if task is None or task.user_id != self.user_id:
+            return None
+        return task
+
+    def _reader(self):
+        # The replica session can serve reads until this unit of work has written
+        return self.read_session if self.read_session is not None and not self._events else self.db_session
+
+    async def _search(self, text: str, limit: int, min_score: float,
+                      include_completed: bool = False) -> List[Tuple[Task, float]]:
+        """
+        The user's tasks most similar to `text`, best first, including the
+        uncommitted writes of this unit of work
+        """
+        pending = {task.id: (kind, task) for kind, task in self._events}
+        session = self._reader()
+        matches = [
+            (task_id, score)
+            for task_id, score in await task_index.search(
+                self.user_id, session, text, limit + len(pending), min_score, include_completed
+            )
+            if task_id not in pending
+        ]
+        loaded = {}
+        if matches:
+            query = select(Task).where(Task.id.in_([task_id for task_id, _ in matches]), Task.user_id == self.user_id)
+            loaded = {task.id: task for task in (await session.execute(query)).scalars()}
+        # The index may lag behind other processes' writes; the rows are authoritative
+        found = [
+            (loaded[task_id], score) for task_id, score in matches
+            if task_id in loaded and (include_completed or not loaded[task_id].completed)
+        ]
+        live = [
+            task for kind, task in pending.values()
+            if kind != task_events.DELETED and (include_completed or not task.completed)
+        ]
+        found += [(task, score) for task, score in task_index.score(text, live) if score >= min_score]
+        found.sort(key=lambda item: item[1], reverse=True)
+        return found[:limit]
+
+    def _error(self, message: str) -> Dict[str, Any]:
+        self._failed = True
+        return {"success": False, "message": message}
+
+    @tool(
+        "add_task",
+        "Add a new task for the user",
+        {
+            "title": {"type": "string", "description": "Title of the task"},
+            "description": {"type": "string", "description": "Description of the task"},
+            "due_date": {"type": "string", "description": "Due date in ISO format (YYYY-MM-DDTHH:MM:SS.sssZ)"},
+        },
+        required=["title"],
+    )
+    @traced("mcp.add_task")
+    async def add_task(self, title: str, description: str = None, due_date: str = None) -> Dict[str, Any]:
         try:
-            # Parse due date if provided
             parsed_due_date = None
             if due_date:
                 parsed_due_date = datetime.fromisoformat(due_date.replace('Z', '+00:00'))
-            
-            # Create new task
-            task = Task(
-                title=title,
-                description=description,
-                due_date=parsed_due_date,
-                user_id=self.user_id
-            )
-            
-            self.db_session.add(task)
-            self.db_session.commit()
-            self.db_session.refresh(task)
-            
-            return {
-                "success": True,
-                "task_id": str(task.id),
-                "message": f"Task '{title}' added successfully"
-            }
-        except Exception as e:
-            return {
-                "success": False,
-                "message": f"Error adding task: {str(e)}"
-            }
-    
-    def list_tasks(self, completed: bool = None) -> List[Dict[str, Any]]:
-        """
-        List tasks for the user
-        
-        Args:
-            completed: Filter by completion status (None for all, True for completed, False for incomplete)
-        
-        Returns:
-            List of task dictionaries
-        """
-        try:
-            query = select(Task).where(Task.user_id == self.user_id)
-            
-            if completed is not None:
-                query = query.where(Task.completed == completed)
-            
-            tasks = self.db_session.exec(query).all()
-            
-            return [
-                {
-                    "id": str(task.id),
-                    "title": task.title,
-                    "description": task.description,
-                    "completed": task.completed,
-                    "due_date": task.due_date.isoformat() if task.due_date else None,
-                    "created_at": task.created_at.isoformat()
-                }
-                for task in tasks
+        except ValueError:
+            return {"success": False, "message": f"Invalid due date format: {due_date}"}
+
+        duplicates = []
+        if task_index.enabled:
+            try:
+                duplicates = await self._search(
+                    f"{title} {description or ''}", limit=3, min_score=settings.TASK_DUPLICATE_THRESHOLD
+                )
+            except Exception:
+                # The warning is a nicety; never fail the add over it
+                logger.warning("Duplicate check failed for user %s", self.user_id, exc_info=True)
+
+        task = Task(title=title, description=description, due_date=parsed_due_date, user_id=self.user_id)
+        self.db_session.add(task)
+        self._written(task_events.CREATED, task, None)
+
+        result = {
+            "success": True,
+            "task_id": str(task.id),
+            "message": f"Task '{title}' added successfully"
+        }
+        if duplicates:
+            result["possible_duplicates"] = [
+                {"id": str(match.id), "title": match.title, "score": round(score, 3)} for match, score in duplicates
             ]
+            titles = ", ".join(f"'{match.title}'" for match, _ in duplicates)
+            result["message"] += f". It looks similar to your existing task {titles}"
+        return result
+
+    @tool(
+        "list_tasks",
+        "List tasks for the user",
+        {
+            "completed": {
+                "type": "boolean",
+                "description": "Filter by completion status (true for completed, false for incomplete, null for all)"
+            },
+        },
+        read_only=True,
+    )
+    @traced("mcp.list_tasks")
+    async def list_tasks(self, completed: bool = None) -> List[Dict[str, Any]]:
+        try:
+            tasks = self._list_cache.get(completed)
+            if tasks is None:
+                query = select(Task).where(Task.user_id == self.user_id)
+                if completed is not None:
+                    query = query.where(Task.completed == completed)
+                session = self._reader()
+                tasks = list((await session.execute(query)).scalars().all())
+                self._list_cache[completed] = tasks
         except Exception as e:
+            self._failed = True
             return [{"error": f"Error listing tasks: {str(e)}"}]
-    
-    def complete_task(self, task_id: str) -> Dict[str, Any]:
-        """
-        Mark a task as complete
-        
-        Args:
-            task_id: ID of the task to mark as complete
-        
-        Returns:
-            Dictionary with success status and message
-        """
+
+        return [
+            {
+                "id": str(task.id),
+                "title": task.title,
+                "description": task.description,
+                "completed": task.completed,
+                "due_date": task.due_date.isoformat() if task.due_date else None,
+                "created_at": task.created_at.isoformat()
+            }
+            for task in tasks
+        ]
+
+    @tool(
+        "find_tasks",
+        "Find the user's tasks that best match a loose description (for example 'the report thing'). "
+        "Returns the closest tasks with a similarity score; use it instead of list_tasks to locate "
+        "the task to complete, update or delete.",
+        {
+            "query": {"type": "string", "description": "Words describing the task"},
+            "include_completed": {"type": "boolean", "description": "Also search completed tasks (default false)"},
+            "limit": {"type": "integer", "description": "Maximum number of tasks to return (default 5)"},
+        },
+        required=["query"],
+        read_only=True,
+    )
+    @traced("mcp.find_tasks")
+    async def find_tasks(self, query: str, include_completed: bool = False, limit: int = 5) -> List[Dict[str, Any]]:
+        if not task_index.enabled:
+            return [{"error": "Task search is not available; use list_tasks"}]
         try:
-            # Convert string ID to UUID
-            task_uuid = uuid.UUID(task_id)
-            
-            # Find the task
-            task = self.db_session.exec(
-                select(Task).where(Task.id == task_uuid, Task.user_id == self.user_id)
-            ).first()
-            
-            if not task:
-                return {
-                    "success": False,
-                    "message": f"Task with ID {task_id} not found"
-                }
-            
-            # Update task as completed
-            task.completed = True
-            task.updated_at = datetime.utcnow()
-            
-            self.db_session.add(task)
-            self.db_session.commit()
-            
-            return {
-                "success": True,
-                "message": f"Task '{task.title}' marked as complete"
+            found = await self._search(
+                query, max(1, min(int(limit), 50)), settings.TASK_MATCH_MIN_SCORE, include_completed
+            )
+        except Exception as e:
+            self._failed = True
+            return [{"error": f"Error finding tasks: {str(e)}"}]
+
+        return [
+            {
+                "id": str(task.id),
+                "title": task.title,
+                "description": task.description,
+                "completed": task.completed,
+                "due_date": task.due_date.isoformat() if task.due_date else None,
+                "score": round(score, 3),
             }
+            for task, score in found
+        ]
+
+    @tool(
+        "complete_task",
+        "Mark a task as complete",
+        {"task_id": {"type": "string", "description": "ID of the task to mark as complete"}},
+        required=["task_id"],
+    )
+    @traced("mcp.complete_task")
+    async def complete_task(self, task_id: str) -> Dict[str, Any]:
+        try:
+            task = await self._get_task(task_id)
         except ValueError:
-            return {
-                "success": False,
-                "message": f"Invalid task ID format: {task_id}"
-            }
+            return {"success": False, "message": f"Invalid task ID format: {task_id}"}
         except Exception as e:
-            return {
-                "success": False,
-                "message": f"Error completing task: {str(e)}"
-            }
-    
-    def delete_task(self, task_id: str) -> Dict[str, Any]:
-        """
-        Delete a task
-        
-        Args:
-            task_id: ID of the task to delete
-        
-        Returns:
-            Dictionary with success status and message
-        """
+            return self._error(f"Error completing task: {str(e)}")
+
+        if not task:
+            return {"success": False, "message": f"Task with ID {task_id} not found"}
+
+        before = task_counters.snapshot(task)
+        task.completed = True
+        task.updated_at = datetime.utcnow()
+        self._written(task_events.UPDATED, task, before)
+
+        return {"success": True, "message": f"Task '{task.title}' marked as complete"}
+
+    @tool(
+        "delete_task",
+        "Delete a task",
+        {"task_id": {"type": "string", "description": "ID of the task to delete"}},
+        required=["task_id"],
+    )
+    @traced("mcp.delete_task")
+    async def delete_task(self, task_id: str) -> Dict[str, Any]:
         try:
-            # Convert string ID to UUID
-            task_uuid = uuid.UUID(task_id)
-            
-            # Find the task
-            task = self.db_session.exec(
-                select(Task).where(Task.id == task_uuid, Task.user_id == self.user_id)
-            ).first()
-            
-            if not task:
-                return {
-                    "success": False,
-                    "message": f"Task with ID {task_id} not found"
-                }
-            
-            # Delete the task
-            self.db_session.delete(task)
-            self.db_session.commit()
-            
-            return {
-                "success": True,
-                "message": f"Task '{task.title}' deleted successfully"
-            }
+            task = await self._get_task(task_id)
+            if task:
+                await self.db_session.delete(task)
         except ValueError:
-            return {
-                "success": False,
-                "message": f"Invalid task ID format: {task_id}"
-            }
+            return {"success": False, "message": f"Invalid task ID format: {task_id}"}
         except Exception as e:
-            return {
-                "success": False,
-                "message": f"Error deleting task: {str(e)}"
-            }
-    
-    def update_task(self, task_id: str, title: str = None, description: str = None, 
-                    due_date: str = None, completed: bool = None) -> Dict[str, Any]:
-        """
-        Update a task
-        
-        Args:
-            task_id: ID of the task to update
-            title: New title (optional)
-            description: New description (optional)
-            due_date: New due date (optional)
-            completed: New completion status (optional)
-        
-        Returns:
-            Dictionary with success status and message
-        """
+            return self._error(f"Error deleting task: {str(e)}")
+
+        if not task:
+            return {"success": False, "message": f"Task with ID {task_id} not found"}
+
+        self._written(task_events.DELETED, task, task_counters.snapshot(task))
+        return {"success": True, "message": f"Task '{task.title}' deleted successfully"}
+
+    @tool(
+        "update_task",
+        "Update a task",
+        {
+            "task_id": {"type": "string", "description": "ID of the task to update"},
+            "title": {"type": "string", "description": "New title of the task"},
+            "description": {"type": "string", "description": "New description of the task"},
+            "due_date": {"type": "string", "description": "New due date in ISO format"},
+            "completed": {"type": "boolean", "description": "New completion status"},
+        },
+        required=["task_id"],
+    )
+    @traced("mcp.update_task")
+    async def update_task(self, task_id: str, title: str = None, description: str = None,
+                          due_date: str = None, completed: bool = None) -> Dict[str, Any]:
         try:
-            # Convert string ID to UUID
-            task_uuid = uuid.UUID(task_id)
-            
-            # Find the task
-            task = self.db_session.exec(
-                select(Task).where(Task.id == task_uuid, Task.user_id == self.user_id)
-            ).first()
-            
-            if not task:
-                return {
-                    "success": False,
-                    "message": f"Task with ID {task_id} not found"
-                }
-            
-            # Update task fields if provided
-            if title is not None:
-                task.title = title
-            if description is not None:
-                task.description = description
-            if due_date is not None:
-                parsed_due_date = datetime.fromisoformat(due_date.replace('Z', '+00:00'))
-                task.due_date = parsed_due_date
-            if completed is not None:
-                task.completed = completed
-            
-            task.updated_at = datetime.utcnow()
-            self.db_session.add(task)
-            self.db_session.commit()
-            
-            return {
-                "success": True,
-                "message": f"Task '{task.title}' updated successfully"
-            }
+            task = await self._get_task(task_id)
+            parsed_due_date = datetime.fromisoformat(due_date.replace('Z', '+00:00')) if due_date else None
         except ValueError:
-            return {
-                "success": False,
-                "message": f"Invalid task ID or date format"
-            }
+            return {"success": False, "message": "Invalid task ID or date format"}
+        except Exception as e:
+            return self._error(f"Error updating task: {str(e)}")
+
+        if not task:
+            return {"success": False, "message": f"Task with ID {task_id} not found"}
+
+        before = task_counters.snapshot(task)
+        if title is not None:
+            task.title = title
+        if description is not None:
+            task.description = description
+        if parsed_due_date is not None:
+            task.due_date = parsed_due_date
+        if completed is not None:
+            task.completed = completed
+
+        task.updated_at = datetime.utcnow()
+        self._written(task_events.UPDATED, task, before)
+
+        return {"success": True, "message": f"Task '{task.title}' updated successfully"}
+
+    @tool(
+        "task_stats",
+        "Count the user's tasks: total, completed, open, overdue and due today. "
+        "Use this for questions about how many tasks the user has.",
+        read_only=True,
+    )
+    @traced("mcp.task_stats")
+    async def task_stats(self) -> Dict[str, Any]:
+        try:
+            session = self._reader()
+            counters = await session.get(TaskCounters, self.user_id)
+            if counters is None:
+                # Tasks predating the counters: count them this once (the next write stores the row)
+                rows = (await session.execute(task_counters.task_rows(self.user_id))).all()
+                stats = task_counters.stats(TaskCounters(user_id=self.user_id), task_counters.Delta.from_rows(rows))
+            else:
+                # Writes of this unit of work are recorded at commit
+                stats = task_counters.stats(counters, self._counts)
         except Exception as e:
-            return {
-                "success": False,
-                "message": f"Error updating task: {str(e)}"
-            }
\ No newline at end of file
+            self._failed = True
+            return {"success": False, "message": f"Error counting tasks: {str(e)}"}
+
+        return {"success": True, **stats}
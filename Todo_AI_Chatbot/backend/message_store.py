@@ -0,0 +1,236 @@
+import asyncio
+import json
+import logging
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import text, delete, insert, or_
+from sqlmodel import Session, select
+from config import settings
+from db import shard_map
+from models import Conversation, Message, ArchivedConversation
+from leader import LeaderElection
+
+try:
+    import zstandard
+except ImportError:  # Fall back to zlib when zstandard is not installed
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(value: datetime) -> datetime:
+    return (_month_start(value) + timedelta(days=32)).replace(day=1)
+
+
+def ensure_message_partitions(months_ahead: int = None) -> None:
+    """
+    Create monthly partitions of the messages table from the current month
+    up to `months_ahead` months in the future, plus a default partition, on
+    every shard. No-op on databases other than Postgres.
+    """
+    months_ahead = settings.MESSAGE_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    for shard in shard_map.all():
+        if shard.sync_engine.dialect.name == "postgresql":
+            _ensure_shard_partitions(shard.sync_engine, months_ahead)
+
+
+def _ensure_shard_partitions(engine, months_ahead: int) -> None:
+    start = _month_start(datetime.utcnow())
+
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT"))
+        for _ in range(months_ahead + 1):
+            end = _next_month(start)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS messages_{start:%Y_%m} PARTITION OF messages "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            ))
+            start = end
+
+
+def _compress(data: bytes) -> tuple[str, bytes]:
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+
+def _decompress(codec: str, payload: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this archived conversation")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+
+def archive_conversation(session: Session, conversation: Conversation) -> int:
+    """
+    Move a conversation's messages into a compressed archive row.
+    The caller commits. Returns the number of archived messages.
+
+    Only the messages read here are deleted, so a message committed meanwhile
+    stays in the messages table instead of being lost.
+    """
+    messages = session.exec(
+        select(Message)
+        .where(Message.conversation_id == conversation.id)
+        .order_by(Message.timestamp, Message.id)
+    ).all()
+
+    rows = [
+        {
+            "id": str(message.id),
+            "role": message.role,
+            "content": message.content,
+            "timestamp": message.timestamp.isoformat(),
+            "route": message.route,
+            "usage": message.usage,
+        }
+        for message in messages
+    ]
+    codec, payload = _compress(json.dumps(rows, separators=(",", ":")).encode())
+
+    session.add(ArchivedConversation(
+        conversation_id=conversation.id,
+        codec=codec,
+        message_count=len(rows),
+        payload=payload,
+    ))
+    if messages:
+        session.execute(delete(Message).where(
+            Message.conversation_id == conversation.id,
+            Message.id.in_([message.id for message in messages]),
+        ))
+    conversation.archived_at = datetime.utcnow()
+    session.add(conversation)
+    return len(rows)
+
+
+def rehydrate_conversation(session: Session, conversation: Conversation) -> None:
+    """
+    Restore an archived conversation's messages into the messages table and
+    record when, so the next archival pass leaves it alone. `updated_at` is
+    left as is: reading an old thread is not activity. Commits when anything was restored; no-op for conversations that are not archived.
+    """
+    if conversation.archived_at is None:
+        return
+
+    archive = session.get(ArchivedConversation, conversation.id)
+    if archive is not None:
+        rows = json.loads(_decompress(archive.codec, archive.payload))
+        if rows:
+            session.execute(insert(Message), [
+                {
+                    "id": uuid.UUID(row["id"]),
+                    "conversation_id": conversation.id,
+                    "role": row["role"],
+                    "content": row["content"],
+                    "timestamp": datetime.fromisoformat(row["timestamp"]),
+                    "route": row.get("route"),
+                    "usage": row.get("usage"),
+                }
+                for row in rows
+            ])
+        session.delete(archive)
+
+    conversation.archived_at = None
+    conversation.rehydrated_at = datetime.utcnow()
+    session.add(conversation)
+    session.commit()
+
+
+def archive_idle_conversations(idle_days: int = None, batch_size: int = 100) -> int:
+    """
+    Archive conversations with no activity, and not restored from the
+    archive, for `idle_days`. Returns the number of conversations archived.
+
+    Candidates are locked (skipping those the message writer holds) and
+    rechecked under the lock, since a chat turn may have touched them since
+    they went idle.
+    """
+    idle_days = settings.MESSAGE_ARCHIVE_AFTER_DAYS if idle_days is None else idle_days
+    cutoff = datetime.utcnow() - timedelta(days=idle_days)
+    archived = 0
+
+    for shard in shard_map.all():
+        while True:
+            with shard.SyncSession() as session:
+                conversations = session.exec(
+                    select(Conversation)
+                    .where(
+                        Conversation.updated_at < cutoff,
+                        Conversation.archived_at.is_(None),
+                        or_(Conversation.rehydrated_at.is_(None), Conversation.rehydrated_at < cutoff),
+                    )
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True)
+                ).all()
+                idle = [
+                    conversation for conversation in conversations
+                    if conversation.updated_at < cutoff
+                    and conversation.archived_at is None
+                    and (conversation.rehydrated_at is None or conversation.rehydrated_at < cutoff)
+                ]
+                if not idle:
+                    break
+
+                for conversation in idle:
+                    archive_conversation(session, conversation)
+                session.commit()
+                archived += len(idle)
+
+    return archived
+
+
+def run_message_maintenance() -> None:
+    ensure_message_partitions()
+    archived = archive_idle_conversations()
+    if archived:
+        logger.info("Archived %d idle conversations", archived)
+
+
+class MessageMaintenance:
+    """
+    Background job that keeps future partitions in place and archives idle conversations
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(run_message_maintenance)
+            except Exception:
+                logger.exception("Message maintenance failed")
+            await asyncio.sleep(self.interval)
+
+
+message_maintenance = MessageMaintenance(interval=settings.MESSAGE_MAINTENANCE_INTERVAL_SECONDS)
+
+# Only the elected API process runs maintenance, so workers do not archive the same conversations
+maintenance_election = LeaderElection(
+    "message_maintenance",
+    on_elected=message_maintenance.start,
+    on_deposed=message_maintenance.stop,
+    interval=settings.LEADER_ELECTION_INTERVAL_SECONDS,
+)
@@ -0,0 +1,305 @@
+import asyncio
+import json
+import logging
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import insert, update
+from config import settings
+from db import shard_map
+from sharding import MOVING
+from metrics import MESSAGE_QUEUE_DEPTH, MESSAGES_DEAD_LETTERED
+from models import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+
+class MessageQueueFull(Exception):
+    """
+    Raised when the write-behind queue stays full, i.e. the database is not keeping up
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__("Chat history is not being saved fast enough, please try again shortly")
+        self.retry_after = retry_after
+
+
+class MessageWriter:
+    """
+    Write-behind queue for chat messages.
+
+    Messages are enqueued from the request path and inserted in batches by a
+    background task, so a chat turn does not wait on a commit per message.
+    A batch is flushed when it reaches `batch_size` rows or after
+    `flush_interval` seconds, whichever comes first. Failed flushes are
+    retried with backoff.
+
+    When a batch fails, its rows are retried one at a time so a row the
+    database rejects cannot hold back the rest of its shard; a row rejected
+    `max_attempts` times is dead-lettered, i.e. logged in full and dropped.
+    Rows are only charged an attempt while the database is reachable, so an
+    outage dead-letters nothing. Above `max_pending` queued rows chat turns
+    wait in `wait_for_room()`, and `stop()` drains the queue for at most
+    `drain_timeout` seconds before dead-lettering what is left.
+
+    Rows are queued per user and routed to the user's shard when they are
+    flushed, not when they are queued. Rows of a user that rebalance.py is
+    moving are held until the move finishes and then go to the new shard.
+    """
+
+    def __init__(self, flush_interval: float, batch_size: int, max_attempts: int, max_pending: int,
+                 queue_wait: float, drain_timeout: float, max_backoff: float = 5.0):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.queue_wait = queue_wait
+        self.drain_timeout = drain_timeout
+        self.max_backoff = max_backoff
+        # Rows and conversation activity, per user
+        self._pending: Dict[uuid.UUID, List[dict]] = {}
+        self._touched: Dict[uuid.UUID, Dict[uuid.UUID, datetime]] = {}
+        # Rejected inserts so far, by message id
+        self._attempts: Dict[uuid.UUID, int] = {}
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def enqueue(self, message: Message, user_id: uuid.UUID) -> None:
+        """
+        Queue a message of `user_id` for insertion and mark its conversation as active
+        """
+        self._pending.setdefault(user_id, []).append({
+            "id": message.id,
+            "conversation_id": message.conversation_id,
+            "role": message.role,
+            "content": message.content,
+            "timestamp": message.timestamp,
+            "route": message.route,
+            "usage": message.usage,
+        })
+        self._touched.setdefault(user_id, {})[message.conversation_id] = message.timestamp
+        pending = self.pending_count
+        if pending >= self.max_pending:
+            self._room.clear()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    async def wait_for_room(self) -> None:
+        """
+        Wait up to `queue_wait` seconds while the queue is full; raise
+        MessageQueueFull if it does not drain by then
+        """
+        if self.pending_count < self.max_pending:
+            return
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._room.wait(), timeout=self.queue_wait)
+        except asyncio.TimeoutError:
+            raise MessageQueueFull(retry_after=self.queue_wait) from None
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(rows) for rows in self._pending.values())
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background task after draining the queue, giving up after `drain_timeout` seconds
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, timeout=self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.error("Could not drain %d chat messages within %.1fs", self.pending_count, self.drain_timeout)
+            self._task = None
+        for rows in self._pending.values():
+            for row in rows:
+                self._dead_letter(row, "shutdown", "not written before shutdown")
+        self._pending.clear()
+        self._touched.clear()
+
+    def _dead_letter(self, row: dict, reason: str, error: str) -> None:
+        self._attempts.pop(row["id"], None)
+        MESSAGES_DEAD_LETTERED.labels(reason).inc()
+        # The full row, so the message can be restored from the log
+        logger.error("Dead-lettered chat message (%s): %s", error, json.dumps(row, default=str))
+
+    def _requeue(self, owners: Dict[uuid.UUID, uuid.UUID], rows: List[dict],
+                 touched: Dict[uuid.UUID, datetime]) -> None:
+        # Back to each row's user (`owners` maps message and conversation ids to
+        # user ids), in front of anything queued meanwhile
+        requeued: Dict[uuid.UUID, List[dict]] = {}
+        for row in rows:
+            requeued.setdefault(owners[row["id"]], []).append(row)
+        for user_id, user_rows in requeued.items():
+            self._pending[user_id] = user_rows + self._pending.get(user_id, [])
+        for conversation_id, updated_at in touched.items():
+            self._touched.setdefault(owners[conversation_id], {}).setdefault(conversation_id, updated_at)
+
+    async def _insert_one_by_one(self, engine, rows: List[dict]) -> Tuple[List[Tuple[dict, Exception]], List[dict]]:
+        """
+        Insert `rows` in a transaction each. Returns the rows the database
+        rejected, with their errors, and the rows not tried because the
+        connection was lost; raises if no connection can be made.
+        """
+        rejected = []
+        async with engine.connect() as conn:
+            for index, row in enumerate(rows):
+                try:
+                    await conn.execute(insert(Message), [row])
+                    await conn.commit()
+                except Exception as e:
+                    try:
+                        await conn.rollback()
+                    except Exception:
+                        return rejected, rows[index:]
+                    if getattr(e, "connection_invalidated", False):
+                        return rejected, rows[index:]
+                    rejected.append((row, e))
+        return rejected, []
+
+    async def _touch(self, conn, touched: Dict[uuid.UUID, datetime]) -> None:
+        # In id order, so concurrent writers lock conversations in the same order
+        for conversation_id, updated_at in sorted(touched.items()):
+            await conn.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id)
+                .values(updated_at=updated_at)
+            )
+
+    async def _flush_shard(self, shard: str, owners: Dict[uuid.UUID, uuid.UUID], rows: List[dict],
+                           touched: Dict[uuid.UUID, datetime]) -> None:
+        engine = shard_map.shards[shard].async_engine
+        try:
+            async with engine.begin() as conn:
+                # Conversations first: the update locks their rows, which the archival
+                # pass also locks, so it cannot archive them while these rows go in
+                await self._touch(conn, touched)
+                if rows:
+                    # SQLAlchemy batches this into multi-row INSERT statements
+                    await conn.execute(insert(Message), rows)
+        except Exception as e:
+            batch_error = e
+        except asyncio.CancelledError:
+            self._requeue(owners, rows, touched)
+            raise
+        else:
+            for row in rows:
+                self._attempts.pop(row["id"], None)
+            return
+        if not rows:
+            self._requeue(owners, rows, touched)
+            raise batch_error
+
+        # Find the rows the database rejects; everything else gets written
+        try:
+            rejected, untried = await self._insert_one_by_one(engine, rows)
+        except BaseException:
+            self._requeue(owners, rows, touched)
+            raise
+        retry_ids = {row["id"] for row in untried}
+        settled = {row["id"] for row in rows} - retry_ids
+        for row, error in rejected:
+            attempts = self._attempts.get(row["id"], 0) + 1
+            if attempts >= self.max_attempts:
+                self._dead_letter(row, "rejected", f"rejected {attempts} times, last: {error}")
+            else:
+                self._attempts[row["id"]] = attempts
+                retry_ids.add(row["id"])
+                settled.discard(row["id"])
+        for message_id in settled:
+            self._attempts.pop(message_id, None)
+        retry = [row for row in rows if row["id"] in retry_ids]
+
+        try:
+            async with engine.begin() as conn:
+                await self._touch(conn, touched)
+        except BaseException:
+            self._requeue(owners, retry, touched)
+            raise
+        self._requeue(owners, retry, {})
+        if retry:
+            raise batch_error
+
+    async def flush(self) -> None:
+        """
+        Write all queued messages, one transaction per shard
+        """
+        # Resolve every user before taking anything off the queue, so a failed
+        # lookup leaves it untouched
+        users = list(set(self._pending) | set(self._touched))
+        shards = {}
+        for user_id in users:
+            shard, status = await shard_map.alookup(user_id)
+            if status != MOVING:
+                shards[user_id] = shard
+
+        batches: Dict[str, Tuple[Dict[uuid.UUID, uuid.UUID], List[dict], Dict[uuid.UUID, datetime]]] = {}
+        for user_id, shard in shards.items():
+            rows = self._pending.pop(user_id, [])
+            touched = self._touched.pop(user_id, {})
+            if not rows and not touched:
+                continue
+            owners, shard_rows, shard_touched = batches.setdefault(shard, ({}, [], {}))
+            for row in rows:
+                owners[row["id"]] = user_id
+            for conversation_id in touched:
+                owners[conversation_id] = user_id
+            shard_rows.extend(rows)
+            shard_touched.update(touched)
+
+        failed = None
+        try:
+            for shard, (owners, rows, touched) in batches.items():
+                try:
+                    await self._flush_shard(shard, owners, rows, touched)
+                except Exception as e:
+                    failed = e
+        finally:
+            if self.pending_count < self.max_pending:
+                self._room.set()
+
+        if failed is not None:
+            raise failed
+
+    async def _run(self) -> None:
+        backoff = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+                backoff = self.flush_interval
+            except Exception:
+                # While stopping, this keeps retrying until stop() gives up on the drain
+                logger.exception("Flushing %d chat messages failed, retrying in %.2fs", self.pending_count, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            if self._stopping and not self._pending and not self._touched:
+                return
+
+
+message_writer = MessageWriter(
+    flush_interval=settings.MESSAGE_FLUSH_INTERVAL_MS / 1000,
+    batch_size=settings.MESSAGE_FLUSH_BATCH_SIZE,
+    max_attempts=settings.MESSAGE_MAX_ATTEMPTS,
+    max_pending=settings.MESSAGE_QUEUE_MAX_ROWS,
+    queue_wait=settings.MESSAGE_QUEUE_WAIT_SECONDS,
+    drain_timeout=settings.MESSAGE_DRAIN_SECONDS,
+)
+MESSAGE_QUEUE_DEPTH.set_function(lambda: message_writer.pending_count)
@@ -0,0 +1,304 @@
+import re
+import time
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# HTTP
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "route", "status"],
+)
+
+# Database
+QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds",
+    "SQL statement execution time by statement shape",
+    ["engine", "statement"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+QUERY_ERRORS = Counter(
+    "db_query_errors_total",
+    "SQL statements that raised an error",
+    ["engine", "statement"],
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    ["engine"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+POOL_IN_USE = Gauge(
+    "db_pool_connections_in_use",
+    "Connections currently checked out of the pool",
+    ["engine"],
+)
+
+# LLM and tools
+LLM_LATENCY = Histogram(
+    "llm_request_duration_seconds",
+    "Chat completion latency",
+    ["model"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64),
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens consumed by chat completions",
+    ["model", "kind"],
+)
+LLM_ERRORS = Counter(
+    "llm_errors_total",
+    "Chat completions that raised an error",
+    ["model", "error"],
+)
+LLM_TOOL_CALLS = Counter(
+    "llm_tool_calls_total",
+    "Tool calls requested by the model",
+    ["model", "tool"],
+)
+LLM_FAILOVERS = Counter(
+    "llm_failovers_total",
+    "Completions moved past an endpoint after an error",
+    ["endpoint", "error"],
+)
+LLM_HEDGES = Counter(
+    "llm_hedged_requests_total",
+    "Hedged duplicate completions by outcome (sent, won)",
+    ["outcome"],
+)
+LLM_CIRCUIT_OPEN = Gauge(
+    "llm_circuit_open",
+    "1 while an LLM endpoint's circuit breaker is open",
+    ["endpoint"],
+)
+TOOL_LATENCY = Histogram(
+    "mcp_tool_duration_seconds",
+    "MCP tool execution time",
+    ["tool", "outcome"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+# Chat routing (fast path, cache or model)
+CHAT_ROUTES = Counter(
+    "chat_route_total",
+    "Chat turns by how the reply was produced",
+    ["route"],
+)
+
+# Chat response cache
+CACHE_REQUESTS = Counter(
+    "chat_cache_requests_total",
+    "Chat response cache lookups by result",
+    ["result"],
+)
+CACHE_LLM_CALLS_SAVED = Counter(
+    "chat_cache_llm_calls_saved_total",
+    "Chat completions avoided by the response cache",
+)
+CACHE_ENTRY_AGE = Histogram(
+    "chat_cache_entry_age_seconds",
+    "Age of cache entries when served",
+    ["result"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+# Write-behind chat messages
+MESSAGE_QUEUE_DEPTH = Gauge(
+    "message_queue_depth",
+    "Chat messages waiting to be written",
+)
+MESSAGES_DEAD_LETTERED = Counter(
+    "messages_dead_lettered_total",
+    "Chat messages given up on and logged instead of written (rejected, shutdown)",
+    ["reason"],
+)
+
+# Due-date reminders
+REMINDERS_SCHEDULED = Gauge(
+    "reminders_scheduled",
+    "Reminders held in the in-memory schedule",
+)
+REMINDERS_SENT = Counter(
+    "reminders_sent_total",
+    "Reminder events emitted",
+)
+REMINDER_DELAY = Histogram(
+    "reminder_delay_seconds",
+    "How late reminders fire relative to their scheduled time",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60, 300),
+)
+
+# Background jobs
+JOB_QUEUE_DEPTH = Gauge(
+    "job_queue_depth",
+    "Jobs waiting to run",
+    ["queue"],
+)
+JOBS_PROCESSED = Counter(
+    "jobs_processed_total",
+    "Job executions by outcome (done, retry, failed)",
+    ["kind", "outcome"],
+)
+JOB_DURATION = Histogram(
+    "job_duration_seconds",
+    "Job execution time",
+    ["kind"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60, 300),
+)
+
+# Idempotency keys
+IDEMPOTENCY_REQUESTS = Counter(
+    "idempotency_requests_total",
+    "Requests carrying an Idempotency-Key by result (new, replayed, mismatch, conflict, full)",
+    ["result"],
+)
+TASK_INDEX_LATENCY = Histogram(
+    "task_index_seconds",
+    "Semantic task index time by operation (build, search)",
+    ["operation"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25, 1, 5),
+)
+
+# Response compression
+COMPRESSION_BYTES = Counter(
+    "http_compression_bytes_total",
+    "Response body bytes before and after compression",
+    ["encoding", "kind"],
+)
+COMPRESSION_CACHE = Counter(
+    "http_compression_cache_total",
+    "Compressed-body cache lookups (hit, miss) and 304 answers to If-None-Match (not_modified)",
+    ["result"],
+)
+
+# Event loop
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a scheduled heartbeat",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+EVENT_LOOP_BLOCKED = Counter(
+    "event_loop_blocked_total",
+    "Times a callback blocked the event loop longer than LOOP_LAG_THRESHOLD_MS",
+)
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+def statement_shape(statement: str) -> str:
+    """
+    Reduce a SQL statement to a low-cardinality label such as "SELECT tasks"
+    """
+    words = statement.split(None, 1)
+    if not words:
+        return "UNKNOWN"
+    verb = words[0].upper()
+    match = _STATEMENT_TABLE.search(statement)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+def instrument_engine(engine: Engine, name: str) -> None:
+    """
+    Attach query timing and pool metrics to a (sync) engine.
+    For an AsyncEngine pass `async_engine.sync_engine`.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_start", None)
+        if start is not None:
+            QUERY_LATENCY.labels(name, statement_shape(statement)).observe(time.perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        statement = exception_context.statement or ""
+        QUERY_ERRORS.labels(name, statement_shape(statement)).inc()
+
+    pool = engine.pool
+    POOL_IN_USE.labels(name).set_function(lambda: checked_out(pool))
+    if not isinstance(pool, QueuePool):
+        # NullPool (aiosqlite) and the SQLite pools never make callers wait for a connection
+        return
+
+    # Time the wait for a connection around the pool's internal getter
+    original_do_get = pool._do_get
+
+    def _timed_do_get():
+        start = time.perf_counter()
+        try:
+            return original_do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.labels(name).observe(time.perf_counter() - start)
+
+    pool._do_get = _timed_do_get
+
+
+def checked_out(pool) -> int:
+    """
+    Connections currently checked out of `pool`; 0 for pools that do not count them
+    """
+    counter = getattr(pool, "checkedout", None)
+    return counter() if callable(counter) else 0
+
+
+def observe_completion(model: str, started: float, response=None, error: Exception = None) -> None:
+    """
+    Record latency, token usage and errors for one chat completion call
+    """
+    LLM_LATENCY.labels(model).observe(time.perf_counter() - started)
+    if error is not None:
+        LLM_ERRORS.labels(model, type(error).__name__).inc()
+        return
+
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        LLM_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+        LLM_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+
+    tool_calls = response.choices[0].message.tool_calls or []
+    for tool_call in tool_calls:
+        LLM_TOOL_CALLS.labels(model, tool_call.function.name).inc()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request latency per route template
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope; fall back to a
+            # fixed label so unmatched paths do not explode label cardinality
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            REQUEST_LATENCY.labels(scope["method"], route_path, str(status_code)).observe(
+                time.perf_counter() - start
+            )
+
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
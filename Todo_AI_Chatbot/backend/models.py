@@ -1,8 +1,8 @@
 from sqlmodel import SQLModel, Field, create_engine, Session, select
-from sqlalchemy import func, ForeignKey
-from typing import Optional
+from sqlalchemy import func, ForeignKey, Index, Column, LargeBinary, JSON, text
+from typing import Optional, List
 import uuid
-from datetime import datetime
+from datetime import date, datetime
 from pydantic import BaseModel
 from enum import Enum
 
@@ -41,6 +41,30 @@ class Task(TaskBase, table=True):
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
     __tablename__ = "tasks"
+    # Reminder scheduler reads open tasks by due date; completed tasks stay out of the index
+    __table_args__ = (
+        Index(
+            "ix_tasks_due_date_open",
+            "due_date",
+            postgresql_where=text("completed = false AND due_date IS NOT NULL"),
+            sqlite_where=text("completed = 0 AND due_date IS NOT NULL"),
+        ),
+    )
+
+
+class TaskCounters(SQLModel, table=True):
+    """
+    Per-user task counts, updated in the same transaction as every task write
+    (see task_counters.py)
+    """
+    user_id: uuid.UUID = Field(primary_key=True, foreign_key="users.id")
+    total: int = Field(default=0)
+    completed: int = Field(default=0)
+    # Open tasks with a due date, per UTC due day: {"2025-01-31": 2}
+    open_due_days: dict = Field(default_factory=dict, sa_column=Column(JSON, nullable=False))
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    __tablename__ = "task_counters"
 
 
 class ConversationBase(SQLModel):
@@ -52,8 +76,14 @@ class Conversation(ConversationBase, table=True):
     user_id: uuid.UUID = Field(default=None, foreign_key="users.id")  # Removed ondelete for compatibility
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
+    archived_at: datetime | None = Field(default=None)  # Set while history lives in archived_conversations
+    rehydrated_at: datetime | None = Field(default=None)  # Last restore from the archive; not activity
 
     __tablename__ = "conversations"
+    # Conversation lists are read newest-first per user
+    __table_args__ = (
+        Index("ix_conversations_user_id_updated_at", "user_id", "updated_at"),
+    )
 
 
 class MessageBase(SQLModel):
@@ -64,9 +94,94 @@ class MessageBase(SQLModel):
 class Message(MessageBase, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     conversation_id: uuid.UUID = Field(default=None, foreign_key="conversations.id")  # Removed ondelete for compatibility
-    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    # Part of the primary key because Postgres requires the partition key in it
+    timestamp: datetime = Field(default_factory=datetime.utcnow, primary_key=True)
+    # How an assistant reply was produced: 'llm', 'cache_hit', 'fast_path:add_task', ...
+    route: str | None = Field(default=None, max_length=50)
+    # LLM usage of the turn an assistant reply came from: model, tokens, latency, tool-result bytes
+    usage: dict | None = Field(default=None, sa_column=Column(JSON, nullable=True))
 
     __tablename__ = "messages"
+    # Supports keyset pagination of history on (timestamp, id);
+    # on Postgres the table is range-partitioned by month (see message_store.py)
+    __table_args__ = (
+        Index("ix_messages_conversation_id_timestamp_id", "conversation_id", "timestamp", "id"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+
+class ArchivedConversation(SQLModel, table=True):
+    """
+    Compressed message history of a conversation that has gone cold
+    """
+    conversation_id: uuid.UUID = Field(primary_key=True, foreign_key="conversations.id")
+    codec: str = Field(max_length=16, nullable=False)  # 'zstd' or 'zlib'
+    message_count: int = Field(default=0)
+    payload: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
+    __tablename__ = "archived_conversations"
+
+
+class UserDirectory(SQLModel, table=True):
+    """
+    Which shard holds each user (see sharding.py). Kept on the main database
+    so sign-in can find a user by email without asking every shard.
+    """
+    user_id: uuid.UUID = Field(primary_key=True)
+    email: str = Field(unique=True, nullable=False)
+    shard: str = Field(max_length=50, nullable=False)
+    status: str = Field(default="active", max_length=16, nullable=False)  # active, moving
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    __tablename__ = "user_directory"
+
+
+class TokenUsage(SQLModel, table=True):
+    """
+    LLM usage per user, UTC day and model (see usage_ledger.py). Kept on the
+    main database so it can be queried across users.
+    """
+    user_id: uuid.UUID = Field(primary_key=True)
+    day: date = Field(primary_key=True)
+    model: str = Field(primary_key=True, max_length=100)
+    turns: int = Field(default=0)  # Chat turns that called the model
+    completions: int = Field(default=0)
+    prompt_tokens: int = Field(default=0)
+    completion_tokens: int = Field(default=0)
+    tool_result_bytes: int = Field(default=0)  # Tool output sent back to the model
+    latency_ms: int = Field(default=0)  # Summed completion latency
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    __tablename__ = "token_usage"
+    # Admin reports scan a range of days
+    __table_args__ = (
+        Index("ix_token_usage_day", "day"),
+    )
+
+
+class Job(SQLModel, table=True):
+    """
+    Background job in the durable queue (see jobs.py)
+    """
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    queue: str = Field(default="default", max_length=50, nullable=False)
+    kind: str = Field(max_length=100, nullable=False)
+    payload: dict = Field(default_factory=dict, sa_column=Column(JSON, nullable=False))
+    status: str = Field(default="queued", max_length=16, nullable=False)  # queued, running, done, failed
+    attempts: int = Field(default=0)
+    max_attempts: int = Field(default=5)
+    run_at: datetime = Field(default_factory=datetime.utcnow)
+    locked_until: datetime | None = Field(default=None)
+    last_error: str | None = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    __tablename__ = "jobs"
+    # Workers claim the oldest runnable jobs of their queues
+    __table_args__ = (
+        Index("ix_jobs_queue_status_run_at", "queue", "status", "run_at"),
+    )
 
 
 # Pydantic models for API requests/responses
@@ -88,6 +203,33 @@ class TaskResponse(TaskBase):
     updated_at: datetime
 
 
+class TaskStats(BaseModel):
+    total: int
+    completed: int
+    open: int
+    overdue: int  # Open and due on an earlier day (UTC)
+    due_today: int
+
+
+class UsageTotals(BaseModel):
+    turns: int = 0
+    completions: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    tool_result_bytes: int = 0
+    latency_ms: int = 0
+
+
+class UserUsage(UsageTotals):
+    user_id: uuid.UUID
+
+
+class DailyUsage(UsageTotals):
+    day: date
+    model: str
+
+
 class UserResponse(UserBase):
     id: uuid.UUID
     created_at: datetime
@@ -105,10 +247,23 @@ class MessageResponse(MessageBase):
     id: uuid.UUID
     conversation_id: uuid.UUID
     timestamp: datetime
+    route: str | None = None
+    usage: dict | None = None
+
+
+class ConversationPage(BaseModel):
+    conversations: List[ConversationResponse]
+    next_cursor: str | None = None
+
+
+class MessagePage(BaseModel):
+    messages: List[MessageResponse]
+    next_cursor: str | None = None
 
 
 class ChatRequest(BaseModel):
     message: str
+    conversation_id: uuid.UUID | None = None
 
 
 class ChatResponse(BaseModel):
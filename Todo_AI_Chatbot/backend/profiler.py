@@ -0,0 +1,181 @@
+"""
+Runtime diagnostics for a live worker.
+
+- SamplingProfiler samples the Python stacks of every thread from a separate
+  thread for a few seconds and returns them in the collapsed format read by
+  flamegraph.pl, speedscope and similar tools ("thread;frame;frame count").
+  Sampling only reads frames, so the worker keeps serving while it runs.
+- LoopLagMonitor schedules a heartbeat on the event loop. A watchdog thread
+  notices when the heartbeat stops running and logs the loop thread's stack
+  while the blocking callback is still on it.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from config import settings
+from metrics import EVENT_LOOP_BLOCKED, EVENT_LOOP_LAG
+
+logger = logging.getLogger(__name__)
+
+# Leaf frames of threads that are waiting rather than working: (file name, function)
+_IDLE_LEAVES = frozenset({
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),  # concurrent.futures worker waiting for work
+    ("runners.py", "run"),  # uvloop waits in C below asyncio.run
+})
+
+
+class ProfilerBusy(Exception):
+    """
+    Raised when a profile is requested while another one is running
+    """
+
+
+@lru_cache(maxsize=4096)
+def _short_path(filename: str) -> str:
+    """
+    `filename` relative to the sys.path entry it was imported from
+    """
+    for prefix in sorted((entry for entry in sys.path if entry), key=len, reverse=True):
+        if filename.startswith(prefix + os.sep):
+            return filename[len(prefix) + 1:]
+    return filename
+
+
+def collapse(frame, include_idle: bool = True) -> Optional[str]:
+    """
+    "outer;...;inner" for the stack ending at `frame`, or None for an idle
+    thread when `include_idle` is false
+    """
+    code = frame.f_code
+    if not include_idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+        return None
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({_short_path(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler over all threads, one profile at a time
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def sample(self, seconds: float, interval: float, include_idle: bool = False) -> Tuple[Dict[str, int], int]:
+        """
+        Sample every `interval` seconds for `seconds`. Blocks the calling
+        thread, so run it with asyncio.to_thread. Returns (stack counts, samples taken).
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running in this worker")
+        try:
+            own = threading.get_ident()
+            stacks: Counter = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = collapse(frame, include_idle)
+                    if stack is not None:
+                        stacks[f"{names.get(ident, ident)};{stack}"] += 1
+                samples += 1
+                time.sleep(interval)
+            return dict(stacks), samples
+        finally:
+            self._lock.release()
+
+
+def render_collapsed(stacks: Dict[str, int]) -> str:
+    """
+    One "stack count" line per distinct stack, most frequent first
+    """
+    lines = [f"{stack} {count}" for stack, count in sorted(stacks.items(), key=lambda item: -item[1])]
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class LoopLagMonitor:
+    """
+    Event-loop heartbeat plus a watchdog thread that logs what blocks the loop
+    """
+
+    def __init__(self, threshold: float, interval: float):
+        self.threshold = threshold
+        self.interval = interval
+        self._beat = 0.0
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._loop_thread = threading.get_ident()
+            self._beat = time.monotonic()
+            self._stopped.clear()
+            self._task = asyncio.create_task(self._heartbeat())
+            self._thread = threading.Thread(target=self._watch, name="loop-lag-monitor", daemon=True)
+            self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, self.interval * 2)
+            self._thread = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            EVENT_LOOP_LAG.observe(max(now - expected, 0.0))
+            self._beat = now
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            # A healthy loop beats every `interval`; anything beyond that is time spent blocked
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            EVENT_LOOP_BLOCKED.inc()
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(unavailable)\n"
+            logger.warning(
+                "Event loop blocked for at least %.0f ms; the loop thread is at:\n%s",
+                blocked * 1000,
+                stack.rstrip("\n"),
+            )
+
+
+profiler = SamplingProfiler()
+loop_lag_monitor = LoopLagMonitor(
+    threshold=settings.LOOP_LAG_THRESHOLD_MS / 1000,
+    interval=settings.LOOP_LAG_INTERVAL_MS / 1000,
+)
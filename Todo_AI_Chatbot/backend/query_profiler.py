@@ -0,0 +1,217 @@
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised by query_budget() when a request ran more statements than allowed
+    """
+
+
+@dataclass
+class QueryRecord:
+    statement: str
+    duration: float
+    parameter_shape: str
+
+
+@dataclass
+class RequestProfile:
+    """
+    Every statement executed while handling one request
+    """
+    label: str
+    queries: List[QueryRecord] = field(default_factory=list)
+
+    @property
+    def count(self) -> int:
+        return len(self.queries)
+
+    @property
+    def total_time(self) -> float:
+        return sum(query.duration for query in self.queries)
+
+    def repeated_statements(self, threshold: int) -> List[tuple[str, int]]:
+        """
+        Statement shapes executed at least `threshold` times (likely N+1 patterns)
+        """
+        counts = Counter(query.statement for query in self.queries)
+        return [(statement, count) for statement, count in counts.most_common() if count >= threshold]
+
+
+_current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("current_query_profile", default=None)
+_profile_listeners: List[Callable[[RequestProfile], None]] = []
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current_profile.get()
+
+
+def add_profile_listener(listener: Callable[[RequestProfile], None]) -> None:
+    """
+    Call `listener` with the profile of every finished request or profiled block
+    """
+    _profile_listeners.append(listener)
+
+
+def remove_profile_listener(listener: Callable[[RequestProfile], None]) -> None:
+    _profile_listeners.remove(listener)
+
+
+def _parameter_shape(parameters) -> str:
+    """
+    Describe bound parameters by type only, so values never reach the logs
+    """
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"[{len(parameters)} x {_parameter_shape(parameters[0])}]"
+        return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+    return type(parameters).__name__
+
+
+def _explain(conn, statement: str, parameters) -> str:
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    # Use a fresh cursor; the original one still holds the unread result set
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def install_query_profiler(engine: Engine) -> None:
+    """
+    Attach the per-request statement recorder and slow-query log to a (sync) engine.
+    For an AsyncEngine pass `async_engine.sync_engine`.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._profiler_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_profiler_start", None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.queries.append(QueryRecord(statement, duration, _parameter_shape(parameters)))
+
+        if duration * 1000 >= settings.SLOW_QUERY_THRESHOLD_MS:
+            plan = None
+            if settings.SLOW_QUERY_EXPLAIN and not executemany and statement.lstrip().upper().startswith("SELECT"):
+                try:
+                    plan = _explain(conn, statement, parameters)
+                except Exception as e:
+                    plan = f"EXPLAIN failed: {e}"
+            logger.warning(
+                "Slow query (%.1f ms) in %s: %s\nparameters: %s%s",
+                duration * 1000,
+                profile.label if profile else "background",
+                statement,
+                _parameter_shape(parameters),
+                f"\nplan:\n{plan}" if plan else "",
+            )
+
+
+class _BudgetWatcher:
+    def __init__(self, max_queries: int):
+        self.max_queries = max_queries
+        self.violations: List[RequestProfile] = []
+
+    def check(self, profile: RequestProfile) -> None:
+        if profile.count > self.max_queries:
+            self.violations.append(profile)
+
+
+def _finish_profile(profile: RequestProfile) -> None:
+    repeated = profile.repeated_statements(settings.N_PLUS_ONE_THRESHOLD)
+    for statement, count in repeated:
+        logger.warning("Possible N+1 in %s: statement ran %d times: %s", profile.label, count, statement)
+
+    budget = settings.QUERY_BUDGET_PER_REQUEST
+    if budget is not None and profile.count > budget:
+        logger.warning("%s ran %d queries, budget is %d", profile.label, profile.count, budget)
+
+    for listener in list(_profile_listeners):
+        listener(profile)
+
+
+@contextmanager
+def profile_queries(label: str = "block"):
+    """
+    Record the statements executed in the current context
+    """
+    profile = RequestProfile(label=label)
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+        _finish_profile(profile)
+
+
+@contextmanager
+def query_budget(max_queries: int):
+    """
+    Fail when the enclosed code, or any request served while it is active,
+    executes more than `max_queries` statements. Intended for tests:
+
+        with query_budget(2):
+            client.patch(f"/api/{user_id}/tasks/{task_id}/complete", headers=headers)
+    """
+    watcher = _BudgetWatcher(max_queries)
+    add_profile_listener(watcher.check)
+    try:
+        with profile_queries("query_budget") as profile:
+            yield profile
+    finally:
+        remove_profile_listener(watcher.check)
+
+    # Our own profile is finished (and checked) when profile_queries exits
+    if watcher.violations:
+        details = "; ".join(
+            f"{violation.label}: {violation.count} queries" for violation in watcher.violations
+        )
+        raise QueryBudgetExceeded(f"Query budget of {max_queries} exceeded ({details})")
+
+
+class QueryProfilerMiddleware:
+    """
+    ASGI middleware that records the statements of each request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(label=f"{scope['method']} {scope['path']}")
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_profile.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                profile.label = f"{scope['method']} {route.path}"
+            _finish_profile(profile)
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable
+from auth import user_id_from_token
+from config import settings
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # The shared store is optional
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+
+class LLMQuotaExceeded(Exception):
+    """
+    Raised when a caller waited too long for an LLM concurrency slot
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__("Too many concurrent AI requests, please retry shortly")
+        self.retry_after = retry_after
+
+
+class InMemoryBucketStore:
+    """
+    Token buckets kept in this process
+    """
+
+    def __init__(self):
+        self._buckets: Dict[str, tuple[float, float]] = {}
+        self._takes = 0
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> tuple[bool, float, float]:
+        """
+        Take `cost` tokens from the bucket. Returns (allowed, remaining, retry_after)
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+
+        self._takes += 1
+        if self._takes % 1000 == 0:
+            self._prune(now, capacity, rate)
+
+        retry_after = 0.0 if allowed else (cost - tokens) / rate
+        return allowed, tokens, retry_after
+
+    def _prune(self, now: float, capacity: float, rate: float) -> None:
+        # A bucket that would have refilled completely carries no state
+        full_after = capacity / rate
+        for key in [key for key, (_, updated) in self._buckets.items() if now - updated >= full_after]:
+            del self._buckets[key]
+
+
+class RedisBucketStore:
+    """
+    Token buckets shared between workers through Redis
+    """
+
+    _SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local now = tonumber(ARGV[4])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * rate)
+    local allowed = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url: str):
+        self._client = redis_asyncio.from_url(url)
+        self._script = self._client.register_script(self._SCRIPT)
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> tuple[bool, float, float]:
+        allowed, tokens = await self._script(keys=[f"ratelimit:{key}"], args=[capacity, rate, cost, time.time()])
+        tokens = float(tokens)
+        retry_after = 0.0 if allowed else (cost - tokens) / rate
+        return bool(allowed), tokens, retry_after
+
+
+def _create_store():
+    if settings.RATE_LIMIT_REDIS_URL:
+        if redis_asyncio is None:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL is set but the redis package is not installed")
+        return RedisBucketStore(settings.RATE_LIMIT_REDIS_URL)
+    return InMemoryBucketStore()
+
+
+class FairLLMLimiter:
+    """
+    Caps concurrent LLM calls globally and per user.
+
+    Callers over a cap wait in a per-user queue; when a slot frees up the
+    queues are served round-robin, so one user with many pending calls cannot
+    starve others.
+    """
+
+    def __init__(self, global_limit: int, per_user_limit: int):
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self.in_flight = 0
+        self._per_user: Dict[Hashable, int] = defaultdict(int)
+        self._waiters: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+
+    def _grant(self, key: Hashable) -> None:
+        self.in_flight += 1
+        self._per_user[key] += 1
+
+    def _dispatch(self) -> None:
+        progressed = True
+        while progressed and self.in_flight < self.global_limit and self._waiters:
+            progressed = False
+            for key in list(self._waiters):
+                if self.in_flight >= self.global_limit:
+                    break
+                if self._per_user[key] >= self.per_user_limit:
+                    continue
+                queue = self._waiters.pop(key)
+                while queue and queue[0].done():
+                    queue.popleft()
+                if queue:
+                    self._grant(key)
+                    queue.popleft().set_result(None)
+                if queue:
+                    # Back of the line for this user's next waiter
+                    self._waiters[key] = queue
+                progressed = True
+
+    async def acquire(self, key: Hashable, timeout: float) -> None:
+        if (
+            self.in_flight < self.global_limit
+            and self._per_user[key] < self.per_user_limit
+            and key not in self._waiters
+        ):
+            self._grant(key)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, deque()).append(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            queue = self._waiters.get(key)
+            if queue is not None and future in queue:
+                queue.remove(future)
+                if not queue:
+                    del self._waiters[key]
+            if future.done() and not future.cancelled():
+                # Granted just as we gave up; hand the slot back
+                self.release(key)
+            if isinstance(e, asyncio.TimeoutError):
+                raise LLMQuotaExceeded(retry_after=max(1.0, timeout)) from None
+            raise
+
+    def release(self, key: Hashable) -> None:
+        self.in_flight -= 1
+        self._per_user[key] -= 1
+        if self._per_user[key] <= 0:
+            del self._per_user[key]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable, timeout: float = None):
+        timeout = settings.LLM_QUEUE_TIMEOUT_SECONDS if timeout is None else timeout
+        await self.acquire(key, timeout)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+
+llm_limiter = FairLLMLimiter(
+    global_limit=settings.LLM_MAX_CONCURRENT,
+    per_user_limit=settings.LLM_MAX_CONCURRENT_PER_USER,
+)
+
+
+def _rate_limit_key(scope) -> str:
+    """
+    The authenticated user id from the bearer token, else the client address
+    """
+    headers = dict(scope.get("headers") or [])
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if authorization.startswith("Bearer "):
+        user_id = user_id_from_token(authorization[7:])
+        if user_id is not None:
+            return f"user:{user_id}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware applying a per-user token bucket to API requests.
+    Chat requests cost CHAT_REQUEST_COST tokens since each one drives LLM calls.
+    """
+
+    exempt_paths = {"/", "/health", "/ready", "/metrics"}
+
+    def __init__(self, app):
+        self.app = app
+        self.store = _create_store()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.RATE_LIMIT_ENABLED or scope["path"] in self.exempt_paths:
+            await self.app(scope, receive, send)
+            return
+
+        capacity = settings.RATE_LIMIT_CAPACITY
+        cost = settings.CHAT_REQUEST_COST if scope["path"].endswith("/chat") else 1
+        try:
+            allowed, remaining, retry_after = await self.store.take(
+                _rate_limit_key(scope), cost, capacity, settings.RATE_LIMIT_REFILL_PER_SECOND
+            )
+        except Exception:
+            # Fail open if the shared store is unavailable
+            logger.exception("Rate limit store failed")
+            await self.app(scope, receive, send)
+            return
+
+        quota_headers = [
+            (b"x-ratelimit-limit", str(capacity).encode()),
+            (b"x-ratelimit-remaining", str(int(remaining)).encode()),
+        ]
+
+        if not allowed:
+            body = json.dumps({"detail": "Rate limit exceeded"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": quota_headers + [
+                    (b"retry-after", str(math.ceil(retry_after)).encode()),
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + quota_headers
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
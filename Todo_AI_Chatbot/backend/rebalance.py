@@ -0,0 +1,214 @@
+"""
+Move users between shards.
+
+    python rebalance.py status                        # users per shard
+    python rebalance.py backfill                      # add users found on the shards to the directory
+    python rebalance.py plan                          # users not on the shard the hash ring wants
+    python rebalance.py run [--limit N] [--batch-size N]  # move every planned user
+    python rebalance.py move USER_ID --to SHARD       # move one user
+
+Moves are online and done in batches. The users' directory entries are
+marked "moving", which makes the API answer their writes with 503 (reads
+keep working). Chat turns already running check the status again before
+they commit and roll back if it changed, and the chat message write-behind
+queue holds a moving user's messages until the move is over. The tool waits
+for every process's directory cache to see the new status and for requests
+that passed the old one to finish, copies each user's rows to the target
+shard, points the directory at it, waits again so cached readers move over,
+and finally deletes the rows from the source shard.
+"""
+import argparse
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import List
+from sqlalchemy import delete, insert, select
+from config import settings
+from db import SyncSession, shard_map
+from models import ArchivedConversation, Conversation, Message, Task, TaskCounters, User, UserDirectory
+from sharding import ACTIVE, MOVING
+
+CHUNK_SIZE = 500
+
+
+def default_settle_seconds() -> float:
+    """
+    Directory cache lifetime plus the longest a chat turn can run (queued for
+    an LLM slot, then the completion deadline), so no request still holds an
+    old directory entry when the wait is over
+    """
+    return (
+        settings.SHARD_DIRECTORY_CACHE_SECONDS
+        + settings.LLM_QUEUE_TIMEOUT_SECONDS
+        + settings.LLM_DEADLINE_SECONDS
+        + 5
+    )
+
+
+def _set_directory(user_id: uuid.UUID, **values) -> None:
+    with SyncSession() as session:
+        entry = session.get(UserDirectory, user_id)
+        for name, value in values.items():
+            setattr(entry, name, value)
+        entry.updated_at = datetime.utcnow()
+        session.add(entry)
+        session.commit()
+
+
+def _user_rows(conn, user_id: uuid.UUID):
+    """
+    The user's rows on one shard, per table, in foreign-key order
+    """
+    tables = {
+        User.__table__: conn.execute(select(User.__table__).where(User.__table__.c.id == user_id)).mappings().all(),
+        Task.__table__: conn.execute(select(Task.__table__).where(Task.__table__.c.user_id == user_id)).mappings().all(),
+        TaskCounters.__table__: conn.execute(
+            select(TaskCounters.__table__).where(TaskCounters.__table__.c.user_id == user_id)
+        ).mappings().all(),
+    }
+    conversations = conn.execute(
+        select(Conversation.__table__).where(Conversation.__table__.c.user_id == user_id)
+    ).mappings().all()
+    tables[Conversation.__table__] = conversations
+
+    conversation_ids = [row["id"] for row in conversations]
+    messages, archives = [], []
+    for start in range(0, len(conversation_ids), CHUNK_SIZE):
+        chunk = conversation_ids[start:start + CHUNK_SIZE]
+        messages += conn.execute(
+            select(Message.__table__).where(Message.__table__.c.conversation_id.in_(chunk))
+        ).mappings().all()
+        archives += conn.execute(
+            select(ArchivedConversation.__table__).where(ArchivedConversation.__table__.c.conversation_id.in_(chunk))
+        ).mappings().all()
+    tables[Message.__table__] = messages
+    tables[ArchivedConversation.__table__] = archives
+    return tables, conversation_ids
+
+
+def _delete_user_rows(conn, user_id: uuid.UUID, conversation_ids: List[uuid.UUID]) -> None:
+    for start in range(0, len(conversation_ids), CHUNK_SIZE):
+        chunk = conversation_ids[start:start + CHUNK_SIZE]
+        conn.execute(delete(ArchivedConversation.__table__).where(ArchivedConversation.__table__.c.conversation_id.in_(chunk)))
+        conn.execute(delete(Message.__table__).where(Message.__table__.c.conversation_id.in_(chunk)))
+    conn.execute(delete(Conversation.__table__).where(Conversation.__table__.c.user_id == user_id))
+    conn.execute(delete(TaskCounters.__table__).where(TaskCounters.__table__.c.user_id == user_id))
+    conn.execute(delete(Task.__table__).where(Task.__table__.c.user_id == user_id))
+    conn.execute(delete(User.__table__).where(User.__table__.c.id == user_id))
+
+
+def move_users(moves: List[tuple], settle_seconds: float) -> None:
+    """
+    Move each (user_id, target shard) in `moves`. The users are moved as one
+    batch so the settle waits are paid once per batch.
+    """
+    with SyncSession() as session:
+        entries = {user_id: session.get(UserDirectory, user_id) for user_id, _ in moves}
+    batch = []
+    for user_id, target_name in moves:
+        entry = entries[user_id]
+        if entry is None:
+            print(f"Skipping {user_id}: not in the directory (run backfill)")
+        elif entry.shard == target_name:
+            print(f"Skipping {user_id}: already on {target_name}")
+        else:
+            batch.append((user_id, shard_map.shards[entry.shard], shard_map.shards[target_name]))
+    if not batch:
+        return
+
+    # 1. Block writes, let every process's directory cache notice and let requests
+    # that started before that finish
+    for user_id, _, _ in batch:
+        _set_directory(user_id, status=MOVING)
+    time.sleep(settle_seconds)
+
+    # 2. Copy each user, then switch the directory to the new shard
+    copied = []
+    for user_id, source, target in batch:
+        try:
+            with source.sync_engine.connect() as source_conn, target.sync_engine.begin() as target_conn:
+                rows, conversation_ids = _user_rows(source_conn, user_id)
+                # A leftover partial copy from an earlier attempt is replaced
+                _delete_user_rows(target_conn, user_id, conversation_ids)
+                for table, table_rows in rows.items():
+                    if table_rows:
+                        target_conn.execute(insert(table), [dict(row) for row in table_rows])
+        except Exception as e:
+            # The source copy is still authoritative
+            _set_directory(user_id, status=ACTIVE)
+            print(f"Failed to move {user_id}: {e}")
+            continue
+        _set_directory(user_id, shard=target.name, status=ACTIVE)
+        copied.append((user_id, source, target, conversation_ids, sum(len(r) for r in rows.values())))
+
+    # 3. Wait out readers still using the old entries, then remove the source copies
+    time.sleep(settle_seconds)
+    for user_id, source, target, conversation_ids, row_count in copied:
+        with source.sync_engine.begin() as source_conn:
+            _delete_user_rows(source_conn, user_id, conversation_ids)
+        print(f"Moved {user_id} ({row_count} rows) from {source.name} to {target.name}")
+
+
+def planned_moves() -> List[tuple]:
+    with SyncSession() as session:
+        entries = session.execute(select(UserDirectory.user_id, UserDirectory.shard)).all()
+    return [
+        (user_id, shard, shard_map.place(user_id).name)
+        for user_id, shard in entries
+        if shard_map.place(user_id).name != shard
+    ]
+
+
+def backfill() -> None:
+    added = 0
+    for shard in shard_map.all():
+        with shard.SyncSession() as shard_session, SyncSession() as session:
+            known = set(session.execute(select(UserDirectory.user_id)).scalars().all())
+            for user_id, email in shard_session.execute(select(User.id, User.email)).all():
+                if user_id not in known:
+                    session.add(UserDirectory(user_id=user_id, email=email, shard=shard.name))
+                    added += 1
+            session.commit()
+    print(f"Added {added} users to the directory")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebalance users between shards")
+    parser.add_argument("command", choices=["status", "backfill", "plan", "run", "move"])
+    parser.add_argument("user_id", nargs="?", type=uuid.UUID)
+    parser.add_argument("--to", dest="target", help="Target shard for move")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=100, help="Users moved per batch by run")
+    parser.add_argument(
+        "--settle-seconds", type=float, default=default_settle_seconds(),
+        help="Wait for directory caches to expire and running requests to finish (default: "
+             "SHARD_DIRECTORY_CACHE_SECONDS + LLM_QUEUE_TIMEOUT_SECONDS + LLM_DEADLINE_SECONDS + 5)",
+    )
+    args = parser.parse_args()
+
+    if not shard_map.enabled:
+        raise SystemExit("Sharding is not configured (DATABASE_SHARD_URLS is empty)")
+
+    if args.command == "status":
+        with SyncSession() as session:
+            counts = Counter(session.execute(select(UserDirectory.shard)).scalars().all())
+        for name in shard_map.shards:
+            print(f"{name}: {counts.get(name, 0)} users")
+    elif args.command == "backfill":
+        backfill()
+    elif args.command == "plan":
+        for user_id, current, target in planned_moves():
+            print(f"{user_id}: {current} -> {target}")
+    elif args.command == "run":
+        moves = [(user_id, target) for user_id, _, target in planned_moves()[:args.limit]]
+        for start in range(0, len(moves), args.batch_size):
+            move_users(moves[start:start + args.batch_size], args.settle_seconds)
+    else:
+        if args.user_id is None or args.target not in shard_map.shards:
+            parser.error("move needs USER_ID and --to with a configured shard name")
+        move_users([(args.user_id, args.target)], args.settle_seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+import asyncio
+import heapq
+import json
+import logging
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Set
+from sqlalchemy import select, text
+from config import settings
+from db import async_engine, shard_map
+from metrics import REMINDERS_SCHEDULED, REMINDERS_SENT, REMINDER_DELAY
+from models import Task
+from jobs import job_queue, job_handler
+from leader import LeaderElection
+import task_events
+
+logger = logging.getLogger(__name__)
+
+# Postgres LISTEN/NOTIFY channel reminders are published on
+NOTIFY_CHANNEL = "task_reminders"
+LOAD_PAGE_SIZE = 5000
+# Wait before retrying reminders whose delivery jobs could not be queued
+EMIT_RETRY_SECONDS = 5.0
+
+
+@dataclass
+class Reminder:
+    task_id: uuid.UUID
+    user_id: uuid.UUID
+    title: str
+    due_date: datetime
+    fire_at: datetime
+    updated_at: datetime
+
+    def to_dict(self) -> dict:
+        return {
+            "task_id": str(self.task_id),
+            "user_id": str(self.user_id),
+            "title": self.title,
+            "due_date": self.due_date.isoformat(),
+        }
+
+
+ReminderListener = Callable[[Reminder], None]
+_listeners: List[ReminderListener] = []
+
+
+def subscribe(listener: ReminderListener) -> None:
+    """
+    Register `listener(reminder)` to run when a task's reminder fires
+    """
+    _listeners.append(listener)
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # Due dates parsed from ISO strings may carry an offset; the database stores naive UTC
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class ReminderScheduler:
+    """
+    Fires a reminder when an open task reaches its due date (minus `lead`).
+
+    Only reminders within the next `horizon` are held in memory, in a heap
+    ordered by fire time. The window is extended by a range read on the
+    partial index ix_tasks_due_date_open of every shard, so each task is loaded once and no
+    query scans the whole table. Task writes in this process arrive through
+    task_events and update the heap in place; writes made by other processes
+    are picked up by rereading the loaded window every `rescan` seconds, and
+    changes beyond the window when the window reaches them. Reminders for
+    tasks completed, deleted or rescheduled elsewhere are dropped by
+    deliver_reminder.
+    """
+
+    def __init__(self, lead: float, horizon: float, grace: float, rescan: float):
+        self.lead = timedelta(seconds=lead)
+        self.horizon = timedelta(seconds=horizon)
+        self.grace = timedelta(seconds=grace)
+        self.rescan = timedelta(seconds=rescan)
+        self._heap: List[tuple] = []
+        self._entries: Dict[uuid.UUID, Reminder] = {}
+        # Fire times of reminders sent within the grace period, so a rescan does not resend them
+        self._fired: Dict[uuid.UUID, datetime] = {}
+        self._rescan_at: Optional[datetime] = None
+        self._cancelled_while_loading: Set[uuid.UUID] = set()
+        self._loaded_until: Optional[datetime] = None
+        self._loading_until: Optional[datetime] = None
+        self._loading = False
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def scheduled_count(self) -> int:
+        return len(self._entries)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        with self._lock:
+            self._heap, self._entries, self._fired = [], {}, {}
+            self._loaded_until = None
+            self._rescan_at = None
+        REMINDERS_SCHEDULED.set(0)
+
+    def task_changed(self, kind: str, user_id: uuid.UUID, task: Optional[Task]) -> None:
+        """
+        task_events listener keeping the schedule in step with task writes
+        """
+        if task is None or (self._loaded_until is None and not self._loading):
+            return
+
+        now = datetime.utcnow()
+        wake = False
+        with self._lock:
+            if kind == task_events.DELETED or task.completed or task.due_date is None:
+                self._cancel(task.id)
+            else:
+                due_date = _naive_utc(task.due_date)
+                fire_at = due_date - self.lead
+                # While a window is loading, writes inside it are applied here too,
+                # since the load query may have read the rows before they were committed
+                window_end = self._loading_until if self._loading else self._loaded_until
+                if now < fire_at <= window_end:
+                    wake = not self._heap or fire_at < self._heap[0][0]
+                    self._schedule(Reminder(task.id, user_id, task.title, due_date, fire_at, task.updated_at))
+                else:
+                    # Already due, or beyond the window and loaded when the window gets there
+                    self._cancel(task.id)
+        REMINDERS_SCHEDULED.set(len(self._entries))
+
+        if wake and self._loop is not None:
+            # Listeners may run off the event loop thread
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _schedule(self, reminder: Reminder) -> None:
+        current = self._entries.get(reminder.task_id)
+        if current is not None and current.updated_at > reminder.updated_at:
+            return
+        if self._fired.get(reminder.task_id) == reminder.fire_at:
+            return
+        self._entries[reminder.task_id] = reminder
+        # Superseded heap items are skipped when popped
+        heapq.heappush(self._heap, (reminder.fire_at, reminder.task_id))
+
+    def _cancel(self, task_id: uuid.UUID) -> None:
+        self._entries.pop(task_id, None)
+        if self._loading:
+            self._cancelled_while_loading.add(task_id)
+
+    async def _load_window(self, now: datetime, rescan: bool = False) -> None:
+        """
+        Load open tasks whose reminders fall between the end of the loaded
+        window (with `rescan`, the start of the grace period) and now +
+        horizon, paging through the partial due-date index
+        """
+        rescan = rescan or self._loaded_until is None
+        start = now - self.grace if rescan else self._loaded_until
+        end = now + self.horizon
+        with self._lock:
+            self._loading = True
+            self._loading_until = end
+            self._cancelled_while_loading = set()
+
+        try:
+            for shard in shard_map.all():
+                await self._load_shard(shard, start, end)
+        finally:
+            with self._lock:
+                self._loading = False
+                self._cancelled_while_loading = set()
+
+        with self._lock:
+            self._loaded_until = end
+            if rescan:
+                self._rescan_at = now + self.rescan
+        REMINDERS_SCHEDULED.set(len(self._entries))
+
+    async def _load_shard(self, shard, start: datetime, end: datetime) -> None:
+        after = (start + self.lead, None)
+        async with shard.AsyncSession() as session:
+            while True:
+                query = (
+                    select(Task)
+                    .where(Task.completed == False)  # noqa: E712 - matches the partial index predicate
+                    .where(Task.due_date.is_not(None))
+                    .where(Task.due_date <= end + self.lead)
+                    .order_by(Task.due_date, Task.id)
+                    .limit(LOAD_PAGE_SIZE)
+                )
+                if after[1] is None:
+                    query = query.where(Task.due_date > after[0])
+                else:
+                    query = query.where(
+                        (Task.due_date > after[0]) | ((Task.due_date == after[0]) & (Task.id > after[1]))
+                    )
+                tasks = (await session.execute(query)).scalars().all()
+
+                with self._lock:
+                    for task in tasks:
+                        if task.id in self._cancelled_while_loading:
+                            continue
+                        due_date = _naive_utc(task.due_date)
+                        self._schedule(Reminder(
+                            task.id, task.user_id, task.title, due_date, due_date - self.lead, task.updated_at
+                        ))
+                if len(tasks) < LOAD_PAGE_SIZE:
+                    break
+                after = (tasks[-1].due_date, tasks[-1].id)
+                session.expunge_all()
+
+    def _pop_due(self, now: datetime) -> List[Reminder]:
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, task_id = heapq.heappop(self._heap)
+                reminder = self._entries.get(task_id)
+                if reminder is None or reminder.fire_at != fire_at:
+                    continue
+                del self._entries[task_id]
+                self._fired[task_id] = fire_at
+                due.append(reminder)
+            self._fired = {task_id: fire_at for task_id, fire_at in self._fired.items() if fire_at > now - self.grace}
+        REMINDERS_SCHEDULED.set(len(self._entries))
+        return due
+
+    def _restore(self, reminders: List[Reminder]) -> None:
+        # Put back reminders whose delivery could not be queued, so they fire again
+        with self._lock:
+            for reminder in reminders:
+                if self._fired.get(reminder.task_id) == reminder.fire_at:
+                    del self._fired[reminder.task_id]
+                self._schedule(reminder)
+        REMINDERS_SCHEDULED.set(len(self._entries))
+
+    async def _emit(self, reminders: List[Reminder], now: datetime) -> None:
+        # Delivery runs on the job queue so it is retried and kept off the scheduler loop
+        try:
+            await job_queue.enqueue_many("reminder.deliver", [reminder.to_dict() for reminder in reminders],
+                                         queue="reminders")
+        except BaseException:
+            self._restore(reminders)
+            raise
+
+        for reminder in reminders:
+            REMINDERS_SENT.inc()
+            REMINDER_DELAY.observe(max((now - reminder.fire_at).total_seconds(), 0.0))
+            for listener in list(_listeners):
+                try:
+                    listener(reminder)
+                except Exception:
+                    logger.exception("Reminder listener %r failed", listener)
+
+    async def _run(self) -> None:
+        refresh_every = self.horizon / 2
+        while True:
+            now = datetime.utcnow()
+            failed = False
+            try:
+                if self._loaded_until is None or now + refresh_every >= self._loaded_until:
+                    await self._load_window(now)
+                elif now >= self._rescan_at:
+                    await self._load_window(now, rescan=True)
+                reminders = self._pop_due(now)
+                if reminders:
+                    await self._emit(reminders, now)
+            except Exception:
+                logger.exception("Reminder scheduler iteration failed")
+                failed = True
+
+            # Sleep until the next reminder or window refresh, whichever is first
+            wake_at = (self._loaded_until or now + refresh_every) - refresh_every
+            with self._lock:
+                if self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+                if self._rescan_at is not None:
+                    wake_at = min(wake_at, self._rescan_at)
+            timeout = min(max((wake_at - datetime.utcnow()).total_seconds(), 0.05), refresh_every.total_seconds())
+            if failed:
+                # Restored reminders are already due; do not retry in a tight loop
+                timeout = max(timeout, EMIT_RETRY_SECONDS)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+reminder_scheduler = ReminderScheduler(
+    lead=settings.REMINDER_LEAD_SECONDS,
+    horizon=settings.REMINDER_HORIZON_SECONDS,
+    grace=settings.REMINDER_GRACE_SECONDS,
+    rescan=settings.REMINDER_RESCAN_SECONDS,
+)
+
+task_events.subscribe(reminder_scheduler.task_changed)
+
+# Every API process takes part; only the elected one runs the scheduler, so each reminder fires once
+reminder_election = LeaderElection(
+    "reminder_scheduler",
+    on_elected=reminder_scheduler.start,
+    on_deposed=reminder_scheduler.stop,
+    interval=settings.LEADER_ELECTION_INTERVAL_SECONDS,
+)
+
+
+@job_handler("reminder.deliver")
+async def deliver_reminder(payload: dict) -> None:
+    """
+    Publish a fired reminder to the notification channel, unless the task has
+    since been completed, deleted or given another due date
+    """
+    task_id, user_id = uuid.UUID(payload["task_id"]), uuid.UUID(payload["user_id"])
+    shard = await shard_map.ashard_for_user(user_id)
+    async with shard.AsyncSession() as session:
+        task = await session.get(Task, task_id)
+    if (task is None or task.user_id != user_id or task.completed or task.due_date is None
+            or _naive_utc(task.due_date).isoformat() != payload["due_date"]):
+        logger.info("Dropping reminder for task %s: no longer open with that due date", task_id)
+        return
+    logger.info("Reminder: task %s of user %s is due at %s", payload["task_id"], payload["user_id"], payload["due_date"])
+    if async_engine.dialect.name == "postgresql":
+        async with async_engine.begin() as conn:
+            await conn.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": NOTIFY_CHANNEL, "payload": json.dumps(payload)},
+            )
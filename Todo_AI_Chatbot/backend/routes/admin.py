@@ -0,0 +1,121 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+from sqlmodel import Session, select
+from sqlalchemy import func
+from auth import require_admin
+from models import TokenUsage, UserUsage, DailyUsage
+from db import get_session
+from usage_ledger import usage_ledger, COUNTERS
+from profiler import profiler, render_collapsed, ProfilerBusy
+from config import settings
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+import asyncio
+import os
+import uuid
+
+# Operator endpoints, authenticated with ADMIN_TOKEN instead of a user JWT
+router = APIRouter(prefix="/api/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+def usage_range(start: Optional[date], end: Optional[date]) -> tuple[date, date]:
+    """
+    Inclusive UTC day range, defaulting to the last 7 days
+    """
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=6)
+    if start > end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="start must not be after end"
+        )
+    return start, end
+
+
+def _sums():
+    return [func.sum(getattr(TokenUsage, name)).label(name) for name in COUNTERS]
+
+
+def _totals(row) -> dict:
+    values = {name: int(getattr(row, name) or 0) for name in COUNTERS}
+    values["total_tokens"] = values["prompt_tokens"] + values["completion_tokens"]
+    return values
+
+
+def top_users(session: Session, start: date, end: date, limit: int) -> List[UserUsage]:
+    tokens = func.sum(TokenUsage.prompt_tokens + TokenUsage.completion_tokens)
+    rows = session.exec(
+        select(TokenUsage.user_id, *_sums())
+        .where(TokenUsage.day >= start, TokenUsage.day <= end)
+        .group_by(TokenUsage.user_id)
+        .order_by(tokens.desc())
+        .limit(limit)
+    ).all()
+    return [UserUsage(user_id=row.user_id, **_totals(row)) for row in rows]
+
+
+def user_days(session: Session, user_id: uuid.UUID, start: date, end: date) -> List[DailyUsage]:
+    rows = session.exec(
+        select(TokenUsage)
+        .where(TokenUsage.user_id == user_id, TokenUsage.day >= start, TokenUsage.day <= end)
+        .order_by(TokenUsage.day.desc(), TokenUsage.model)
+    ).all()
+    return [DailyUsage(day=row.day, model=row.model, **_totals(row)) for row in rows]
+
+
+@router.get("/usage", response_model=List[UserUsage])
+async def read_usage(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(default=50, ge=1, le=500),
+    session: Session = Depends(get_session)
+):
+    """
+    Users with the most tokens used between `start` and `end`
+    """
+    start, end = usage_range(start, end)
+    # Include completions this process has not written yet
+    await usage_ledger.flush()
+    # The aggregate runs on a sync session, so keep it off the event loop
+    return await asyncio.to_thread(top_users, session, start, end, limit)
+
+
+@router.get("/usage/{user_id}", response_model=List[DailyUsage])
+async def read_user_usage(
+    user_id: uuid.UUID,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    session: Session = Depends(get_session)
+):
+    """
+    One user's usage per day and model, newest day first
+    """
+    start, end = usage_range(start, end)
+    await usage_ledger.flush()
+    return await asyncio.to_thread(user_days, session, user_id, start, end)
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def read_profile(
+    seconds: float = Query(default=10.0, gt=0),
+    interval_ms: float = Query(default=settings.PROFILER_INTERVAL_MS, ge=1, le=1000),
+    include_idle: bool = False
+):
+    """
+    Sample the stacks of all threads in the worker serving this request for
+    `seconds`, as collapsed stacks for flamegraph.pl or speedscope
+    """
+    if seconds > settings.PROFILER_MAX_SECONDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"seconds must be at most {settings.PROFILER_MAX_SECONDS:g}"
+        )
+    try:
+        # The sampler runs off the loop, so the loop's own work shows up in the profile
+        stacks, samples = await asyncio.to_thread(profiler.sample, seconds, interval_ms / 1000, include_idle)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return PlainTextResponse(
+        render_collapsed(stacks),
+        headers={"X-Profile-Samples": str(samples), "X-Profile-Pid": str(os.getpid())},
+    )
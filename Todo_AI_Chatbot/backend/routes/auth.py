@@ -5,8 +5,8 @@ from datetime import datetime, timedelta
 import jwt
 import uuid
 from sqlmodel import Session, select
-from db import get_session
-from models import User
+from db import get_session, read_session, read_router, shard_map
+from models import TaskCounters, User, UserDirectory
 from passlib.context import CryptContext
 from config import settings
 
@@ -53,13 +53,24 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 
 @router.post("/sign-in", response_model=AuthResponse)
-async def sign_in(request: SignInRequest, session: Session = Depends(get_session)):
-    # Find user by email
+def sign_in(request: SignInRequest, session: Session = Depends(get_session)):
+    # Find user by email, on a replica when there is one
     statement = select(User).where(User.email == request.email)
-    result = session.exec(statement)
-    user = result.first()
+    if shard_map.enabled:
+        # The directory says which shard holds the user
+        entry = shard_map.find_by_email(request.email)
+        user = None
+        if entry is not None:
+            with shard_map.shards[entry.shard].SyncSession() as shard_session:
+                user = shard_session.exec(statement).first()
+    else:
+        with read_session() as replica_session:
+            user = replica_session.exec(statement).first()
+        if not user and read_router.replicas:
+            # A user who just signed up may not have replicated yet
+            user = session.exec(statement).first()
     
-    if not user or not verify_password(request.password, user.hashed_password):
+    if not user or not verify_password(request.password, user.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -79,17 +90,18 @@ async def sign_in(request: SignInRequest, session: Session = Depends(get_session
         user={
             "id": str(user.id),
             "email": user.email,
-            "name": user.name
+            "name": user.first_name
         }
     )
 
 
 @router.post("/sign-up", response_model=AuthResponse)
-async def sign_up(request: SignUpRequest, session: Session = Depends(get_session)):
-    # Check if user already exists
-    statement = select(User).where(User.email == request.email)
-    result = session.exec(statement)
-    existing_user = result.first()
+def sign_up(request: SignUpRequest, session: Session = Depends(get_session)):
+    # Check if user already exists (the directory holds every email when sharded)
+    if shard_map.enabled:
+        existing_user = shard_map.find_by_email(request.email)
+    else:
+        existing_user = session.exec(select(User).where(User.email == request.email)).first()
     
     if existing_user:
         raise HTTPException(
@@ -104,13 +116,30 @@ async def sign_up(request: SignUpRequest, session: Session = Depends(get_session
     user = User(
         id=uuid.uuid4(),
         email=request.email,
-        hashed_password=hashed_password,
-        name=request.name or request.email.split('@')[0]  # Use part of email as name if not provided
+        password_hash=hashed_password,
+        first_name=request.name or request.email.split('@')[0]  # Use part of email as name if not provided
     )
     
-    session.add(user)
-    session.commit()
-    session.refresh(user)
+    if shard_map.enabled:
+        # Claim the email in the directory first; its unique index rejects concurrent sign-ups
+        shard = shard_map.place(user.id)
+        session.add(UserDirectory(user_id=user.id, email=user.email, shard=shard.name))
+        session.commit()
+        try:
+            with shard.SyncSession() as shard_session:
+                shard_session.add(user)
+                shard_session.add(TaskCounters(user_id=user.id))
+                shard_session.commit()
+                shard_session.refresh(user)
+        except Exception:
+            session.delete(session.get(UserDirectory, user.id))
+            session.commit()
+            raise
+    else:
+        session.add(user)
+        session.add(TaskCounters(user_id=user.id))
+        session.commit()
+        session.refresh(user)
     
     # Create access token
     access_token_expires = timedelta(hours=24)  # 24 hours
@@ -125,13 +154,13 @@ async def sign_up(request: SignUpRequest, session: Session = Depends(get_session
         user={
             "id": str(user.id),
             "email": user.email,
-            "name": user.name
+            "name": user.first_name
         }
     )
 
 
 @router.get("/verify-token")
-async def verify_token(authorization: str = None):
+def verify_token(authorization: str = None):
     """Verify the JWT token and return user info"""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(
@@ -153,13 +182,8 @@ async def verify_token(authorization: str = None):
                 headers={"WWW-Authenticate": "Bearer"},
             )
         
-        # Verify user exists in database
-        # Using a new session for this lookup
-        from db import sync_engine
-        from sqlalchemy.orm import sessionmaker
-        
-        SyncSession = sessionmaker(bind=sync_engine, autocommit=False, autoflush=False)
-        with SyncSession() as session:
+        # Verify user exists in database (on the user's shard)
+        with read_session(uuid.UUID(user_id)) as session:
             statement = select(User).where(User.id == uuid.UUID(user_id))
             result = session.exec(statement)
             user = result.first()
@@ -174,7 +198,7 @@ async def verify_token(authorization: str = None):
         return {
             "id": str(user.id),
             "email": user.email,
-            "name": user.name
+            "name": user.first_name
         }
     except jwt.ExpiredSignatureError:
         raise HTTPException(
@@ -9,64 +9,131 @@ from models import (
     ConversationResponse, 
     MessageResponse
 )
-from db import get_session
-from mcp_tools import MCPTools
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_user_session, get_async_user_session, get_async_read_session, read_router
+from mcp_tools import AsyncMCPTools, UnitOfWorkRolledBack
 from ai_agents import AIChatAgent
+from rate_limit import LLMQuotaExceeded
+from llm_endpoints import LLMUnavailable
+from usage_ledger import TokenBudgetExceeded
+from sharding import UserMoving
+from metrics import CHAT_ROUTES
+import asyncio
+import math
+from message_writer import MessageQueueFull, message_writer
+from message_store import rehydrate_conversation
+from routes.conversations import get_user_conversation
 import uuid
 
 router = APIRouter()
 
 
+def open_conversation(session: Session, user_id: uuid.UUID, conversation_id: uuid.UUID | None) -> Conversation:
+    """
+    The requested conversation, else the user's most recent one, else a new one
+    """
+    if conversation_id:
+        conversation = get_user_conversation(session, user_id, conversation_id)
+    else:
+        conversation_query = (
+            select(Conversation)
+            .where(Conversation.user_id == user_id)
+            .order_by(Conversation.updated_at.desc())
+            .limit(1)
+        )
+        conversation = session.exec(conversation_query).first()
+    
+    if not conversation:
+        # Create a new conversation
+        conversation = Conversation(user_id=user_id, title=f"Conversation with {user_id}")
+        session.add(conversation)
+        session.commit()
+        session.refresh(conversation)
+    else:
+        # Bring archived history back before appending to it
+        rehydrate_conversation(session, conversation)
+    return conversation
+
+
 @router.post("/chat", response_model=ChatResponse)
 async def chat(
     user_id: uuid.UUID,
     chat_request: ChatRequest,
-    session: Session = Depends(get_session)
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_user_session),
+    async_session: AsyncSession = Depends(get_async_user_session),
+    async_read_session: AsyncSession = Depends(get_async_read_session)
 ):
     # Verify that the user_id in the path matches the authenticated user
-    current_user_id = get_current_user_id()
     if current_user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not authorized to chat for this user"
         )
     
-    # Find or create a conversation for this user
-    conversation_query = select(Conversation).where(Conversation.user_id == user_id)
-    conversation = session.exec(conversation_query).first()
+    # Don't start a turn whose messages could not be queued
+    try:
+        await message_writer.wait_for_room()
+    except MessageQueueFull as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
     
-    if not conversation:
-        # Create a new conversation
-        conversation = Conversation(user_id=user_id, title=f"Conversation with {user_id}")
-        session.add(conversation)
-        session.commit()
-        session.refresh(conversation)
+    # Sync session work runs off the event loop so a lock wait cannot stall other requests
+    conversation = await asyncio.to_thread(open_conversation, session, user_id, chat_request.conversation_id)
     
-    # Save the user's message
+    # Timestamped now so it sorts before the reply, but only queued once the
+    # turn has a reply: a rejected turn (429/503) leaves no orphan user message
     user_message = Message(
         conversation_id=conversation.id,
         role="user",
         content=chat_request.message
     )
-    session.add(user_message)
-    session.commit()
-    
-    # Initialize MCP tools for this user
-    mcp_tools = MCPTools(user_id=user_id, db_session=session)
-    
-    # Initialize the AI agent with MCP tools
-    ai_agent = AIChatAgent(tools=mcp_tools)
     
-    # Get response from AI agent
-    ai_response = await ai_agent.process_message(chat_request.message)
+    # Get response from AI agent. Task writes made by its tools form one unit
+    # of work that is committed when the turn completes, or rolled back.
+    try:
+        async with AsyncMCPTools(user_id=user_id, db_session=async_session, read_session=async_read_session) as mcp_tools:
+            ai_agent = AIChatAgent(tools=mcp_tools)
+            ai_response = await ai_agent.process_message(chat_request.message)
+    except (LLMQuotaExceeded, TokenBudgetExceeded) as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    except LLMUnavailable as e:
+        # The turn's task writes were rolled back, so the client can simply retry
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    except UnitOfWorkRolledBack as e:
+        # The reply may announce writes that were just discarded, so it is not sent
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    except UserMoving as e:
+        # The user started moving shards during the turn and its writes were rolled back
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
     
-    # Save the AI's response
+    # Queue both sides of the turn; the writer also bumps the conversation's updated_at
     ai_message = Message(
         conversation_id=conversation.id,
         role="assistant",
-        content=ai_response
+        content=ai_response,
+        route=ai_agent.last_route,
+        usage=ai_agent.usage if ai_agent.usage["completions"] else None
     )
-    session.add(ai_message)
-    session.commit()
+    CHAT_ROUTES.labels(ai_agent.last_route).inc()
+    message_writer.enqueue(user_message, user_id)
+    message_writer.enqueue(ai_message, user_id)
+    # The history now has writes a replica may not have yet
+    read_router.mark_write(user_id)
     
     return ChatResponse(response=ai_response, conversation_id=conversation.id)
\ No newline at end of file
@@ -0,0 +1,156 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlmodel import Session, select
+from sqlalchemy import and_, or_
+from auth import get_current_user_id
+from models import Conversation, Message, ConversationPage, MessagePage
+from db import get_read_session, user_write_session
+from message_store import rehydrate_conversation
+from datetime import datetime
+import base64
+import uuid
+
+router = APIRouter()
+
+
+def encode_cursor(timestamp: datetime, row_id: uuid.UUID) -> str:
+    """
+    Encode a (timestamp, id) keyset position as an opaque cursor string
+    """
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    """
+    Decode a cursor produced by encode_cursor
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, row_id = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), uuid.UUID(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+def get_user_conversation(session: Session, user_id: uuid.UUID, conversation_id: uuid.UUID) -> Conversation:
+    """
+    Fetch a conversation owned by the user or raise 404
+    """
+    conversation = session.exec(
+        select(Conversation).where(
+            Conversation.id == conversation_id,
+            Conversation.user_id == user_id
+        )
+    ).first()
+
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    return conversation
+
+
+def message_page(session: Session, conversation: Conversation, limit: int, before: str | None) -> MessagePage:
+    """
+    The newest `limit` messages of `conversation` older than the `before` cursor
+    """
+    # The created_at lower bound lets Postgres prune partitions older than the conversation
+    query = select(Message).where(
+        Message.conversation_id == conversation.id,
+        Message.timestamp >= conversation.created_at
+    )
+
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        query = query.where(
+            or_(
+                Message.timestamp < timestamp,
+                and_(Message.timestamp == timestamp, Message.id < message_id)
+            )
+        )
+
+    query = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1)
+    messages = session.exec(query).all()
+
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        oldest = messages[-1]
+        next_cursor = encode_cursor(oldest.timestamp, oldest.id)
+
+    return MessagePage(messages=list(reversed(messages)), next_cursor=next_cursor)
+
+
+@router.get("/conversations", response_model=ConversationPage)
+def list_conversations(
+    user_id: uuid.UUID,
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: str | None = None,
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_read_session)
+):
+    # Verify that the user_id in the path matches the authenticated user
+    if current_user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to view conversations for this user"
+        )
+
+    # Most recently active first, keyset on (updated_at, id)
+    query = select(Conversation).where(Conversation.user_id == user_id)
+
+    if cursor:
+        updated_at, conversation_id = decode_cursor(cursor)
+        query = query.where(
+            or_(
+                Conversation.updated_at < updated_at,
+                and_(Conversation.updated_at == updated_at, Conversation.id < conversation_id)
+            )
+        )
+
+    query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(limit + 1)
+    conversations = session.exec(query).all()
+
+    next_cursor = None
+    if len(conversations) > limit:
+        conversations = conversations[:limit]
+        last = conversations[-1]
+        next_cursor = encode_cursor(last.updated_at, last.id)
+
+    return ConversationPage(conversations=conversations, next_cursor=next_cursor)
+
+
+@router.get("/conversations/{conversation_id}/messages", response_model=MessagePage)
+def read_messages(
+    user_id: uuid.UUID,
+    conversation_id: uuid.UUID,
+    limit: int = Query(default=50, ge=1, le=200),
+    before: str | None = None,
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_read_session)
+):
+    """
+    Page backwards through a conversation's history.
+
+    Returns the newest `limit` messages older than the `before` cursor, in
+    chronological order. Pass `next_cursor` as `before` to load older messages.
+    """
+    # Verify that the user_id in the path matches the authenticated user
+    if current_user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to view conversations for this user"
+        )
+
+    conversation = get_user_conversation(session, user_id, conversation_id)
+    if conversation.archived_at is not None:
+        # Restoring history writes, so it runs on the user's shard (503 while the user
+        # is being moved) and the page is read from there
+        with user_write_session(user_id) as primary_session:
+            conversation = get_user_conversation(primary_session, user_id, conversation_id)
+            rehydrate_conversation(primary_session, conversation)
+            return message_page(primary_session, conversation, limit, before)
+    return message_page(session, conversation, limit, before)
+
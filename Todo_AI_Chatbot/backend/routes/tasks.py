@@ -2,8 +2,10 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlmodel import Session, select
 from typing import List
 from auth import get_current_user_id
-from models import Task, TaskCreate, TaskUpdate, TaskResponse
-from db import get_session
+from models import Task, TaskCounters, TaskCreate, TaskUpdate, TaskResponse, TaskStats
+from db import get_user_session, get_read_session, shard_map
+import task_counters
+import task_events
 import uuid
 from datetime import datetime
 
@@ -11,13 +13,13 @@ router = APIRouter()
 
 
 @router.post("/tasks", response_model=TaskResponse)
-async def create_task(
+def create_task(
     user_id: uuid.UUID,
     task: TaskCreate,
-    session: Session = Depends(get_session)
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_user_session)
 ):
     # Verify that the user_id in the path matches the authenticated user
-    current_user_id = get_current_user_id()
     if current_user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -33,22 +35,24 @@ async def create_task(
         user_id=user_id
     )
     session.add(db_task)
+    task_counters.record(session, user_id, task_counters.Delta().add(None, task_counters.snapshot(db_task)))
     session.commit()
     session.refresh(db_task)
+    task_events.task_changed(task_events.CREATED, user_id, db_task)
     
     return db_task
 
 
 @router.get("/tasks", response_model=List[TaskResponse])
-async def read_tasks(
+def read_tasks(
     user_id: uuid.UUID,
     completed: bool = None,
     limit: int = 100,
     offset: int = 0,
-    session: Session = Depends(get_session)
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_read_session)
 ):
     # Verify that the user_id in the path matches the authenticated user
-    current_user_id = get_current_user_id()
     if current_user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -66,14 +70,37 @@ async def read_tasks(
     return tasks
 
 
+@router.get("/tasks/stats", response_model=TaskStats)
+def read_task_stats(
+    user_id: uuid.UUID,
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_read_session)
+):
+    # Verify that the user_id in the path matches the authenticated user
+    if current_user_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not authorized to view tasks for this user"
+        )
+    
+    counters = session.get(TaskCounters, user_id)
+    if counters is None:
+        # Tasks created before the counters existed are counted once, on the primary
+        with shard_map.shard_for_user(user_id).SyncSession() as primary_session:
+            counters, _ = task_counters.rebuild(primary_session, user_id)
+            primary_session.commit()
+    
+    return task_counters.stats(counters)
+
+
 @router.get("/tasks/{task_id}", response_model=TaskResponse)
-async def read_task(
+def read_task(
     user_id: uuid.UUID,
     task_id: uuid.UUID,
-    session: Session = Depends(get_session)
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_read_session)
 ):
     # Verify that the user_id in the path matches the authenticated user
-    current_user_id = get_current_user_id()
     if current_user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -91,14 +118,14 @@ async def read_task(
 
 
 @router.put("/tasks/{task_id}", response_model=TaskResponse)
-async def update_task(
+def update_task(
     user_id: uuid.UUID,
     task_id: uuid.UUID,
     task_update: TaskUpdate,
-    session: Session = Depends(get_session)
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_user_session)
 ):
     # Verify that the user_id in the path matches the authenticated user
-    current_user_id = get_current_user_id()
     if current_user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -113,26 +140,29 @@ async def update_task(
         raise HTTPException(status_code=404, detail="Task not found")
     
     # Update task fields
+    before = task_counters.snapshot(db_task)
     update_data = task_update.model_dump(exclude_unset=True)
     for field, value in update_data.items():
         setattr(db_task, field, value)
     
     db_task.updated_at = datetime.utcnow()
     session.add(db_task)
+    task_counters.record(session, user_id, task_counters.Delta().add(before, task_counters.snapshot(db_task)))
     session.commit()
     session.refresh(db_task)
+    task_events.task_changed(task_events.UPDATED, user_id, db_task)
     
     return db_task
 
 
 @router.delete("/tasks/{task_id}")
-async def delete_task(
+def delete_task(
     user_id: uuid.UUID,
     task_id: uuid.UUID,
-    session: Session = Depends(get_session)
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_user_session)
 ):
     # Verify that the user_id in the path matches the authenticated user
-    current_user_id = get_current_user_id()
     if current_user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -147,19 +177,21 @@ async def delete_task(
         raise HTTPException(status_code=404, detail="Task not found")
     
     session.delete(task)
+    task_counters.record(session, user_id, task_counters.Delta().add(task_counters.snapshot(task), None))
     session.commit()
+    task_events.task_changed(task_events.DELETED, user_id, task)
     
     return {"message": "Task deleted successfully"}
 
 
 @router.patch("/tasks/{task_id}/complete", response_model=TaskResponse)
-async def complete_task(
+def complete_task(
     user_id: uuid.UUID,
     task_id: uuid.UUID,
-    session: Session = Depends(get_session)
+    current_user_id: uuid.UUID = Depends(get_current_user_id),
+    session: Session = Depends(get_user_session)
 ):
     # Verify that the user_id in the path matches the authenticated user
-    current_user_id = get_current_user_id()
     if current_user_id != user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -173,10 +205,13 @@ async def complete_task(
     if not db_task:
         raise HTTPException(status_code=404, detail="Task not found")
     
+    before = task_counters.snapshot(db_task)
     db_task.completed = True
     db_task.updated_at = datetime.utcnow()
     session.add(db_task)
+    task_counters.record(session, user_id, task_counters.Delta().add(before, task_counters.snapshot(db_task)))
     session.commit()
     session.refresh(db_task)
+    task_events.task_changed(task_events.UPDATED, user_id, db_task)
     
     return db_task
\ No newline at end of file
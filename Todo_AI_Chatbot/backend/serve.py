@@ -0,0 +1,137 @@
+"""
+Production server: gunicorn managing uvicorn workers.
+
+    python serve.py --workers 4 --bind 0.0.0.0:8000
+
+The app is imported once in the master (preload) and forked into
+WEB_WORKERS workers. Each worker sizes its connection pools to its share of
+DB_CONNECTION_BUDGET and warms them before it accepts connections; GET /ready
+returns 200 from then on, while GET /health only reports that the process is
+alive.
+
+On SIGTERM the listening socket is closed, in-flight requests and streamed
+responses get SHUTDOWN_DRAIN_SECONDS to finish, and each worker then flushes
+queued chat messages and token usage before exiting.
+
+Background jobs can run in separate `python worker.py` processes; their
+connections are not part of DB_CONNECTION_BUDGET.
+
+Workers share nothing in memory. The reminder scheduler and message
+archival run in one elected process (leader.py), and a cached chat turn is
+checked against fresh tool results before it is served, so those are safe
+with any number of workers; the LLM concurrency caps and the chat cache are
+per worker. With more than one worker the server refuses to start while
+state that must be shared is kept per worker:
+
+- rate limits without RATE_LIMIT_REDIS_URL, which would allow WEB_WORKERS
+  times the configured rate;
+- idempotency keys without IDEMPOTENCY_REDIS_URL, which a retry landing on
+  another worker would not find;
+- read-your-writes pins with DATABASE_REPLICA_URLS, which only cover reads
+  served by the worker that took the write.
+
+ALLOW_PER_WORKER_STATE=true starts anyway and logs each of these.
+"""
+import argparse
+import logging
+import math
+import os
+from typing import List
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker
+
+logger = logging.getLogger(__name__)
+
+# Time left after the drain for lifespan shutdown (flushing writers) before gunicorn kills the worker
+SHUTDOWN_FLUSH_SECONDS = 15
+
+
+class Worker(UvicornWorker):
+    """
+    Uvicorn worker that lets open requests finish for SHUTDOWN_DRAIN_SECONDS on shutdown
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        from config import settings
+        self.config.timeout_graceful_shutdown = settings.SHUTDOWN_DRAIN_SECONDS
+
+
+def per_worker_state(settings) -> List[str]:
+    """
+    Settings that keep state in each worker when it has to be shared between them
+    """
+    problems = []
+    if settings.RATE_LIMIT_ENABLED and not settings.RATE_LIMIT_REDIS_URL:
+        problems.append("rate limits are per worker (set RATE_LIMIT_REDIS_URL or RATE_LIMIT_ENABLED=false)")
+    if settings.IDEMPOTENCY_ENABLED and not settings.IDEMPOTENCY_REDIS_URL:
+        problems.append(
+            "idempotency keys are per worker (set IDEMPOTENCY_REDIS_URL or IDEMPOTENCY_ENABLED=false)"
+        )
+    if settings.DATABASE_REPLICA_URLS.strip() and settings.READ_YOUR_WRITES_SECONDS > 0:
+        problems.append(
+            "read-your-writes pins are per worker, so users may not see their writes on replicas "
+            "(unset DATABASE_REPLICA_URLS)"
+        )
+    return problems
+
+
+def post_fork(server, worker) -> None:
+    from db import reset_pools_after_fork
+    reset_pools_after_fork()
+
+
+class Server(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from main import app
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with multiple workers")
+    parser.add_argument("--bind", default=os.environ.get("BIND", "0.0.0.0:8000"))
+    parser.add_argument("--workers", type=int, help="Worker processes (default: WEB_WORKERS)")
+    args = parser.parse_args()
+
+    # Settings are read when the app is imported, which pool sizing depends on
+    if args.workers is not None:
+        os.environ["WEB_WORKERS"] = str(args.workers)
+    from config import settings
+
+    logging.basicConfig(level=logging.INFO)
+    if settings.DB_CONNECTION_BUDGET and settings.DB_CONNECTION_BUDGET < 2 * settings.WEB_WORKERS:
+        logger.warning(
+            "DB_CONNECTION_BUDGET=%d is less than two connections per worker; each engine still gets one",
+            settings.DB_CONNECTION_BUDGET,
+        )
+    if settings.WEB_WORKERS > 1:
+        problems = per_worker_state(settings)
+        if problems and not settings.ALLOW_PER_WORKER_STATE:
+            raise SystemExit(
+                f"Refusing to start {settings.WEB_WORKERS} workers: " + "; ".join(problems)
+                + ". Set ALLOW_PER_WORKER_STATE=true to start anyway."
+            )
+        for problem in problems:
+            logger.warning("With %d workers, %s", settings.WEB_WORKERS, problem)
+
+    Server({
+        "bind": args.bind,
+        "workers": settings.WEB_WORKERS,
+        "worker_class": Worker,
+        "preload_app": True,
+        "post_fork": post_fork,
+        "graceful_timeout": math.ceil(settings.SHUTDOWN_DRAIN_SECONDS) + SHUTDOWN_FLUSH_SECONDS,
+        "keepalive": 5,
+    }).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import bisect
+import hashlib
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import Session, select
+from models import UserDirectory
+
+DEFAULT_SHARD = "default"
+
+# Directory entry states
+ACTIVE = "active"
+MOVING = "moving"
+
+
+class UserMoving(Exception):
+    """
+    Raised when writing for a user whom rebalance.py is moving to another shard
+    """
+
+    def __init__(self):
+        super().__init__("Your data is being moved, please retry shortly")
+        self.retry_after = 5
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+def parse_shard_urls(value: str) -> List[Tuple[str, str]]:
+    """
+    Parse DATABASE_SHARD_URLS ("shard0=postgresql://...,shard1=postgresql://...")
+    """
+    shards = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, separator, url = item.strip().partition("=")
+        if not separator or not name or not url:
+            raise ValueError(f"Invalid shard entry {item!r}, expected name=url")
+        shards.append((name.strip(), url.strip()))
+    return shards
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes. Adding a shard moves only about
+    1/N of the keys, which is what rebalance.py then migrates.
+    """
+
+    def __init__(self, names: List[str], vnodes: int):
+        points = sorted((_hash(f"{name}#{index}"), name) for name in names for index in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._names[index]
+
+
+class Shard:
+    """
+    One database holding a subset of users, with its own connection pools
+    """
+
+    def __init__(self, name: str, sync_engine: Engine, async_engine: AsyncEngine):
+        self.name = name
+        self.sync_engine = sync_engine
+        self.async_engine = async_engine
+        self.SyncSession = sessionmaker(bind=sync_engine, class_=Session, autocommit=False, autoflush=False)
+        self.AsyncSession = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+class ShardMap:
+    """
+    Maps users to shards.
+
+    New users are placed by consistent hashing of their id. The user_directory
+    table on the main database is authoritative afterwards, so a user keeps
+    their shard until rebalance.py moves them. Directory entries are cached
+    for `cache_seconds`. With sharding disabled every user is on the default
+    shard and the directory is not consulted.
+    """
+
+    def __init__(self, shards: List[Shard], directory: sessionmaker, async_directory: async_sessionmaker,
+                 vnodes: int, cache_seconds: float, enabled: bool):
+        self.shards: Dict[str, Shard] = {shard.name: shard for shard in shards}
+        self.ring = HashRing(list(self.shards), vnodes)
+        self.directory = directory
+        self.async_directory = async_directory
+        self.cache_seconds = cache_seconds
+        self.enabled = enabled
+        self._cache: Dict[uuid.UUID, Tuple[str, str, float]] = {}
+        self._lock = threading.Lock()
+
+    def all(self) -> List[Shard]:
+        return list(self.shards.values())
+
+    def place(self, user_id: uuid.UUID) -> Shard:
+        """
+        Shard a user belongs on according to the hash ring
+        """
+        return self.shards[self.ring.node_for(str(user_id))]
+
+    def _cached(self, user_id: uuid.UUID) -> Optional[Tuple[str, str]]:
+        entry = self._cache.get(user_id)
+        if entry is None or entry[2] < time.monotonic():
+            return None
+        return entry[0], entry[1]
+
+    def _remember(self, user_id: uuid.UUID, entry: Optional[UserDirectory]) -> Tuple[str, str]:
+        if entry is None:
+            # Not registered (yet): the ring placement is where sign-up puts them
+            shard, status = self.place(user_id).name, ACTIVE
+        else:
+            shard, status = entry.shard, entry.status
+        with self._lock:
+            self._cache[user_id] = (shard, status, time.monotonic() + self.cache_seconds)
+            if len(self._cache) > 100000:
+                now = time.monotonic()
+                self._cache = {key: value for key, value in self._cache.items() if value[2] > now}
+        return shard, status
+
+    def lookup(self, user_id: uuid.UUID) -> Tuple[str, str]:
+        """
+        (shard name, status) of a user
+        """
+        if not self.enabled:
+            return DEFAULT_SHARD, ACTIVE
+        cached = self._cached(user_id)
+        if cached is not None:
+            return cached
+        with self.directory() as session:
+            return self._remember(user_id, session.get(UserDirectory, user_id))
+
+    async def alookup(self, user_id: uuid.UUID) -> Tuple[str, str]:
+        if not self.enabled:
+            return DEFAULT_SHARD, ACTIVE
+        cached = self._cached(user_id)
+        if cached is not None:
+            return cached
+        async with self.async_directory() as session:
+            return self._remember(user_id, await session.get(UserDirectory, user_id))
+
+    def shard_for_user(self, user_id: uuid.UUID) -> Shard:
+        return self.shards[self.lookup(user_id)[0]]
+
+    async def ashard_for_user(self, user_id: uuid.UUID) -> Shard:
+        return self.shards[(await self.alookup(user_id))[0]]
+
+    def forget(self, user_id: uuid.UUID) -> None:
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def find_by_email(self, email: str) -> Optional[UserDirectory]:
+        with self.directory() as session:
+            return session.exec(select(UserDirectory).where(UserDirectory.email == email)).first()
@@ -0,0 +1,185 @@
+"""
+Per-user task counters.
+
+Every task write applies a Delta to the user's task_counters row in the same
+transaction, so statistics are read from one row instead of counting tasks.
+Open tasks with a due date are counted per due day (UTC), which is enough to
+answer "overdue" (due on an earlier day) and "due today".
+
+    before = task_counters.snapshot(task)
+    task.completed = True
+    task_counters.record(session, user_id, task_counters.Delta().add(before, task_counters.snapshot(task)))
+    session.commit()
+"""
+import uuid
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlmodel import Session, select
+from models import Task, TaskCounters
+
+# What one task adds to the counters: (completed, due day if open), or None for no task
+Contribution = Optional[Tuple[bool, Optional[str]]]
+
+
+def _due_day(due_date: Optional[datetime]) -> Optional[str]:
+    if due_date is None:
+        return None
+    if due_date.tzinfo is not None:
+        due_date = due_date.astimezone(timezone.utc)
+    return due_date.date().isoformat()
+
+
+def snapshot(task: Optional[Task]) -> Contribution:
+    """
+    What `task` currently contributes; take one before and one after a change
+    """
+    if task is None:
+        return None
+    completed = bool(task.completed)
+    return completed, None if completed else _due_day(task.due_date)
+
+
+class Delta:
+    """
+    Accumulated change to one user's counters
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.completed = 0
+        self.due_days: Dict[str, int] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.total or self.completed or any(self.due_days.values()))
+
+    def add(self, before: Contribution, after: Contribution) -> "Delta":
+        for contribution, sign in ((before, -1), (after, 1)):
+            if contribution is None:
+                continue
+            completed, due_day = contribution
+            self.total += sign
+            self.completed += sign * completed
+            if due_day is not None:
+                self.due_days[due_day] = self.due_days.get(due_day, 0) + sign
+        return self
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[bool, Optional[datetime]]]) -> "Delta":
+        """
+        Delta that creates counters for the (completed, due_date) rows of a task scan
+        """
+        delta = cls()
+        for completed, due_date in rows:
+            delta.add(None, (bool(completed), None if completed else _due_day(due_date)))
+        return delta
+
+    def applied(self, total: int, completed: int, due_days: Dict[str, int]) -> Tuple[int, int, Dict[str, int]]:
+        due_days = dict(due_days)
+        for day, change in self.due_days.items():
+            count = due_days.get(day, 0) + change
+            if count > 0:
+                due_days[day] = count
+            else:
+                due_days.pop(day, None)
+        return total + self.total, completed + self.completed, due_days
+
+    def apply(self, counters: TaskCounters) -> None:
+        # Assigning a new dict lets SQLAlchemy see the JSON column change
+        counters.total, counters.completed, counters.open_due_days = self.applied(
+            counters.total, counters.completed, counters.open_due_days or {}
+        )
+        counters.updated_at = datetime.utcnow()
+
+
+def task_rows(user_id: uuid.UUID):
+    return select(Task.completed, Task.due_date).where(Task.user_id == user_id)
+
+
+def _counted(user_id: uuid.UUID, rows) -> TaskCounters:
+    counters = TaskCounters(user_id=user_id)
+    Delta.from_rows(rows).apply(counters)
+    return counters
+
+
+def rebuild(session: Session, user_id: uuid.UUID) -> Tuple[TaskCounters, bool]:
+    """
+    Create the counters row of a user whose tasks predate it by counting their
+    tasks once. Returns (row, created); created is False when a concurrent
+    write created the row first.
+    """
+    counters = _counted(user_id, session.exec(task_rows(user_id)).all())
+    try:
+        with session.begin_nested():
+            session.add(counters)
+        return counters, True
+    except IntegrityError:
+        return session.get(TaskCounters, user_id, with_for_update=True, populate_existing=True), False
+
+
+async def arebuild(session: AsyncSession, user_id: uuid.UUID) -> Tuple[TaskCounters, bool]:
+    counters = _counted(user_id, (await session.execute(task_rows(user_id))).all())
+    try:
+        async with session.begin_nested():
+            session.add(counters)
+        return counters, True
+    except IntegrityError:
+        return await session.get(TaskCounters, user_id, with_for_update=True, populate_existing=True), False
+
+
+def record(session: Session, user_id: uuid.UUID, delta: Delta) -> None:
+    """
+    Apply `delta` to the user's counters inside the session's transaction.
+    Call after making the task changes it describes and before committing.
+    """
+    if not delta:
+        return
+    session.flush()
+    # The row lock serialises concurrent writers of the same user
+    counters = session.get(TaskCounters, user_id, with_for_update=True, populate_existing=True)
+    if counters is None:
+        counters, created = rebuild(session, user_id)
+        if created:
+            # The count already includes the flushed changes
+            return
+    delta.apply(counters)
+    session.add(counters)
+
+
+async def arecord(session: AsyncSession, user_id: uuid.UUID, delta: Delta) -> None:
+    if not delta:
+        return
+    await session.flush()
+    counters = await session.get(TaskCounters, user_id, with_for_update=True, populate_existing=True)
+    if counters is None:
+        counters, created = await arebuild(session, user_id)
+        if created:
+            return
+    delta.apply(counters)
+    session.add(counters)
+
+
+def summarize(total: int, completed: int, due_days: Dict[str, int], today: Optional[date] = None) -> Dict[str, Any]:
+    """
+    Statistics from counter values. Costs one step per distinct due day of
+    open tasks, however many tasks there are.
+    """
+    today = (today or datetime.utcnow().date()).isoformat()
+    return {
+        "total": total,
+        "completed": completed,
+        "open": total - completed,
+        "overdue": sum(count for day, count in due_days.items() if day < today),
+        "due_today": due_days.get(today, 0),
+    }
+
+
+def stats(counters: TaskCounters, pending: Optional[Delta] = None) -> Dict[str, Any]:
+    """
+    Statistics of a counters row, plus `pending` changes not yet recorded
+    """
+    values = (counters.total, counters.completed, counters.open_due_days or {})
+    if pending:
+        values = pending.applied(*values)
+    return summarize(*values)
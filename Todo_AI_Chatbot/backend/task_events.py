@@ -0,0 +1,35 @@
+import logging
+import uuid
+from typing import Callable, List, Optional
+from models import Task
+
+logger = logging.getLogger(__name__)
+
+# Kinds of task change
+CREATED = "created"
+UPDATED = "updated"
+DELETED = "deleted"
+
+TaskListener = Callable[[str, uuid.UUID, Optional[Task]], None]
+_listeners: List[TaskListener] = []
+
+
+def subscribe(listener: TaskListener) -> None:
+    """
+    Register `listener(kind, user_id, task)` to run after every task write
+    made through routes/tasks.py or AsyncMCPTools
+    """
+    _listeners.append(listener)
+
+
+def task_changed(kind: str, user_id: uuid.UUID, task: Optional[Task] = None) -> None:
+    """
+    Notify listeners that a user's task was created, updated or deleted.
+    Call after the write has been committed.
+    """
+    for listener in list(_listeners):
+        try:
+            listener(kind, user_id, task)
+        except Exception:
+            # A broken listener must not fail the write that already happened
+            logger.exception("Task listener %r failed", listener)
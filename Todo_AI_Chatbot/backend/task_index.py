@@ -0,0 +1,252 @@
+"""
+Semantic index of task titles and descriptions.
+
+Tasks are embedded locally as signed hashed vectors of their words and
+character trigrams, so no model download or network call is involved and
+"report" still finds "reports". Each user's index is one float32 matrix of
+unit rows, so a lookup is a single matrix-vector product. Indexes are built
+on a user's first lookup and updated from task_events after every committed
+write made in this process. They are rebuilt after TASK_INDEX_TTL_SECONDS to
+pick up writes made by other processes.
+"""
+import asyncio
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select
+from config import settings
+from metrics import TASK_INDEX_LATENCY
+from models import Task
+import task_events
+
+try:
+    import numpy as np
+except ImportError:  # The index is optional
+    np = None
+
+_WORD = re.compile(r"[a-z0-9]+")
+# Words that do not tell tasks apart ("finish the report thing")
+_STOP_WORDS = frozenset("a an and the to of for on in at my me i it its this that thing things stuff task todo".split())
+TRIGRAM_WEIGHT = 0.5
+DESCRIPTION_WEIGHT = 0.5
+
+
+def _features(text: str) -> List[Tuple[str, float]]:
+    features = []
+    for word in _WORD.findall(text.lower()):
+        if word in _STOP_WORDS:
+            continue
+        features.append((f"w:{word}", 1.0))
+        padded = f"#{word}#"
+        features.extend((padded[start:start + 3], TRIGRAM_WEIGHT) for start in range(len(padded) - 2))
+    return features
+
+
+def _hashed(text: str, dimensions: int) -> "np.ndarray":
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature, weight in _features(text):
+        digest = zlib.crc32(feature.encode())
+        # The sign bit keeps colliding features from always adding up
+        vector[digest % dimensions] += weight if digest & 0x80000000 else -weight
+    return vector
+
+
+def embed(title: str, description: Optional[str] = None,
+          dimensions: int = settings.TASK_INDEX_DIMENSIONS) -> "np.ndarray":
+    """
+    Unit-length vector of a task (or of a query, passed as `title`)
+    """
+    vector = _hashed(title or "", dimensions)
+    if description:
+        vector += DESCRIPTION_WEIGHT * _hashed(description, dimensions)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+class UserIndex:
+    """
+    One user's task vectors. Rows are kept dense: removing a task moves the
+    last row into its place.
+    """
+
+    def __init__(self, dimensions: int, capacity: int = 16):
+        self.ids: List[uuid.UUID] = []
+        self.positions: Dict[uuid.UUID, int] = {}
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.completed = np.zeros(capacity, dtype=bool)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple], dimensions: int) -> "UserIndex":
+        """
+        Index (id, title, description, completed) rows
+        """
+        rows = list(rows)
+        index = cls(dimensions, capacity=max(16, len(rows)))
+        for position, (task_id, title, description, completed) in enumerate(rows):
+            index.ids.append(task_id)
+            index.positions[task_id] = position
+            index.vectors[position] = embed(title, description, dimensions)
+            index.completed[position] = bool(completed)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def upsert(self, task_id: uuid.UUID, vector: "np.ndarray", completed: bool) -> None:
+        position = self.positions.get(task_id)
+        if position is None:
+            position = len(self.ids)
+            if position == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+                self.completed = np.concatenate([self.completed, np.zeros_like(self.completed)])
+            self.ids.append(task_id)
+            self.positions[task_id] = position
+        self.vectors[position] = vector
+        self.completed[position] = completed
+
+    def remove(self, task_id: uuid.UUID) -> None:
+        position = self.positions.pop(task_id, None)
+        if position is None:
+            return
+        last = len(self.ids) - 1
+        if position != last:
+            moved = self.ids[last]
+            self.ids[position] = moved
+            self.positions[moved] = position
+            self.vectors[position] = self.vectors[last]
+            self.completed[position] = self.completed[last]
+        self.ids.pop()
+
+    def search(self, query: "np.ndarray", limit: int, min_score: float,
+               include_completed: bool) -> List[Tuple[uuid.UUID, float]]:
+        size = len(self.ids)
+        if not size or limit <= 0:
+            return []
+        scores = self.vectors[:size] @ query
+        if not include_completed:
+            scores = np.where(self.completed[:size], -1.0, scores)
+        top = np.argpartition(-scores, limit)[:limit] if limit < size else np.arange(size)
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[position], float(scores[position])) for position in top if scores[position] >= min_score]
+
+
+class TaskIndex:
+    """
+    Per-user UserIndexes, least recently used first out
+    """
+
+    def __init__(self, dimensions: int, max_users: int, ttl: float):
+        self.dimensions = dimensions
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users: "OrderedDict[uuid.UUID, UserIndex]" = OrderedDict()
+        self._locks: Dict[uuid.UUID, asyncio.Lock] = {}
+        # Writes that arrive while a user's index is being built, replayed onto it afterwards
+        self._pending: Dict[uuid.UUID, List[tuple]] = {}
+        # task_events listeners also run in threadpool threads (sync routes)
+        self._mutex = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return np is not None and settings.TASK_INDEX_ENABLED
+
+    def _fresh(self, user_id: uuid.UUID) -> Optional[UserIndex]:
+        with self._mutex:
+            index = self._users.get(user_id)
+            if index is None or time.monotonic() - index.built_at > self.ttl:
+                return None
+            self._users.move_to_end(user_id)
+            return index
+
+    async def get(self, user_id: uuid.UUID, session) -> UserIndex:
+        """
+        The user's index, built from `session` when missing or expired
+        """
+        index = self._fresh(user_id)
+        if index is not None:
+            return index
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            index = self._fresh(user_id)
+            if index is None:
+                index = await self._build(user_id, session)
+        return index
+
+    async def _build(self, user_id: uuid.UUID, session) -> UserIndex:
+        started = time.perf_counter()
+        self._pending[user_id] = []
+        try:
+            rows = (await session.execute(
+                select(Task.id, Task.title, Task.description, Task.completed).where(Task.user_id == user_id)
+            )).all()
+            # Embedding thousands of tasks takes a while; keep it off the event loop
+            index = await asyncio.to_thread(UserIndex.from_rows, rows, self.dimensions)
+        except BaseException:
+            with self._mutex:
+                del self._pending[user_id]
+            raise
+
+        with self._mutex:
+            for kind, task in self._pending.pop(user_id):
+                self._apply(index, kind, task)
+            self._users[user_id] = index
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                evicted, _ = self._users.popitem(last=False)
+                lock = self._locks.get(evicted)
+                if lock is not None and not lock.locked():
+                    del self._locks[evicted]
+        TASK_INDEX_LATENCY.labels("build").observe(time.perf_counter() - started)
+        return index
+
+    def _apply(self, index: UserIndex, kind: str, task: Task) -> None:
+        if kind == task_events.DELETED:
+            index.remove(task.id)
+        else:
+            index.upsert(task.id, embed(task.title, task.description, self.dimensions), bool(task.completed))
+
+    def task_changed(self, kind: str, user_id: uuid.UUID, task: Optional[Task]) -> None:
+        """
+        task_events listener: keep loaded indexes current
+        """
+        if task is None or not self.enabled:
+            return
+        with self._mutex:
+            if user_id in self._pending:
+                self._pending[user_id].append((kind, task))
+            index = self._users.get(user_id)
+            if index is not None:
+                self._apply(index, kind, task)
+
+    async def search(self, user_id: uuid.UUID, session, text: str, limit: int = 5, min_score: float = 0.0,
+                     include_completed: bool = False) -> List[Tuple[uuid.UUID, float]]:
+        """
+        (task id, cosine similarity) of the user's tasks closest to `text`, best first
+        """
+        index = await self.get(user_id, session)
+        started = time.perf_counter()
+        query = embed(text, dimensions=self.dimensions)
+        with self._mutex:
+            results = index.search(query, limit, min_score, include_completed)
+        TASK_INDEX_LATENCY.labels("search").observe(time.perf_counter() - started)
+        return results
+
+    def score(self, text: str, tasks: Iterable[Task]) -> List[Tuple[Task, float]]:
+        """
+        Similarity of `text` to tasks that are not in an index (such as uncommitted ones)
+        """
+        query = embed(text, dimensions=self.dimensions)
+        return [(task, float(embed(task.title, task.description, self.dimensions) @ query)) for task in tasks]
+
+
+task_index = TaskIndex(
+    dimensions=settings.TASK_INDEX_DIMENSIONS,
+    max_users=settings.TASK_INDEX_MAX_USERS,
+    ttl=settings.TASK_INDEX_TTL_SECONDS,
+)
+task_events.subscribe(task_index.task_changed)
@@ -0,0 +1,315 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """
+    A timed operation within a trace, modelled on the OpenTelemetry span.
+    Unsampled spans carry the trace context for propagation but record nothing.
+    """
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "sampled",
+                 "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, kind: str = "internal"):
+        self.trace_id = trace_id
+        self.span_id = _random_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.status = "ok"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if self.sampled:
+            self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = "error"
+        self.set_attribute("error.type", type(error).__name__)
+        self.set_attribute("error.message", str(error))
+
+    def end(self) -> None:
+        self.end_ns = time.time_ns()
+        if self.sampled:
+            exporter.export(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6 if self.end_ns else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class FileSpanExporter:
+    """
+    Buffers finished spans and appends them as JSON lines to a file,
+    which a collector (or a person with jq) can pick up.
+
+    Spans end on the event loop (requests, SQL statements), so full batches
+    are written by a background thread. At most `max_batches` wait for it;
+    further batches are dropped rather than held in memory while the disk
+    is slow.
+    """
+
+    def __init__(self, path: Optional[str], batch_size: int = 256, max_batches: int = 64):
+        self.path = path
+        self.batch_size = batch_size
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._batches: "queue.Queue[List[Dict[str, Any]]]" = queue.Queue(maxsize=max_batches)
+        self._writer: Optional[threading.Thread] = None
+
+    def export(self, span: Span) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            self._buffer.append(span.to_dict())
+            if len(self._buffer) < self.batch_size:
+                return
+            batch, self._buffer = self._buffer, []
+        self._submit(batch)
+
+    def flush(self) -> None:
+        """
+        Write everything buffered and wait until the writer thread is done
+        """
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+        if batch:
+            self._submit(batch)
+        self._batches.join()
+
+    def _submit(self, batch: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._writer.start()
+        try:
+            self._batches.put_nowait(batch)
+        except queue.Full:
+            logger.warning("Span export is falling behind; dropped %d spans", len(batch))
+
+    def _run(self) -> None:
+        while True:
+            batch = self._batches.get()
+            try:
+                self._write(batch)
+            finally:
+                self._batches.task_done()
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        try:
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(span) + "\n" for span in batch))
+        except OSError:
+            logger.exception("Could not export %d spans to %s", len(batch), self.path)
+
+
+exporter = FileSpanExporter(settings.TRACE_EXPORT_PATH)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def _random_hex(num_bytes: int) -> str:
+    return os.urandom(num_bytes).hex()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[tuple[str, str, bool]]:
+    """
+    Parse a W3C traceparent header into (trace_id, parent_span_id, sampled)
+    """
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3][:2], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 0x01)
+
+
+def start_span(name: str, kind: str = "internal", traceparent: Optional[str] = None) -> Span:
+    """
+    Start a child of the current span, or a new root span. Root spans continue
+    an incoming traceparent and honour its sampling decision; otherwise they are
+    sampled at TRACE_SAMPLE_RATIO. Children inherit their parent's decision.
+    """
+    parent = _current_span.get()
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind)
+
+    incoming = parse_traceparent(traceparent)
+    if incoming is not None:
+        trace_id, parent_id, sampled = incoming
+        return Span(name, trace_id, parent_id, sampled, kind)
+
+    sampled = settings.TRACE_SAMPLE_RATIO > 0 and random.random() < settings.TRACE_SAMPLE_RATIO
+    return Span(name, _random_hex(16), None, sampled, kind)
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """
+    Run the enclosed block inside a new span
+    """
+    parent = _current_span.get()
+    if parent is not None and not parent.sampled:
+        # Nothing below an unsampled span is recorded; skip creating one
+        yield parent
+        return
+
+    current = start_span(name, kind)
+    for key, value in attributes.items():
+        current.set_attribute(key, value)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def traced(name: str):
+    """
+    Decorator wrapping a sync or async function in a span
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def install_sql_tracing(engine: Engine, name: str) -> None:
+    """
+    Create a client span for every statement executed on a (sync) engine.
+    For an AsyncEngine pass `async_engine.sync_engine`.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return
+        sql_span = start_span("db.query", kind="client")
+        sql_span.set_attribute("db.system", conn.dialect.name)
+        sql_span.set_attribute("db.engine", name)
+        sql_span.set_attribute("db.statement", statement)
+        context._trace_span = sql_span
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        sql_span = getattr(context, "_trace_span", None)
+        if sql_span is not None:
+            sql_span.end()
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        context = exception_context.execution_context
+        sql_span = getattr(context, "_trace_span", None) if context is not None else None
+        if sql_span is not None:
+            sql_span.record_error(exception_context.original_exception)
+            sql_span.end()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware opening a server span per request and propagating traceparent
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        traceparent = headers.get(b"traceparent")
+        request_span = start_span(
+            f"{scope['method']} {scope['path']}",
+            kind="server",
+            traceparent=traceparent.decode("latin-1") if traceparent else None,
+        )
+        request_span.set_attribute("http.method", scope["method"])
+        request_span.set_attribute("http.target", scope["path"])
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                request_span.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    request_span.status = "error"
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"traceparent", request_span.traceparent.encode("latin-1"))
+                ]
+            await send(message)
+
+        token = _current_span.set(request_span)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            request_span.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                request_span.name = f"{scope['method']} {route.path}"
+                request_span.set_attribute("http.route", route.path)
+            request_span.end()
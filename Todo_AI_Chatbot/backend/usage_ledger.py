@@ -0,0 +1,182 @@
+"""
+Per-user LLM usage ledger and daily token budget.
+
+Every chat completion is recorded in memory and added to the token_usage
+row of its (user, UTC day, model) every USAGE_FLUSH_SECONDS, so the ledger
+costs one small upsert per active user per flush rather than a write per
+completion. Budget checks read the user's flushed total for today (cached for
+USAGE_BUDGET_CACHE_SECONDS) plus what this process has not flushed yet.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional, Tuple
+from sqlalchemy import func, insert, select, update
+from config import settings
+from db import AsyncSession, async_engine
+from models import TokenUsage
+
+logger = logging.getLogger(__name__)
+
+# Counters summed into a token_usage row
+COUNTERS = ("turns", "completions", "prompt_tokens", "completion_tokens", "tool_result_bytes", "latency_ms")
+
+Key = Tuple[uuid.UUID, date, str]
+
+
+def _today() -> date:
+    return datetime.utcnow().date()
+
+
+def seconds_until_tomorrow() -> float:
+    now = datetime.utcnow()
+    return (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+
+class TokenBudgetExceeded(Exception):
+    """
+    Raised when a user has used up today's LLM token budget
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__("Daily AI usage limit reached, please try again tomorrow")
+        self.retry_after = retry_after
+
+
+class UsageLedger:
+    """
+    Write-behind aggregation of completions into token_usage rows.
+    Unflushed counts are merged back and retried when a flush fails.
+    """
+
+    def __init__(self, flush_interval: float, daily_budget: int, cache_seconds: float):
+        self.flush_interval = flush_interval
+        self.daily_budget = daily_budget
+        self.cache_seconds = cache_seconds
+        self._pending: Dict[Key, Dict[str, int]] = {}
+        # user -> (day, flushed tokens that day, fetched at)
+        self._totals: Dict[uuid.UUID, Tuple[date, int, float]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def record(self, user_id: uuid.UUID, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+               latency_ms: int = 0, tool_result_bytes: int = 0, turns: int = 0, completions: int = 1) -> None:
+        """
+        Add one completion (or, with completions=0, just tool-result bytes) to the user's usage today
+        """
+        counters = self._pending.setdefault((user_id, _today(), model), dict.fromkeys(COUNTERS, 0))
+        counters["turns"] += turns
+        counters["completions"] += completions
+        counters["prompt_tokens"] += prompt_tokens
+        counters["completion_tokens"] += completion_tokens
+        counters["tool_result_bytes"] += tool_result_bytes
+        counters["latency_ms"] += latency_ms
+
+    def _unflushed_tokens(self, user_id: uuid.UUID, day: date) -> int:
+        return sum(
+            counters["prompt_tokens"] + counters["completion_tokens"]
+            for (pending_user, pending_day, _), counters in self._pending.items()
+            if pending_user == user_id and pending_day == day
+        )
+
+    async def used_today(self, user_id: uuid.UUID) -> int:
+        """
+        Tokens the user has used today, including completions not flushed yet
+        """
+        day = _today()
+        cached = self._totals.get(user_id)
+        if cached is None or cached[0] != day or time.monotonic() - cached[2] > self.cache_seconds:
+            async with AsyncSession() as session:
+                flushed = (await session.execute(
+                    select(func.coalesce(func.sum(TokenUsage.prompt_tokens + TokenUsage.completion_tokens), 0))
+                    .where(TokenUsage.user_id == user_id, TokenUsage.day == day)
+                )).scalar_one()
+            cached = (day, int(flushed), time.monotonic())
+            self._totals[user_id] = cached
+        return cached[1] + self._unflushed_tokens(user_id, day)
+
+    async def check_budget(self, user_id: uuid.UUID) -> None:
+        """
+        Raise TokenBudgetExceeded if the user has no tokens left today
+        """
+        if self.daily_budget > 0 and await self.used_today(user_id) >= self.daily_budget:
+            raise TokenBudgetExceeded(seconds_until_tomorrow())
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background task and flush the remaining counts
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def flush(self) -> None:
+        """
+        Add the pending counts to token_usage in one transaction
+        """
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        now = datetime.utcnow()
+        try:
+            async with async_engine.begin() as conn:
+                for (user_id, day, model), counters in pending.items():
+                    key = (TokenUsage.user_id == user_id, TokenUsage.day == day, TokenUsage.model == model)
+                    result = await conn.execute(
+                        update(TokenUsage)
+                        .where(*key)
+                        .values(updated_at=now, **{
+                            name: getattr(TokenUsage, name) + value for name, value in counters.items()
+                        })
+                    )
+                    if result.rowcount == 0:
+                        await conn.execute(insert(TokenUsage).values(
+                            user_id=user_id, day=day, model=model, updated_at=now, **counters
+                        ))
+        except Exception:
+            # Merge the batch back into whatever was recorded meanwhile
+            for key, counters in pending.items():
+                merged = self._pending.setdefault(key, dict.fromkeys(COUNTERS, 0))
+                for name, value in counters.items():
+                    merged[name] += value
+            raise
+        # The flushed counts now live in the database total, which is re-read on the next check
+        for user_id, _, _ in pending:
+            self._totals.pop(user_id, None)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Flushing token usage for %d users failed", len({key[0] for key in self._pending}))
+                if self._stopping:
+                    logger.error("Dropping unflushed token usage on shutdown")
+                    return
+                continue
+
+            if self._stopping:
+                return
+
+
+usage_ledger = UsageLedger(
+    flush_interval=settings.USAGE_FLUSH_SECONDS,
+    daily_budget=settings.LLM_DAILY_TOKEN_BUDGET,
+    cache_seconds=settings.USAGE_BUDGET_CACHE_SECONDS,
+)
@@ -0,0 +1,49 @@
+"""
+Background job worker.
+
+    python worker.py --queues default reminders --concurrency 8
+
+Runs jobs queued through jobs.job_queue until SIGINT/SIGTERM, then finishes
+the jobs in flight and exits. Start as many worker processes as needed;
+they share the jobs table through SKIP LOCKED.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+from config import settings
+from db import async_engine
+from jobs import Worker, job_queue
+from metrics import instrument_engine
+import reminders  # noqa: F401 - registers the reminder.deliver handler
+
+
+async def run(queues, concurrency: int) -> None:
+    worker = Worker(job_queue, queues, concurrency=concurrency, poll_interval=settings.JOB_POLL_INTERVAL_SECONDS)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    await worker.start()
+    logging.getLogger(__name__).info("Worker running on queues %s with concurrency %d", queues, concurrency)
+    await stop.wait()
+    await worker.stop()
+    await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background jobs")
+    parser.add_argument("--queues", nargs="+", default=["default", "reminders"])
+    parser.add_argument("--concurrency", type=int, default=settings.JOB_WORKER_CONCURRENCY)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if settings.JOB_QUEUE_BACKEND == "memory":
+        parser.error("JOB_QUEUE_BACKEND=memory only works with the in-process worker (JOB_WORKER_IN_PROCESS)")
+    instrument_engine(async_engine.sync_engine, "async")
+    asyncio.run(run(args.queues, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()